@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
 import pkg_resources
-from .base.movies import movie, load, load_movie_chain
-from .base.timeseries import concatenate
+from .base.movies import movie, load, load_movie_chain, MovieReader, MovieChain
+from .base.timeseries import concatenate, save_movie_file
 from .cluster import start_server, stop_server
-from .mmapping import load_memmap, save_memmap, save_memmap_each, save_memmap_join
+from .mmapping import load_memmap, save_memmap, save_memmap_each, save_memmap_join, save_chunked, load_chunked
 from .summary_images import local_correlations
 #from .source_extraction import cnmf
 
@@ -15,9 +15,12 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from functools import partial
 import h5py
+import json
 import logging
 from matplotlib import animation
 import numpy as np
@@ -34,9 +37,10 @@ from sklearn.cluster import KMeans
 from sklearn.decomposition import NMF, incremental_pca, FastICA
 from sklearn.metrics.pairwise import euclidean_distances
 import sys
+import threading
 import tifffile
 from tqdm import tqdm
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 import warnings
 from zipfile import ZipFile
 
@@ -58,7 +62,9 @@ except ImportError:
 from . import timeseries as ts
 from .traces import trace
 
-from ..mmapping import load_memmap
+from ..mmapping import load_memmap, memmap_offset, is_chunked_store, ChunkedStore, prepare_shape, \
+    save_memmap_header, _to_memmap_dtype
+from ..paths import memmap_frames_filename
 from ..utils import visualization
 from .. import summary_images as si
 from ..motion_correction import apply_shift_online, motion_correct_online
@@ -304,7 +310,7 @@ class movie(ts.timeseries):
         return self, shifts, xcorrs, template
 
     def bin_median(self, window: int = 10) -> np.ndarray:
-        """ compute median of 3D array in along axis o by binning values
+        """ compute median of 3D array in along axis o by binning values (see bin_median_file for files)
 
         Args:
             mat: ndarray
@@ -574,7 +580,7 @@ class movie(ts.timeseries):
     
     def removeBL(self, windowSize:int=100, quantilMin:int=8, in_place:bool=False, returnBL:bool=False):                   
         """
-        Remove baseline from movie using percentiles over a window
+        Remove baseline from movie using percentiles over a window (see removeBL_file for files)
         Args:
             windowSize: int
                 window size over which to compute the baseline (the larger the faster the algorithm and the less granular
@@ -619,7 +625,8 @@ class movie(ts.timeseries):
         compute the DFF of the movie or remove baseline
 
         In order to compute the baseline frames are binned according to the window length parameter
-        and then the intermediate values are interpolated.
+        and then the intermediate values are interpolated. See computeDFF_file for movies that do
+        not fit in memory.
 
         Args:
             secsWindow: length of the windows used to compute the quantile
@@ -1050,7 +1057,8 @@ class movie(ts.timeseries):
         Resizing caiman movie into a new one. Note that the temporal
         dimension is controlled by fz and fx, fy, fz correspond to
         magnification factors. For example to downsample in time by
-        a factor of 2, you need to set fz = 0.5.
+        a factor of 2, you need to set fz = 0.5. See resize_file for
+        movies that do not fit in memory.
 
         Args:
             fx (float):
@@ -1424,7 +1432,7 @@ def load(file_name: Union[str, List[str]],
     load movie from file. Supports a variety of formats. tif, hdf5, npy and memory mapped. Matlab is experimental.
 
     Args:
-        file_name: string or List[str]
+        file_name: string or List[str] or MovieChain or SbxMovie
             name of file. Possible extensions are tif, avi, npy, (npz and hdf5 are usable only if saved by calblitz)
 
         fr: float
@@ -1453,7 +1461,8 @@ def load(file_name: Union[str, List[str]],
 
         channel: (undocumented)
 
-        outtype: The data type for the movie
+        outtype: The data type for the movie. If None the data type of the file is kept (e.g. uint16
+            data of the camera, that take half the memory of float32)
 
     Returns:
         mov: caiman.movie
@@ -1469,6 +1478,16 @@ def load(file_name: Union[str, List[str]],
     
         Exception 'File not found!'
     """
+    if isinstance(file_name, (MovieChain, SbxMovie)):
+        if subindices is None:
+            input_arr = file_name[:]
+        else:
+            input_arr = file_name[tuple(subindices) if isinstance(subindices, list) else subindices]
+        if outtype is not None:
+            input_arr = input_arr.astype(outtype, copy=False)
+        return movie(input_arr, fr=fr, start_time=start_time, file_name=file_name.file_name,
+                     meta_data=meta_data)
+
     # case we load movie from file
     if max(top, bottom, left, right) > 0 and type(file_name) is str:
         file_name = [file_name]        # type: ignore # mypy doesn't like that this changes type
@@ -1519,7 +1538,16 @@ def load(file_name: Union[str, List[str]],
             if mjv == 2:
                 extension = '.h5'
 
-        if extension == '.tif' or extension == '.tiff':        # load avi file
+        index = tiff_index(file_name) if extension in ('.tif', '.tiff') else None
+        if index is not None and index.contiguous:
+            # read the pages from their offsets
+            frames = subindices[0] if isinstance(subindices, list) else subindices
+            input_arr = index.read(slice(None) if frames is None else frames)
+            if isinstance(subindices, list):
+                input_arr = input_arr[:, subindices[1], subindices[2]]
+            input_arr = np.squeeze(input_arr)
+
+        elif extension == '.tif' or extension == '.tiff':        # load avi file
             with tifffile.TiffFile(file_name) as tffl:
                 multi_page = True if tffl.series[0].shape[0] > 1 else False
                 if len(tffl.pages) == 1:
@@ -1650,7 +1678,7 @@ def load(file_name: Union[str, List[str]],
             if subindices is not None:
                 raise Exception('Subindices not implemented')
             with np.load(file_name) as f:
-                return movie(**f).astype(outtype)
+                return _astype(movie(**f), outtype)
 
         elif extension in ('.hdf5', '.h5', '.nwb'):
             if is_behavior:
@@ -1689,7 +1717,7 @@ def load(file_name: Union[str, List[str]],
                                 images = np.array(fgroup[subindices]).squeeze()
 
                         #input_arr = images
-                        return movie(images.astype(outtype))
+                        return movie(_astype(images, outtype))
                     else:
                         logging.debug('KEYS:' + str(f.keys()))
                         raise Exception('Key not found in hdf5 file')
@@ -1706,17 +1734,22 @@ def load(file_name: Union[str, List[str]],
 
             if in_memory:
                 logging.debug('loading mmap file in memory')
-                images = np.array(images).astype(outtype)
+                images = _astype(np.array(images), outtype)
+                offset = memmap_offset(file_name)
+                if offset != 0 and images.dtype.kind == 'f':
+                    images += images.dtype.type(offset)
 
             logging.debug('mmap')
             return movie(images, fr=fr)
 
         elif extension == '.sbx':
             logging.debug('sbx')
-            if subindices is not None:
-                return movie(sbxreadskip(file_name[:-4], subindices), fr=fr).astype(outtype)
-            else:
-                return movie(sbxread(file_name[:-4], k=0, n_frames=np.inf), fr=fr).astype(outtype)
+            sbx_mov = SbxMovie(file_name)
+            if subindices is None:
+                subindices = slice(None)
+            elif not isinstance(subindices, slice):
+                subindices = np.asarray(list(subindices))
+            return movie(_astype(sbx_mov[subindices], outtype), fr=fr)
 
         elif extension == '.sima':
             if not HAS_SIMA:
@@ -1740,13 +1773,18 @@ def load(file_name: Union[str, List[str]],
         logging.error(f"File request:[{file_name}] not found!")
         raise Exception('File not found!')
 
-    return movie(input_arr.astype(outtype),
+    return movie(_astype(input_arr, outtype),
                  fr=fr,
                  start_time=start_time,
                  file_name=os.path.split(file_name)[-1],
                  meta_data=meta_data)
 
 
+def _astype(arr: np.ndarray, outtype) -> np.ndarray:
+    """ converts arr to outtype, keeping its data type if outtype is None """
+    return arr if outtype is None else arr.astype(outtype)
+
+
 def load_movie_chain(file_list: List[str],
                      fr: float = 30,
                      start_time=0,
@@ -1778,7 +1816,8 @@ def load_movie_chain(file_list: List[str],
 
     Returns:
         movie: movie
-            movie corresponding to the concatenation og the input files
+            movie corresponding to the concatenation og the input files. See MovieChain to read the
+            concatenation lazily instead
 
     """
     mov = []
@@ -1813,6 +1852,217 @@ def load_movie_chain(file_list: List[str],
     return ts.concatenate(mov, axis=0)
 
 
+class MovieChain(object):
+    """
+    Lazy concatenation of movie files along time, as loaded by load_movie_chain but without
+    loading them in memory.
+
+    Global frame indices are mapped to (file, local index) through a table of the frame offsets of
+    the files, and only the requested frames are read, with MovieReader. The chain can be indexed
+    like an array (chain[t0:t1, y0:y1, x0:x1]) and given in place of a file name to MovieReader,
+    load, get_file_size, MotionCorrect and save_memmap (which processes the files one at a time),
+    and to local_correlations.
+
+    Example of usage:
+        chain = MovieChain(sorted(glob.glob('trial_*.tif')), top=10, bottom=10)
+        mc = MotionCorrect(chain, dview=dview, **mc_pars)
+        mc.motion_correct(save_movie=True)
+
+    The chain is also a path like object, whose path (file_name) is only used to name the files
+    derived from it (by default <first file>_chain.chn, in the folder of the first file).
+    """
+
+    def __init__(self, file_list: List[str], fr: float = 30, subindices=None, var_name_hdf5: str = 'mov',
+                 bottom=0, top=0, left=0, right=0, z_top=0, z_bottom=0, is3D: bool = False, channel=None,
+                 outtype=np.float32, file_name: str = None, max_open: int = 16) -> None:
+        """
+        Args:
+            file_list: list
+                file names, in any format supported by MovieReader
+
+            fr: float
+                frame rate
+
+            subindices: slice, range or list of ints
+                frames selected in each file
+
+            var_name_hdf5: str
+                if loading from hdf5 name of the variable to load
+
+            bottom, top, left, right, z_top, z_bottom: int
+                number of pixels cropped on each side of the field of view
+
+            is3D: bool
+                flag for 3d data
+
+            channel: int
+                index of the channel, for files whose first axis are the channels
+
+            outtype: The data type of the returned frames. If None the data type of the files is kept
+
+            file_name: str
+                path of the chain (see above)
+
+            max_open: int
+                maximum number of files kept open at the same time
+
+        Raises:
+            Exception 'The files have different dimensions'
+        """
+        self.file_list = list(file_list)
+        self.fr = fr
+        self.subindices = subindices
+        self.var_name_hdf5 = var_name_hdf5
+        self.channel = channel
+        self.outtype = outtype
+        self.is3D = is3D
+        self.max_open = max_open
+        if file_name is None:
+            folder, name = os.path.split(self.file_list[0])
+            file_name = os.path.join(folder, os.path.splitext(name)[0] + '_chain.chn')
+        self.file_name = file_name
+        self.margins = dict(bottom=bottom, top=top, left=left, right=right, z_top=z_top, z_bottom=z_bottom)
+        margins = [(top, bottom), (left, right)] + ([(z_top, z_bottom)] if is3D else [])
+
+        lengths, dims, dtype = [], None, None
+        # frames selected in each file, when subindices is given
+        self._frames: List[np.ndarray] = []
+        for f in self.file_list:
+            reader = self._open(f)
+            shape = reader.shape[1:] if channel is not None else reader.shape
+            dtype = reader.dtype if dtype is None else dtype
+            reader.close()
+            if dims is None:
+                dims = shape[1:]
+            elif tuple(shape[1:]) != tuple(dims):
+                raise Exception('The files have different dimensions')
+            if subindices is not None:
+                self._frames.append(np.arange(shape[0])[subindices])
+            lengths.append(len(self._frames[-1]) if subindices is not None else shape[0])
+        self._crop = tuple(slice(lo, d - hi) for (lo, hi), d in zip(margins, dims))
+        self.lengths = np.array(lengths, dtype=np.int64)
+        # global index of the first frame of each file
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.shape = (int(self.offsets[-1]),) + tuple(len(range(d)[sl]) for sl, d in zip(self._crop, dims))
+        self.dtype = np.dtype(dtype)
+        self.array = None
+        self._readers: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def dims(self) -> Tuple:
+        return self.shape[1:]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __fspath__(self) -> str:
+        return self.file_name
+
+    def __repr__(self) -> str:
+        return 'MovieChain({} files, shape={})'.format(len(self.file_list), self.shape)
+
+    def __getstate__(self):
+        # the open files are not sent to other processes
+        state = self.__dict__.copy()
+        state['_readers'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __iter__(self):
+        for file_index in range(len(self.file_list)):
+            for frame in self[self.offsets[file_index]:self.offsets[file_index + 1]]:
+                yield frame
+
+    def close(self) -> None:
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+    def _open(self, file_name: str) -> 'MovieReader':
+        return MovieReader(file_name, var_name_hdf5=self.var_name_hdf5, cache_size=0,
+                           outtype=self.outtype)
+
+    def _reader(self, file_index: int) -> 'MovieReader':
+        """ reader of a file, the least recently used one is closed when more than max_open are open """
+        with self._lock:
+            if file_index in self._readers:
+                self._readers.move_to_end(file_index)
+                return self._readers[file_index]
+            reader = self._open(self.file_list[file_index])
+            self._readers[file_index] = reader
+            while len(self._readers) > self.max_open:
+                self._readers.popitem(last=False)[1].close()
+            return reader
+
+    def locate(self, idx) -> Tuple[np.ndarray, np.ndarray]:
+        """ file index and index of the frame in its file of the global frame indices idx """
+        idx = np.asarray(idx, dtype=np.int64)
+        file_index = np.searchsorted(self.offsets, idx, side='right') - 1
+        local = idx - self.offsets[file_index]
+        if self.subindices is not None:
+            local = np.array([self._frames[f][l] for f, l in zip(file_index, local)], dtype=np.int64)
+        return file_index, local
+
+    def parts(self) -> List['MovieChain']:
+        """ one chain per file, with the same options """
+        return [MovieChain([f], fr=self.fr, subindices=self.subindices, var_name_hdf5=self.var_name_hdf5,
+                           is3D=self.is3D, channel=self.channel, outtype=self.outtype, **self.margins)
+                for f in self.file_list]
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self[start:stop]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            ind = [k is Ellipsis for k in key].index(True)
+            key = key[:ind] + (slice(None),) * (self.ndim - len(key) + 1) + key[ind + 1:]
+        time_key, space_key = key[0], (slice(None),) + key[1:]
+        if isinstance(time_key, (int, np.integer)):
+            return self[(np.arange(len(self))[time_key:][:1],) + key[1:]][0]
+        idx = np.arange(len(self))[time_key]
+        file_index, local = self.locate(idx)
+        out = None
+        for f in np.unique(file_index):
+            sel = np.where(file_index == f)[0]
+            frames = local[sel]
+            reader = self._reader(f)
+            if len(frames) > 1 and np.all(np.diff(frames) == 1):
+                frames = slice(frames[0], frames[-1] + 1)
+            if self.channel is not None:
+                data = reader[(self.channel, frames) + self._crop]
+            else:
+                data = reader[(frames,) + self._crop]
+            data = data[space_key]
+            if out is None:
+                out = np.empty((len(idx),) + data.shape[1:], dtype=data.dtype)
+            out[sel] = data
+        if out is None:
+            out = np.empty((0,) + self.dims, dtype=self.dtype if self.outtype is None
+                           else self.outtype)[space_key]
+        return out
+
+
 ####
 # TODO: Consider pulling these functions that work with .mat files into a separate file
 
@@ -1856,11 +2106,17 @@ def _todict(matobj) -> Dict:
     return ret
 
 
-def sbxread(filename: str, k: int = 0, n_frames=np.inf) -> np.ndarray:
-    """
+def sbxinfo(filename: str) -> Dict:
+    """ Reads the info structure of a scanbox file and adds the layout of its data
+
     Args:
         filename: str
             filename should be full path excluding .sbx
+
+    Returns:
+        info: dict
+            info structure of the .mat file of the recording, with the number of channels ('nChan'),
+            of optotune planes ('nPlanes') and of frames ('max_idx' + 1) in the .sbx file
     """
     # Check if contains .sbx and if so just truncate
     if '.sbx' in filename:
@@ -1869,171 +2125,171 @@ def sbxread(filename: str, k: int = 0, n_frames=np.inf) -> np.ndarray:
     # Load info
     info = loadmat_sbx(filename + '.mat')['info']
 
-    # Defining number of channels/size factor
+    # Defining number of channels
     if info['channels'] == 1:
         info['nChan'] = 2
-        factor = 1
-    elif info['channels'] == 2:
+    elif info['channels'] in (2, 3):
         info['nChan'] = 1
-        factor = 2
-    elif info['channels'] == 3:
-        info['nChan'] = 1
-        factor = 2
+
+    # Number of planes of optotune (volumetric) recordings
+    otparam = np.atleast_1d(info.get('otparam', []))
+    info['nPlanes'] = int(otparam[2]) if len(otparam) > 2 and otparam[2] > 0 else 1
 
     # Determine number of frames in whole file
-    max_idx = os.path.getsize(filename + '.sbx') / info['recordsPerBuffer'] / info['sz'][1] * factor / 4 - 1
+    frame_bytes = int(info['sz'][1]) * int(info['recordsPerBuffer']) * 2 * info['nChan']
+    info['max_idx'] = os.path.getsize(filename + '.sbx') // frame_bytes - 1
+    return info
 
-    # Paramters
-    N = max_idx + 1    # Last frame
-    N = np.minimum(N, n_frames)
 
-    nSamples = info['sz'][1] * info['recordsPerBuffer'] * 2 * info['nChan']
+class SbxMovie(object):
+    """
+    Lazy view of one channel (and optionally one optotune plane) of a scanbox file.
 
-    # Open File
-    fo = open(filename + '.sbx')
+    The .sbx file is memory mapped, channel, plane and frame selections are views of the memory
+    map and only the indexed frames are read from disk and converted (scanbox stores the values
+    subtracted from the maximum uint16). The view can be indexed like an array of shape
+    (T, d1, d2) and, as MovieChain, given in place of a file name to load, load_iter, MovieReader,
+    get_file_size, MotionCorrect and save_memmap, so that one plane of one channel is processed at
+    a time.
 
-    # Note: SBX files store the values strangely, its necessary to subtract the values from the max int16 to get the correct ones
-    fo.seek(k * nSamples, 0)
-    ii16 = np.iinfo(np.uint16)
-    x = ii16.max - np.fromfile(fo, dtype='uint16', count=int(nSamples / 2 * N))
-    x = x.reshape((int(info['nChan']), int(info['sz'][1]), int(info['recordsPerBuffer']), int(N)), order='F')
+    The view is a path like object, whose path (file_name) is only used to name the files derived
+    from it: <file>_chan<channel>_plane<plane>.sbx (without the parts not selected).
 
-    x = x[0, :, :, :]
+    Args:
+        filename: str
+            name of the file, with or without the .sbx extension
 
-    fo.close()
+        channel: int
+            channel to read (for recordings with two channels)
 
-    return x.transpose([2, 1, 0])
+        plane: int or None
+            optotune plane to read, all the frames if None
 
+    Example:
+        mov = SbxMovie('recording.sbx', channel=1, plane=2)
+        chunk = mov[1000:2000].astype(np.float32)
+        mc = MotionCorrect(mov, dview=dview, **mc_pars)
+    """
 
-def sbxreadskip(filename: str, subindices: slice) -> np.ndarray:
+    def __init__(self, filename: str, channel: int = 0, plane: int = None) -> None:
+        filename = os.fspath(filename)
+        if filename.endswith('.sbx'):
+            filename = filename[:-4]
+        self.filename = filename
+        self.channel = channel
+        self.plane = plane
+        self.info = sbxinfo(filename)
+        n_chan, n_planes = int(self.info['nChan']), self.info['nPlanes']
+        if not 0 <= channel < n_chan:
+            raise Exception('Channel {} not available, the file has {} channel(s)'.format(channel, n_chan))
+        if plane is not None and not 0 <= plane < n_planes:
+            raise Exception('Plane {} not available, the file has {} plane(s)'.format(plane, n_planes))
+        self.file_name = filename + ('_chan{}'.format(channel) if n_chan > 1 else '') + \
+            ('' if plane is None else '_plane{}'.format(plane)) + '.sbx'
+        self._open()
+        self.shape = self.raw.shape
+        self.dtype = np.dtype(np.uint16)
+        self.ndim = 3
+
+    def _open(self) -> None:
+        n_chan, n_planes = int(self.info['nChan']), self.info['nPlanes']
+        # samples are stored in F order (channel, column, row, frame)
+        raw = np.memmap(self.filename + '.sbx', dtype=np.uint16, mode='r',
+                        shape=(int(self.info['max_idx']) + 1, int(self.info['recordsPerBuffer']),
+                               int(self.info['sz'][1]), n_chan))
+        raw = raw[..., self.channel]
+        if self.plane is not None:
+            raw = raw[self.plane::n_planes]
+        self.raw = raw
+
+    @property
+    def dims(self) -> Tuple:
+        return self.shape[1:]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __fspath__(self) -> str:
+        return self.file_name
+
+    def __repr__(self) -> str:
+        return 'SbxMovie({}, channel={}, plane={}, shape={})'.format(self.filename, self.channel, self.plane,
+                                                                    self.shape)
+
+    def __getstate__(self):
+        # the memory map is opened again rather than copied to other processes
+        state = self.__dict__.copy()
+        del state['raw']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __getitem__(self, key) -> np.ndarray:
+        return np.iinfo(np.uint16).max - np.asarray(self.raw[key])
+
+
+def sbxread(filename: str, k: int = 0, n_frames=np.inf, channel: int = 0, plane: int = None) -> np.ndarray:
     """
     Args:
         filename: str
             filename should be full path excluding .sbx
 
-        slice: pass a slice to slice along the last dimension
-    """
-    # Check if contains .sbx and if so just truncate
-    if '.sbx' in filename:
-        filename = filename[:-4]
-
-    # Load info
-    info = loadmat_sbx(filename + '.mat')['info']
-
-    # Defining number of channels/size factor
-    if info['channels'] == 1:
-        info['nChan'] = 2
-        factor = 1
-    elif info['channels'] == 2:
-        info['nChan'] = 1
-        factor = 2
-    elif info['channels'] == 3:
-        info['nChan'] = 1
-        factor = 2
-
-    # Determine number of frames in whole file
-    max_idx = np.int(os.path.getsize(filename + '.sbx') / info['recordsPerBuffer'] / info['sz'][1] * factor / 4 - 1)
+        k: int
+            first frame to read
 
-    # Paramters
-    if isinstance(subindices, slice):
-        if subindices.start is None:
-            start = 0
-        else:
-            start = subindices.start
-
-        if subindices.stop is None:
-            N = max_idx + 1    # Last frame
-        else:
-            N = np.minimum(subindices.stop, max_idx + 1).astype(np.int)
-
-        if subindices.step is None:
-            skip = 1
-        else:
-            skip = subindices.step
-
-        iterable_elements = range(start, N, skip)
-
-    else:
+        n_frames: int
+            number of frames to read
 
-        N = len(subindices)
-        iterable_elements = subindices
-        skip = 0
+        channel: int
+            channel to read
 
-    N_time = len(list(iterable_elements))
-
-    nSamples = info['sz'][1] * info['recordsPerBuffer'] * 2 * info['nChan']
-    assert nSamples >= 0
-
-    # Open File
-    fo = open(filename + '.sbx')
-
-    # Note: SBX files store the values strangely, its necessary to subtract the values from the max int16 to get the correct ones
-
-    counter = 0
-
-    if skip == 1:
-        # Note: SBX files store the values strangely, its necessary to subtract the values from the max int16 to get the correct ones
-        assert start * nSamples > 0
-        fo.seek(start * nSamples, 0)
-        ii16 = np.iinfo(np.uint16)
-        x = ii16.max - np.fromfile(fo, dtype='uint16', count=int(nSamples / 2 * (N - start)))
-        x = x.reshape((int(info['nChan']), int(info['sz'][1]), int(info['recordsPerBuffer']), int(N - start)),
-                      order='F')
-
-        x = x[0, :, :, :]
+        plane: int or None
+            optotune plane to read, all the frames if None
+    """
+    mov = SbxMovie(filename, channel=channel, plane=plane)
+    N = int(np.minimum(len(mov) - k, n_frames))
+    return mov[k:k + N]
 
-    else:
-        for k in iterable_elements:
-            assert k >= 0
-            if counter % 100 == 0:
-                print(f'Reading Iteration: {k}')
-            fo.seek(k * nSamples, 0)
-            ii16 = np.iinfo(np.uint16)
-            tmp = ii16.max - \
-                np.fromfile(fo, dtype='uint16', count=int(nSamples / 2 * 1))
 
-            tmp = tmp.reshape((int(info['nChan']), int(info['sz'][1]), int(info['recordsPerBuffer'])), order='F')
-            if counter == 0:
-                x = np.zeros((tmp.shape[0], tmp.shape[1], tmp.shape[2], N_time))
+def sbxreadskip(filename: str, subindices: slice, channel: int = 0, plane: int = None) -> np.ndarray:
+    """
+    Args:
+        filename: str
+            filename should be full path excluding .sbx
 
-            x[:, :, :, counter] = tmp
-            counter += 1
+        slice: pass a slice to slice along the last dimension
 
-        x = x[0, :, :, :]
-    fo.close()
+        channel: int
+            channel to read
 
-    return x.transpose([2, 1, 0])
+        plane: int or None
+            optotune plane to read, all the frames if None
+    """
+    mov = SbxMovie(filename, channel=channel, plane=plane)
+    if not isinstance(subindices, slice):
+        subindices = np.asarray(list(subindices))
+    return mov[subindices]
 
 
-def sbxshape(filename: str) -> Tuple[int, int, int]:
+def sbxshape(filename: str, plane: int = None) -> Tuple[int, int, int]:
     """
     Args:
         filename should be full path excluding .sbx
-    """
-    # TODO: Document meaning of return values
-
-    # Check if contains .sbx and if so just truncate
-    if '.sbx' in filename:
-        filename = filename[:-4]
 
-    # Load info
-    info = loadmat_sbx(filename + '.mat')['info']
+        plane: int or None
+            optotune plane, all the frames if None
 
-    # Defining number of channels/size factor
-    if info['channels'] == 1:
-        info['nChan'] = 2
-        factor = 1
-    elif info['channels'] == 2:
-        info['nChan'] = 1
-        factor = 2
-    elif info['channels'] == 3:
-        info['nChan'] = 1
-        factor = 2
-
-    # Determine number of frames in whole file
-    max_idx = os.path.getsize(filename + '.sbx') / info['recordsPerBuffer'] / info['sz'][1] * factor / 4 - 1
-    N = max_idx + 1    # Last frame
-    x = (int(info['sz'][1]), int(info['recordsPerBuffer']), int(N))
+    Returns:
+        shape: tuple
+            number of columns, number of rows (lines) and number of frames
+    """
+    info = sbxinfo(filename)
+    N = int(info['max_idx']) + 1    # Last frame
+    if plane is not None:
+        N = len(range(plane, N, info['nPlanes']))
+    x = (int(info['sz'][1]), int(info['recordsPerBuffer']), N)
     return x
 
 
@@ -2134,7 +2390,7 @@ def rolling_window(ndarr, window_size, stride):
            yield ndarr[:,i+stride:]
 
 
-def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
+def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov', queue_size: int = 0, num_threads: int = 1):
     """
     load iterator over movie from file. Supports a variety of formats. tif, hdf5, avi.
 
@@ -2145,6 +2401,15 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
         subindices: iterable indexes
             for loading only a portion of the movie
 
+        var_name_hdf5: str
+            if loading from hdf5 name of the variable to load
+
+        queue_size: int
+            if larger than 0, number of chunks of frames read ahead in the background (see PrefetchIterator)
+
+        num_threads: int
+            number of threads reading ahead
+
     Returns:
         iter: iterator over movie
 
@@ -2157,9 +2422,27 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
 
         Exception 'File not found!'
     """
+    if queue_size > 0:
+        with PrefetchIterator(file_name, subindices=subindices, var_name_hdf5=var_name_hdf5,
+                              queue_size=queue_size, num_threads=num_threads) as frames:
+            for y in frames:
+                yield y
+        return
+    if isinstance(file_name, (MovieChain, SbxMovie)):
+        for t in np.arange(len(file_name))[slice(None) if subindices is None else subindices]:
+            yield file_name[t]
+        return
     if os.path.exists(file_name):
         extension = os.path.splitext(file_name)[1].lower()
         if extension in ('.tif', '.tiff'):
+            index = tiff_index(file_name)
+            if index is not None and index.contiguous:
+                frames = np.arange(index.shape[0])
+                if subindices is not None:
+                    frames = frames[subindices]
+                for t in frames:
+                    yield index.read(t)[0]
+                return
             Y = tifffile.TiffFile(file_name).pages
             if subindices is not None:
                 if type(subindices) is range:
@@ -2204,6 +2487,13 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
 
                 return
                 #raise StopIteration
+        elif extension == '.sbx':
+            Y = SbxMovie(file_name)
+            frames = np.arange(len(Y))
+            if subindices is not None:
+                frames = frames[subindices]
+            for t in frames:
+                yield Y[t]
         elif extension in ('.hdf5', '.h5', '.mat'):
             with h5py.File(file_name, "r") as f:
                 Y = f.get(var_name_hdf5)
@@ -2225,3 +2515,1002 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov'):
         logging.error(f"File request:[{file_name}] not found!")
         raise Exception('File not found!')
 
+
+def _map_chunks(func, pars: List, dview=None) -> List:
+    """ maps func over the chunk parameters pars, in parallel if dview is not None """
+    return cm.cluster.as_executor(dview).map(func, pars)
+
+
+def _temporal_weights(j0: int, j1: int, T: int, T_new: int, area: bool = True) -> Tuple[int, np.ndarray]:
+    """ Weights of the input frames for the output frames j0:j1 of a movie resampled from T to T_new frames
+
+    Downsampling with area interpolation averages the input frames over the interval of each output
+    frame (weighted by the overlap), as cv2.INTER_AREA. Otherwise frames are interpolated linearly,
+    with the coordinates of cv2.INTER_LINEAR.
+
+    Returns:
+        i0: int
+            first input frame
+
+        W: np.ndarray
+            weights (j1 - j0) x (number of input frames from i0)
+    """
+    scale = T / T_new
+    j = np.arange(j0, j1)
+    if area and T_new <= T:
+        lo, hi = j * scale, (j + 1) * scale
+        i0, i1 = int(np.floor(lo[0])), min(int(np.ceil(hi[-1])), T)
+        i = np.arange(i0, i1)
+        W = np.clip(np.minimum(hi[:, None], i + 1) - np.maximum(lo[:, None], i), 0, None) / scale
+    else:
+        x = np.clip((j + 0.5) * scale - 0.5, 0, T - 1)
+        left = np.floor(x).astype(int)
+        right = np.minimum(left + 1, T - 1)
+        i0, i1 = left[0], right[-1] + 1
+        W = np.zeros((len(j), i1 - i0))
+        W[np.arange(len(j)), left - i0] += 1 - (x - left)
+        W[np.arange(len(j)), right - i0] += x - left
+    return i0, W.astype(np.float32)
+
+
+def _create_output_memmap(fname: str, base_name: str, suffix: str, dims: Tuple, T: int, order: str, dtype,
+                          fr: Optional[float] = None) -> str:
+    """ creates the memory mapped file (pixels x time) where a streaming operation writes its output """
+    if base_name is None:
+        base_name = os.path.splitext(fname)[0] + suffix
+    fname_out = memmap_frames_filename(base_name, dims, T, order, dtype)
+    try:
+        # a new file, so that existing maps of an older file with the same name stay valid
+        os.unlink(fname_out)
+    except OSError:
+        pass
+    np.memmap(fname_out, mode='w+', dtype=dtype, shape=prepare_shape((int(np.prod(dims)), T)), order=order)
+    save_memmap_header(fname_out, dims, T, order, dtype, fr=fr)
+    return fname_out
+
+
+def _write_chunk(fname_out: str, shape: Tuple, order: str, dtype, t0: int, frames: np.ndarray) -> None:
+    """ writes the frames (time x d1 x d2) starting at frame t0 in a memory mapped file (pixels x time) """
+    out = np.memmap(fname_out, mode='r+', dtype=dtype, shape=prepare_shape(shape), order=order)
+    out[:, t0:t0 + len(frames)] = _to_memmap_dtype(np.reshape(frames, (len(frames), -1), order='F').T, dtype)
+    out.flush()
+    del out
+
+
+def _resize_chunk(pars: List) -> int:
+    """ resizes the output frames j0:j1 of resize_file and writes them in the output file """
+    fname, var_name_hdf5, fname_out, shape_out, order, dtype, j0, j1, T, T_new, dsize, interpolation = pars
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        if T_new == T:
+            i0, W = j0, None
+            frames = reader[j0:j1]
+        else:
+            i0, W = _temporal_weights(j0, j1, T, T_new, area=interpolation == cv2.INTER_AREA)
+            frames = reader[i0:i0 + W.shape[1]]
+    if dsize is not None:
+        frames = np.stack([cv2.resize(frame, dsize, interpolation=interpolation) for frame in frames])
+    if W is not None:
+        frames = np.tensordot(W, frames, axes=1)
+    _write_chunk(fname_out, shape_out, order, dtype, j0, frames)
+    return j1 - j0
+
+
+def resize_file(fname: str, fx: float = 1, fy: float = 1, fz: float = 1, interpolation=cv2.INTER_AREA,
+                base_name: str = None, dview=None, chunk_size: int = 1000, var_name_hdf5: str = 'mov',
+                order: str = 'C', dtype=np.float32, fr: Optional[float] = None) -> str:
+    """ Out of core version of movie.resize: resizes a movie file chunk by chunk into a new memory mapped file
+
+    The file is read with MovieReader (any format, memory mapped files are not loaded in memory) by
+    chunks of chunk_size output frames, processed in parallel if dview is not None. Chunks read the
+    input frames overlapping with their output frames, so that temporal resampling (e.g. fz=0.2 to
+    downsample from 30 Hz to 6 Hz before CNMF) gives the same result as resizing the whole movie.
+
+    Args:
+        fname: str
+            name of the movie file
+
+        fx, fy, fz: float
+            magnification factors along x, y and time (see movie.resize)
+
+        interpolation: opencv interpolation flag. Temporal resampling supports cv2.INTER_AREA (frames
+            averaged over the interval of each output frame when downsampling) and linear interpolation
+            (any other flag)
+
+        base_name: str
+            base of the name of the output file (default: name of fname + '_resized')
+
+        dview: cluster handle
+            if not None, chunks are processed in parallel
+
+        chunk_size: int
+            number of output frames processed at once by a worker
+
+        var_name_hdf5: str
+            name of the dataset if fname is an hdf5 file
+
+        order: str
+            order of the output memory mapped file ('C' to use it directly in CNMF)
+
+        dtype: data type of the output file (float32, float16 or uint16)
+
+        fr: float
+            frame rate of the input movie. The frame rate of the output (fr * fz) is saved in the header
+
+    Returns:
+        fname_out: str
+            name of the memory mapped file with the resized movie
+    """
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5) as reader:
+        T, h, w = reader.shape
+    if fx != 1 or fy != 1:
+        dsize = (int(w * fy), int(h * fx))
+        dims = (dsize[1], dsize[0])
+    else:
+        dsize, dims = None, (h, w)
+    T_new = max(1, int(fz * T)) if fz != 1 else T
+    fname_out = _create_output_memmap(fname, base_name, '_resized', dims, T_new, order, dtype,
+                                      fr=None if fr is None else fr * fz)
+    shape_out = (int(np.prod(dims)), T_new)
+    pars = [[fname, var_name_hdf5, fname_out, shape_out, order, np.dtype(dtype).name, j0,
+             min(j0 + chunk_size, T_new), T, T_new, dsize, interpolation] for j0 in range(0, T_new, chunk_size)]
+    _map_chunks(_resize_chunk, pars, dview)
+    return fname_out
+
+
+def _baseline_windows(pars: List) -> np.ndarray:
+    """ quantile of each pixel over the frames of each window (windows as in removeBL) """
+    fname, var_name_hdf5, windows, quantilMin = pars
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        frames = reader[windows[0][0]:windows[-1][1]]
+    t0 = windows[0][0]
+    return np.stack([np.percentile(frames[start - t0:end - t0], quantilMin, axis=0) for start, end in windows])
+
+
+def _remove_baseline_chunk(pars: List) -> int:
+    """ subtracts the interpolated baseline from the frames t0:t1 and writes them in the output file """
+    fname, var_name_hdf5, fname_out, order, dtype, t0, t1, T, BL = pars
+    i0, W = _temporal_weights(t0, t1, len(BL), T, area=False)
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        frames = reader[t0:t1]
+    frames = frames - np.tensordot(W, BL[i0:i0 + W.shape[1]], axes=1)
+    _write_chunk(fname_out, (int(np.prod(frames.shape[1:])), T), order, dtype, t0, frames)
+    return t1 - t0
+
+
+def removeBL_file(fname: str, windowSize: int = 100, quantilMin: int = 8, base_name: str = None, dview=None,
+                  chunk_size: int = 1000, var_name_hdf5: str = 'mov', order: str = 'C', dtype=np.float32,
+                  fr: Optional[float] = None) -> Tuple[str, np.ndarray]:
+    """ Out of core version of movie.removeBL: removes the baseline of a movie file into a new memory mapped file
+
+    The baseline (quantile over windows of windowSize frames, linearly interpolated between windows)
+    is computed in a first pass over the file, and subtracted chunk by chunk in a second pass. Both
+    passes run in parallel if dview is not None.
+
+    Args:
+        fname: str
+            name of the movie file
+
+        windowSize: int
+            window size over which to compute the baseline
+
+        quantilMin: float
+            percentile to be used as baseline value
+
+        base_name: str
+            base of the name of the output file (default: name of fname + '_noBL')
+
+        dview: cluster handle
+            if not None, chunks are processed in parallel
+
+        chunk_size: int
+            approximate number of frames processed at once by a worker
+
+        var_name_hdf5: str
+            name of the dataset if fname is an hdf5 file
+
+        order: str
+            order of the output memory mapped file
+
+        dtype: data type of the output file (float32 or float16)
+
+        fr: float
+            frame rate, saved in the header of the output file
+
+    Returns:
+        fname_out: str
+            name of the memory mapped file with the movie without baseline
+
+        BL: np.ndarray
+            baseline of each window (number of windows x d1 x d2)
+    """
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5) as reader:
+        T, h, w = reader.shape
+    # same windows as rolling_window in removeBL: the last window includes the remaining frames
+    n_windows = T // windowSize
+    if n_windows < 2:
+        raise Exception('The movie must have at least two windows of windowSize frames')
+    bounds = [[k * windowSize, (k + 1) * windowSize] for k in range(n_windows)]
+    bounds[-1][1] = T
+    step = max(1, chunk_size // windowSize)
+    pars = [[fname, var_name_hdf5, bounds[k:k + step], quantilMin] for k in range(0, n_windows, step)]
+    BL = np.concatenate(_map_chunks(_baseline_windows, pars, dview)).astype(np.float32)
+
+    fname_out = _create_output_memmap(fname, base_name, '_noBL', (h, w), T, order, dtype, fr=fr)
+    pars = [[fname, var_name_hdf5, fname_out, order, np.dtype(dtype).name, t0, min(t0 + chunk_size, T), T, BL]
+            for t0 in range(0, T, chunk_size)]
+    _map_chunks(_remove_baseline_chunk, pars, dview)
+    return fname_out, BL
+
+
+def _dff_bins(pars: List) -> np.ndarray:
+    """ quantile of each pixel over the frames of each bin of computeDFF_file (reflect padded movie) """
+    fname, var_name_hdf5, b0, b1, downsampfact, padbefore, T, quantilMin = pars
+    t = np.arange(b0 * downsampfact, b1 * downsampfact) - padbefore
+    t = np.abs(t)                                    # reflect padding at the beginning
+    t = np.where(t > T - 1, 2 * (T - 1) - t, t)      # and at the end
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        frames = reader[t]
+    frames = np.reshape(frames, (b1 - b0, downsampfact) + frames.shape[1:])
+    return np.percentile(frames, quantilMin, axis=1)
+
+
+def _dff_chunk(pars: List) -> int:
+    """ computes DF (or DF/F, DF/sqrt(F)) for the frames t0:t1 and writes them in the output file """
+    fname, var_name_hdf5, fname_out, order, dtype, t0, t1, T, T_pad, padbefore, BL, method = pars
+    # linear interpolation of the bins as scipy.ndimage.zoom(order=1) over the padded movie
+    x = (np.arange(t0, t1) + padbefore) * ((len(BL) - 1) / max(T_pad - 1, 1))
+    left = np.minimum(np.floor(x).astype(int), len(BL) - 1)
+    right = np.minimum(left + 1, len(BL) - 1)
+    frac = (x - left).astype(np.float32)[:, None, None]
+    movBL = BL[left] * (1 - frac) + BL[right] * frac
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        frames = reader[t0:t1]
+    if method == 'delta_f_over_sqrt_f':
+        frames = (frames - movBL) / np.sqrt(movBL)
+    elif method == 'delta_f_over_f':
+        frames = (frames - movBL) / movBL
+    else:
+        frames = frames - movBL
+    _write_chunk(fname_out, (int(np.prod(frames.shape[1:])), T), order, dtype, t0, frames)
+    return t1 - t0
+
+
+def computeDFF_file(fname: str, fr: float, secsWindow: int = 5, quantilMin: int = 8,
+                    method: str = 'only_baseline', base_name: str = None, dview=None, chunk_size: int = 1000,
+                    var_name_hdf5: str = 'mov', order: str = 'C', dtype=np.float32) -> Tuple[str, np.ndarray]:
+    """ Out of core version of movie.computeDFF: computes DF/F of a movie file into a new memory mapped file
+
+    As in movie.computeDFF, the movie is padded (reflecting it) to a multiple of secsWindow * fr frames,
+    the quantile of each bin of frames is computed (first pass) and linearly interpolated to obtain
+    the baseline, that is removed chunk by chunk (second pass). Both passes run in parallel if dview
+    is not None.
+
+    Args:
+        fname: str
+            name of the movie file
+
+        fr: float
+            frame rate of the movie
+
+        secsWindow: length of the windows used to compute the quantile
+
+        quantilMin : value of the quantile
+
+        method='only_baseline','delta_f_over_f','delta_f_over_sqrt_f'
+
+        base_name: str
+            base of the name of the output file (default: name of fname + '_dff')
+
+        dview: cluster handle
+            if not None, chunks are processed in parallel
+
+        chunk_size: int
+            approximate number of frames processed at once by a worker
+
+        var_name_hdf5: str
+            name of the dataset if fname is an hdf5 file
+
+        order: str
+            order of the output memory mapped file
+
+        dtype: data type of the output file (float32 or float16)
+
+    Returns:
+        fname_out: str
+            name of the memory mapped file with DF, DF/F or DF/sqrt(F)
+
+        BL: np.ndarray
+            baseline of each bin (number of bins x d1 x d2)
+
+    Raises:
+        Exception 'Unknown method'
+    """
+    if method not in ('only_baseline', 'delta_f_over_f', 'delta_f_over_sqrt_f'):
+        raise Exception('Unknown method')
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5) as reader:
+        T, h, w = reader.shape
+    downsampfact = int(secsWindow * fr)
+    elm_missing = int(np.ceil(T * 1.0 / downsampfact) * downsampfact - T)
+    padbefore = elm_missing // 2
+    T_pad = T + elm_missing
+    n_bins = T_pad // downsampfact
+    step = max(1, chunk_size // downsampfact)
+    pars = [[fname, var_name_hdf5, b0, min(b0 + step, n_bins), downsampfact, padbefore, T, quantilMin]
+            for b0 in range(0, n_bins, step)]
+    BL = np.concatenate(_map_chunks(_dff_bins, pars, dview)).astype(np.float32)
+    if method != 'only_baseline' and np.min(BL) <= 0:
+        raise ValueError("All pixels must be positive")
+
+    fname_out = _create_output_memmap(fname, base_name, '_dff', (h, w), T, order, dtype, fr=fr)
+    pars = [[fname, var_name_hdf5, fname_out, order, np.dtype(dtype).name, t0, min(t0 + chunk_size, T), T, T_pad,
+             padbefore, BL, method] for t0 in range(0, T, chunk_size)]
+    _map_chunks(_dff_chunk, pars, dview)
+    return fname_out, BL
+
+
+def _bin_median_block(pars: List) -> np.ndarray:
+    """ bin_median of the columns x0:x1 of a movie file """
+    fname, var_name_hdf5, window, num_frames, x0, x1 = pars
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+        block = reader[:num_frames, :, x0:x1]
+    return np.nanmedian(np.nanmean(np.reshape(block, (window, num_frames // window) + block.shape[1:]), axis=0),
+                        axis=0)
+
+
+def bin_median_file(fname: str, window: int = 10, dview=None, mem_budget: int = 2**28,
+                    var_name_hdf5: str = 'mov') -> np.ndarray:
+    """ Out of core version of movie.bin_median: median image of a movie file computed by blocks of columns
+
+    Each block of columns is read for all the frames (memory mapped files in C order store the
+    columns contiguously), with at most mem_budget bytes per block, in parallel if dview is not None.
+
+    Args:
+        fname: str
+            name of the movie file
+
+        window: int
+            number of frames in a bin
+
+        dview: cluster handle
+            if not None, blocks are processed in parallel
+
+        mem_budget: int
+            memory (in bytes) used for each block
+
+        var_name_hdf5: str
+            name of the dataset if fname is an hdf5 file
+
+    Returns:
+        img: np.ndarray
+            median image
+    """
+    with MovieReader(fname, var_name_hdf5=var_name_hdf5) as reader:
+        T, d1, d2 = reader.shape
+    num_frames = (T // window) * window
+    step = int(np.clip(mem_budget // (max(num_frames, 1) * d1 * 4), 1, d2))
+    pars = [[fname, var_name_hdf5, window, num_frames, x0, min(x0 + step, d2)] for x0 in range(0, d2, step)]
+    return np.concatenate(_map_chunks(_bin_median_block, pars, dview), axis=1)
+
+
+TIFF_INDEX_VERSION = 1
+
+
+def tiff_index_filename(file_name: str) -> str:
+    """ Name of the page offset index (sidecar file) of a tif file """
+    return str(file_name) + '.index.npz'
+
+
+class TiffIndex(object):
+    """
+    Page offset index of a multi page tif file with one frame per page.
+
+    Locating the pages of a tif file requires walking the chain of its image file directories, which
+    for large (BigTIFF, ScanImage) files takes seconds and is otherwise repeated every time the file
+    is opened, e.g. by every worker in motion correction. The index stores the offsets and byte
+    counts of the pages, the shape and data type of the frames and the ScanImage metadata of the
+    first page, and is saved next to the file (see tiff_index). Frames of uncompressed files are then
+    read directly from their offsets.
+
+    Args:
+        file_name: str
+            name of the tif file
+
+        offsets, bytecounts: np.ndarray
+            offset and size in bytes of the data of each page
+
+        shape: tuple
+            shape (T, d1, d2) of the movie
+
+        dtype: data type
+            data type of the pages, with the byte order of the file
+
+        contiguous: bool
+            whether the data of each page is uncompressed and contiguous, so that frames can be read
+            directly from the offsets
+
+        metadata: dict
+            ScanImage metadata of the first page (parsed with si_parse), empty for other files
+    """
+
+    def __init__(self, file_name: str, offsets: np.ndarray, bytecounts: np.ndarray, shape: Tuple, dtype,
+                 contiguous: bool, metadata: Dict = None) -> None:
+        self.file_name = file_name
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bytecounts = np.asarray(bytecounts, dtype=np.int64)
+        self.shape = tuple(int(s) for s in shape)
+        self.file_dtype = np.dtype(dtype)
+        self.dtype = self.file_dtype.newbyteorder('=')
+        self.contiguous = contiguous
+        self.metadata = {} if metadata is None else metadata
+
+    @classmethod
+    def build(cls, file_name: str):
+        """ Builds the index of a tif file walking its pages. Returns None if the pages are not the frames of a movie """
+        from ..utils.utils import si_parse
+        with tifffile.TiffFile(file_name) as tffl:
+            page = tffl.pages[0]
+            n_pages = len(tffl.pages)
+            series_shape = tuple(tffl.series[0].shape)
+            if n_pages < 2 or page.ndim != 2 or (series_shape != (n_pages,) + page.shape and
+                                                 (series_shape != page.shape or len(tffl.series) != n_pages)):
+                return None
+            dtype = np.dtype(tffl.byteorder + page.dtype.char)
+            frame_bytes = int(np.prod(page.shape)) * dtype.itemsize
+            contiguous = page.compression == 1
+            offsets, bytecounts = np.zeros(n_pages, dtype=np.int64), np.zeros(n_pages, dtype=np.int64)
+            tffl.pages.useframes = True
+            for idx, pg in enumerate(tffl.pages):
+                if pg.shape != page.shape:
+                    return None
+                offs, counts = pg.dataoffsets, pg.databytecounts
+                offsets[idx], bytecounts[idx] = offs[0], sum(counts)
+                if contiguous and (bytecounts[idx] != frame_bytes or
+                                   any(o + c != o_next for o, c, o_next in zip(offs[:-1], counts[:-1], offs[1:]))):
+                    contiguous = False
+            metadata = si_parse(page.description) if page.is_scanimage else {}
+        return cls(file_name, offsets, bytecounts, (n_pages,) + page.shape, dtype, contiguous, metadata)
+
+    def save(self, index_file: str) -> None:
+        """ Saves the index, together with size and modification time of the tif file to detect changes """
+        stat = os.stat(self.file_name)
+        info = {'version': TIFF_INDEX_VERSION, 'shape': self.shape, 'dtype': self.file_dtype.str,
+                'contiguous': self.contiguous, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'metadata': self.metadata}
+        tmp_file = index_file + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(tmp_file, offsets=self.offsets, bytecounts=self.bytecounts,
+                 info=np.array(json.dumps(info, default=str)))
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, file_name: str, index_file: str):
+        """ Loads the index of a tif file. Returns None if it is outdated """
+        with np.load(index_file, allow_pickle=False) as index:
+            info = json.loads(str(index['info']))
+            stat = os.stat(file_name)
+            if info['version'] != TIFF_INDEX_VERSION or info['size'] != stat.st_size or \
+                    info['mtime_ns'] != stat.st_mtime_ns:
+                return None
+            return cls(file_name, index['offsets'], index['bytecounts'], info['shape'], info['dtype'],
+                       info['contiguous'], info['metadata'])
+
+    def memmap(self):
+        """ Memory mapped array of shape (T, d1, d2) if the pages are contiguous, evenly spaced and in the native byte order, otherwise None """
+        if not self.contiguous or len(set(np.diff(self.offsets))) > 1:
+            return None
+        stride = int(self.offsets[1] - self.offsets[0])
+        buf = np.memmap(self.file_name, dtype=np.uint8, mode='r')
+        frame_strides = tuple(np.cumprod((self.file_dtype.itemsize,) + self.shape[:0:-1])[-2::-1])
+        arr = np.ndarray(self.shape, dtype=self.file_dtype, buffer=buf, offset=int(self.offsets[0]),
+                         strides=(stride,) + frame_strides)
+        return arr if self.file_dtype.isnative else None
+
+    def read(self, frames) -> np.ndarray:
+        """ Reads the frames with indices frames (int, slice or array of indices) """
+        if not self.contiguous:
+            raise Exception('The pages of ' + self.file_name + ' cannot be read from their offsets')
+        frames = np.atleast_1d(np.arange(self.shape[0])[frames])
+        out = np.empty((len(frames),) + self.shape[1:], dtype=self.file_dtype)
+        with open(self.file_name, 'rb') as f:
+            for i, t in enumerate(frames):
+                f.seek(self.offsets[t])
+                f.readinto(memoryview(out[i]).cast('B'))
+        return out.astype(self.dtype, copy=False)
+
+
+_tiff_indexes: Dict = {}
+
+
+def tiff_index(file_name: str, save: bool = True):
+    """ Page offset index of a multi page tif file
+
+    The index is read from its sidecar file (see tiff_index_filename) if it exists and is up to date,
+    otherwise it is built walking the pages of the file once and saved (if save and the folder is
+    writable). Indexes are also kept in memory for the lifetime of the process.
+
+    Args:
+        file_name: str
+            name of the tif file
+
+        save: bool
+            whether to save the index next to the file
+
+    Returns:
+        index: TiffIndex or None if the pages of the file are not the frames of a movie
+    """
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+    if key in _tiff_indexes:
+        return _tiff_indexes[key]
+    index_file = tiff_index_filename(file_name)
+    index = None
+    if os.path.exists(index_file):
+        try:
+            index = TiffIndex.load(file_name, index_file)
+        except Exception as e:
+            logging.warning('Could not read the index ' + index_file + ': ' + str(e))
+    if index is None:
+        index = TiffIndex.build(file_name)
+        if save and index is not None:
+            try:
+                index.save(index_file)
+            except OSError as e:
+                logging.warning('Could not save the index ' + index_file + ': ' + str(e))
+    _tiff_indexes[key] = index
+    return index
+
+
+class MovieReader(object):
+    """
+    Lazy random access reader over a movie file.
+
+    The reader supports numpy-style indexing over time and space (reader[t0:t1, y0:y1, x0:x1])
+    and only reads the frames that are requested. Memory mapped files (mmap, npy and uncompressed
+    contiguous tif) are indexed directly, so that only the requested pixels are touched. The other
+    formats (paged tif, hdf5, sbx, avi) are read in chunks of consecutive frames that are kept in a
+    bounded LRU cache. Avi files are read sequentially and seek (to the closest keyframe) only when
+    frames are requested out of order.
+
+    Example of usage:
+        with MovieReader('movie.tif', chunk_size=200) as reader:
+            T, d1, d2 = reader.shape
+            mean_img = np.mean(reader[::10, :d1 // 2], 0)
+    """
+
+    def __init__(self, file_name: str, var_name_hdf5: str = 'mov', chunk_size: int = 100, cache_size: int = 4,
+                 outtype=np.float32) -> None:
+        """
+        Args:
+            file_name: str
+                name of the file. Possible extensions are tif, avi, hdf5/h5/nwb, sbx, mmap, npy. Other
+                formats are loaded in memory with load
+
+            var_name_hdf5: str
+                if loading from hdf5 name of the variable to load
+
+            chunk_size: int
+                number of consecutive frames read at once for chunked formats
+
+            cache_size: int
+                maximum number of chunks kept in memory. If 0, no chunk is cached and only the
+                requested frames are read
+
+            outtype: The data type of the returned frames. If None the data type of the file is kept.
+                The offset of integer memory mapped files (see memmap_offset) is added to floating
+                point frames
+
+        Raises:
+            Exception 'File not found!'
+        """
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self.outtype = outtype
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._backend = _open_reader_backend(file_name, var_name_hdf5)
+        self.shape = tuple(self._backend.shape)
+
+    @property
+    def dims(self) -> Tuple:
+        return self.shape[1:]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._backend.dtype if self.outtype is None else np.dtype(self.outtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            for frame in self[start:start + self.chunk_size]:
+                yield frame
+
+    def close(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._backend.close()
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            ind = [k is Ellipsis for k in key].index(True)
+            key = key[:ind] + (slice(None),) * (self.ndim - len(key) + 1) + key[ind + 1:]
+        time_key, space_key = key[0], key[1:]
+        if isinstance(time_key, (int, np.integer)):
+            return self[(np.arange(len(self))[time_key:][:1],) + space_key][0]
+        if getattr(self._backend, 'array', None) is not None:
+            frames = np.asarray(self._backend.array[key])
+        else:
+            frames = self._read_frames(np.arange(len(self))[time_key], space_key)
+        if self.outtype is None:
+            return frames
+        frames = frames.astype(self.outtype, copy=False)
+        offset = getattr(self._backend, 'offset', 0)
+        if offset != 0 and frames.dtype.kind == 'f':
+            # offset of integer memory mapped files, added once the frames are converted
+            frames = frames + frames.dtype.type(offset)
+        return frames
+
+    def _read_frames(self, idx: np.ndarray, space_key: Tuple) -> np.ndarray:
+        """ read the frames idx (and the pixels space_key) going through the chunk cache """
+        space_key = (slice(None),) + space_key
+        if len(idx) == 0:
+            return np.empty((0,) + self.dims, dtype=self._backend.dtype)[space_key]
+        if self.cache_size == 0:
+            # read the runs of consecutive frames directly
+            breaks = np.where(np.diff(idx) != 1)[0] + 1
+            starts, stops = np.r_[0, breaks], np.r_[breaks, len(idx)]
+            runs = [(idx[start], idx[stop - 1] + 1) for start, stop in zip(starts, stops)]
+            with self._lock:
+                return np.concatenate([self._backend.read(start, stop)[space_key] for start, stop in runs])
+        chunks = idx // self.chunk_size
+        out = None
+        for chunk in np.unique(chunks):
+            sel = np.where(chunks == chunk)[0]
+            data = self._get_chunk(chunk)[idx[sel] - chunk * self.chunk_size][space_key]
+            if out is None:
+                out = np.empty((len(idx),) + data.shape[1:], dtype=data.dtype)
+            out[sel] = data
+        return out
+
+    def _get_chunk(self, chunk: int) -> np.ndarray:
+        with self._lock:
+            if chunk in self._cache:
+                self._cache.move_to_end(chunk)
+                return self._cache[chunk]
+            start = chunk * self.chunk_size
+            data = self._backend.read(start, min(start + self.chunk_size, len(self)))
+            self._cache[chunk] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return data
+
+
+class _ArrayReader(object):
+    """ reader backend for arrays that can be indexed directly (memory mapped or in memory) """
+
+    def __init__(self, array, offset: float = 0) -> None:
+        if array.ndim == 2:
+            array = array[np.newaxis]
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.offset = offset
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return np.asarray(self.array[start:stop])
+
+    def close(self) -> None:
+        if hasattr(self.array, 'close'):
+            self.array.close()
+        self.array = None
+
+
+class _TiffReader(object):
+    """ reader backend for multi page tif files, one frame per page """
+
+    def __init__(self, file_name: str, index: TiffIndex = None) -> None:
+        self.tffl = tifffile.TiffFile(file_name)
+        if index is not None:
+            self.shape, self.dtype = index.shape, index.dtype
+        else:
+            page = self.tffl.pages[0]
+            self.shape = (len(self.tffl.pages),) + tuple(page.shape)
+            self.dtype = page.dtype
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self.tffl.asarray(key=range(start, stop)).reshape((stop - start,) + self.shape[1:])
+
+    def close(self) -> None:
+        self.tffl.close()
+
+
+class _TiffIndexReader(object):
+    """ reader backend for uncompressed multi page tif files, reading the pages from their offsets """
+
+    def __init__(self, index: TiffIndex) -> None:
+        self.index = index
+        self.shape = index.shape
+        self.dtype = index.dtype
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self.index.read(slice(start, stop))
+
+    def close(self) -> None:
+        pass
+
+
+class _HDF5Reader(object):
+    """ reader backend for hdf5 (and nwb) datasets """
+
+    def __init__(self, file_name: str, var_name_hdf5: str = 'mov') -> None:
+        self.f = h5py.File(file_name, "r")
+        fkeys = list(self.f.keys())
+        if len(fkeys) == 1:
+            var_name_hdf5 = fkeys[0]
+        if var_name_hdf5 not in self.f:
+            logging.debug('KEYS:' + str(fkeys))
+            self.f.close()
+            raise Exception('Key not found in hdf5 file')
+        if file_name.lower().endswith('.nwb'):
+            self.dataset = self.f[var_name_hdf5]['data']
+        else:
+            self.dataset = self.f[var_name_hdf5]
+        self.shape = self.dataset.shape
+        self.dtype = self.dataset.dtype
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self.dataset[start:stop]
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class _AviReader(object):
+    """ reader backend for avi files (first color channel) """
+
+    def __init__(self, file_name: str) -> None:
+        self.cap = cv2.VideoCapture(file_name)
+        T = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.shape = (T, height, width)
+        self.dtype = np.dtype(np.uint8)
+        self.position = 0
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        if start != self.position:
+            # opencv seeks to the closest keyframe and decodes up to the requested frame
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        frames = np.zeros((stop - start,) + self.shape[1:], dtype=self.dtype)
+        for ind in range(stop - start):
+            ret, frame = self.cap.read()
+            if not ret:
+                self.position = -1
+                raise Exception('Could not read frame {} of the avi file'.format(start + ind))
+            frames[ind] = frame[:, :, 0]
+        self.position = stop
+        return frames
+
+    def close(self) -> None:
+        self.cap.release()
+
+
+def _open_reader_backend(file_name: str, var_name_hdf5: str = 'mov'):
+    """ opens the reader backend of MovieReader appropriate for the file format """
+    if isinstance(file_name, MovieChain):
+        # the chain reads its files with their own readers
+        return file_name
+    if isinstance(file_name, SbxMovie):
+        return _ArrayReader(file_name)
+    if not os.path.exists(file_name):
+        logging.error(f"File request:[{file_name}] not found!")
+        raise Exception('File not found!')
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.mat':
+        byte_stream, file_opened = scipy.io.matlab.mio._open_file(file_name, appendmat=False)
+        mjv, mnv = scipy.io.matlab.mio.get_matfile_version(byte_stream)
+        if mjv == 2:
+            extension = '.h5'
+    if extension in ('.tif', '.tiff'):
+        index = tiff_index(file_name)
+        if index is not None:
+            # uncompressed evenly spaced pages can be memory mapped, other uncompressed pages are read
+            # from their offsets
+            array = index.memmap()
+            if array is not None:
+                return _ArrayReader(array)
+            if index.contiguous:
+                return _TiffIndexReader(index)
+            return _TiffReader(file_name, index)
+        try:
+            # uncompressed contiguous data can be memory mapped
+            return _ArrayReader(tifffile.memmap(file_name, mode='r'))
+        except ValueError:
+            pass
+        with tifffile.TiffFile(file_name) as tffl:
+            series_shape = tffl.series[0].shape
+            paged = len(tffl.pages) > 1 and (len(series_shape) == 2 or series_shape[0] == len(tffl.pages))
+        if paged:
+            return _TiffReader(file_name)
+    elif extension in ('.hdf5', '.h5', '.nwb'):
+        if is_chunked_store(file_name):
+            return _ArrayReader(ChunkedStore(file_name))
+        return _HDF5Reader(file_name, var_name_hdf5)
+    elif extension == '.mmap':
+        Yr, dims, T = load_memmap(file_name)
+        return _ArrayReader(np.reshape(Yr.T, [T] + list(dims), order='F'), offset=memmap_offset(file_name))
+    elif extension == '.npy':
+        return _ArrayReader(np.load(file_name, mmap_mode='r'))
+    elif extension == '.sbx':
+        return _ArrayReader(SbxMovie(file_name))
+    elif extension == '.avi':
+        reader = _AviReader(file_name)
+        if min(reader.shape) > 0:
+            return reader
+        reader.close()
+    # fall back to loading the whole file in memory
+    return _ArrayReader(np.asarray(load(file_name, var_name_hdf5=var_name_hdf5, in_memory=True)))
+
+
+class PrefetchIterator(object):
+    """
+    Iterator over the frames of one or more movie files that reads ahead in background threads.
+
+    Frames are read in chunks of chunk_size consecutive frames. Up to queue_size chunks are read
+    (and decoded) by a pool of num_threads threads while the frames of the previous chunks are
+    consumed, so that disk and decoding latency overlap with the processing of the frames. Several
+    files are read back to back: the first chunks of a file are read while the last frames of the
+    previous file are still processed. The file and frame index of the last returned frame are
+    available as file_index and frame_index.
+
+    Example of usage:
+        with PrefetchIterator(['mov_1.tif', 'mov_2.tif'], subindices=[slice(200, None), None]) as frames:
+            for frame in frames:
+                process(frame)
+    """
+
+    def __init__(self, file_names, subindices=None, var_name_hdf5: str = 'mov', queue_size: int = 4,
+                 num_threads: int = 2, chunk_size: int = 32, outtype=None) -> None:
+        """
+        Args:
+            file_names: str or list of str
+                name(s) of the file(s), in any format supported by MovieReader
+
+            subindices: iterable indexes or list
+                for reading only a portion of the movie. If a list, one entry (possibly None) per file
+
+            var_name_hdf5: str
+                if loading from hdf5 name of the variable to load
+
+            queue_size: int
+                number of chunks read ahead
+
+            num_threads: int
+                number of threads reading the chunks. Each thread uses its own file handles
+
+            chunk_size: int
+                number of frames in each chunk
+
+            outtype: The data type of the frames. If None the data type of the file is kept
+        """
+        if isinstance(file_names, str):
+            file_names = [file_names]
+        if not isinstance(subindices, list):
+            subindices = [subindices] * len(file_names)
+        self.file_names = file_names
+        self.subindices = subindices
+        self.var_name_hdf5 = var_name_hdf5
+        self.queue_size = max(queue_size, 1)
+        self.chunk_size = chunk_size
+        self.outtype = outtype
+        self.file_index = -1
+        self.frame_index = -1
+        self._idx: np.ndarray = np.zeros(0, dtype=int)
+        self._frames: np.ndarray = np.zeros(0)
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._readers: List = []
+        self._shared_readers: Dict = {}
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._chunks = self._iter_chunks()
+        self._pending: deque = deque()
+        for _ in range(self.queue_size):
+            self._submit()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> np.ndarray:
+        while self._pos == len(self._idx):
+            if not self._pending:
+                raise StopIteration
+            self.file_index, self._idx, future = self._pending.popleft()
+            self._submit()
+            self._frames, self._pos = future.result(), 0
+        self.frame_index = self._idx[self._pos]
+        self._pos += 1
+        return self._frames[self._pos - 1]
+
+    def iter_file(self, file_index: int):
+        """ iterator over the remaining frames of the file file_index """
+        while True:
+            if self._pos == len(self._idx):
+                if not self._pending or self._pending[0][0] != file_index:
+                    return
+            elif self.file_index != file_index:
+                return
+            yield next(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for reader in self._readers + list(self._shared_readers.values()):
+                reader.close()
+            self._readers = []
+            self._shared_readers = {}
+
+    def _open(self, file_index: int) -> MovieReader:
+        return MovieReader(self.file_names[file_index], var_name_hdf5=self.var_name_hdf5, cache_size=0,
+                           outtype=self.outtype)
+
+    def _iter_chunks(self):
+        """ generates the (file index, frame indices) of the chunks to read, file after file """
+        for file_index, subindices in enumerate(self.subindices):
+            reader = self._open(file_index)
+            idx = np.arange(len(reader))
+            if subindices is not None:
+                idx = idx[subindices]
+            if getattr(reader._backend, 'array', None) is not None:
+                # memory mapped or in memory files can be shared between the threads
+                with self._lock:
+                    self._shared_readers[file_index] = reader
+            else:
+                reader.close()
+            for start in range(0, len(idx), self.chunk_size):
+                yield file_index, idx[start:start + self.chunk_size]
+
+    def _submit(self) -> None:
+        chunk = next(self._chunks, None)
+        if chunk is not None:
+            self._pending.append(chunk + (self._executor.submit(self._read, *chunk),))
+
+    def _read(self, file_index: int, idx: np.ndarray) -> np.ndarray:
+        with self._lock:
+            reader = self._shared_readers.get(file_index)
+        if reader is None:
+            readers = getattr(self._local, 'readers', None)
+            if readers is None:
+                readers = self._local.readers = {}
+            if file_index not in readers:
+                # chunks are read in order, the files previously read by this thread are done
+                for old_reader in readers.values():
+                    old_reader.close()
+                readers.clear()
+                readers[file_index] = self._open(file_index)
+                with self._lock:
+                    self._readers.append(readers[file_index])
+            reader = readers[file_index]
+        return reader[idx]
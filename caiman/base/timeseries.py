@@ -7,8 +7,11 @@ author: Andrea Giovannucci
 """
 
 #%%
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import h5py
+import itertools
 import logging
 import numpy as np
 import os
@@ -19,9 +22,10 @@ import tifffile
 import warnings
 from datetime import datetime
 from dateutil.tz import tzlocal
-from pynwb import NWBHDF5IO, NWBFile
+from pynwb import H5DataIO, NWBHDF5IO, NWBFile
 from pynwb.ophys import TwoPhotonSeries, OpticalChannel
 from pynwb.device import Device
+from caiman.mmapping import save_memmap_header
 from caiman.paths import memmap_frames_filename
 
 try:
@@ -139,7 +143,12 @@ class timeseries(np.ndarray):
              lab_name=None,
              institution=None,
              experiment_description='Experiment Description',
-             session_id='Session ID'):
+             session_id='Session ID',
+             batch_size=None,
+             n_threads=None,
+             chunks=None,
+             compression=None,
+             compression_opts=None):
         """
         Save the timeseries in single precision. Supported formats include
         TIFF, NPZ, AVI, MAT, HDF5/H5, MMAP, and NWB
@@ -157,6 +166,24 @@ class timeseries(np.ndarray):
             var_name_hdf5: str
                 Name of hdf5 file subdirectory
 
+            compress: int
+                zlib compression level of tif files
+
+            batch_size: int
+                number of frames written at once to tif, avi and hdf5 files (see save_movie_file)
+
+            n_threads: int
+                number of threads preparing the batches
+
+            chunks: tuple or True
+                chunk shape of hdf5 and nwb datasets
+
+            compression: str
+                compression filter of hdf5 ('gzip', 'lzf', 'blosc') and nwb ('gzip', 'lzf') datasets
+
+            compression_opts: int
+                level of the gzip filter
+
         Raises:
             Exception 'Extension Unknown'
 
@@ -165,16 +192,12 @@ class timeseries(np.ndarray):
         extension = extension.lower()
         logging.debug("Parsing extension " + str(extension))
 
-        if extension == '.tif':
-            with tifffile.TiffWriter(file_name, bigtiff=bigtiff, imagej=imagej) as tif:
-                for i in range(self.shape[0]):
-                    if i % 200 == 0:
-                        logging.debug(str(i) + ' frames saved')
-
-                    curfr = self[i].copy()
-                    if to32 and not ('float32' in str(self.dtype)):
-                        curfr = curfr.astype(np.float32)
-                    tif.save(curfr, compress=compress)
+        if extension in ('.tif', '.avi', '.hdf5', '.h5'):
+            return save_movie_file(self, file_name, fr=self.fr, to32=to32, batch_size=batch_size,
+                                   n_threads=n_threads, compress=compress, bigtiff=bigtiff, imagej=imagej,
+                                   var_name_hdf5=var_name_hdf5, chunks=chunks, compression=compression,
+                                   compression_opts=compression_opts, start_time=self.start_time,
+                                   file_names=self.file_name, meta_data=self.meta_data)
         elif extension == '.npz':
             if to32 and not ('float32' in str(self.dtype)):
                 input_arr = self.astype(np.float32)
@@ -187,22 +210,6 @@ class timeseries(np.ndarray):
                      fr=self.fr,
                      meta_data=self.meta_data,
                      file_name=self.file_name)
-        elif extension == '.avi':
-            codec = None
-            try:
-                codec = cv2.FOURCC('I', 'Y', 'U', 'V')
-            except AttributeError:
-                codec = cv2.VideoWriter_fourcc(*'IYUV')
-            np.clip(self, np.percentile(self, 1), np.percentile(self, 99), self)
-            minn, maxx = np.min(self), np.max(self)
-            data = 255 * (self - minn) / (maxx - minn)
-            data = data.astype(np.uint8)
-            y, x = data[0].shape
-            vw = cv2.VideoWriter(file_name, codec, self.fr, (x, y), isColor=True)
-            for d in data:
-                vw.write(cv2.cvtColor(d, cv2.COLOR_GRAY2BGR))
-            vw.release()
-
         elif extension == '.mat':
             if self.file_name[0] is not None:
                 f_name = self.file_name
@@ -233,23 +240,6 @@ class timeseries(np.ndarray):
                         'file_name': f_name
                     })
 
-        elif extension in ('.hdf5', '.h5'):
-            with h5py.File(file_name, "w") as f:
-                if to32 and not ('float32' in str(self.dtype)):
-                    input_arr = self.astype(np.float32)
-                else:
-                    input_arr = np.array(self)
-
-                dset = f.create_dataset(var_name_hdf5, data=input_arr)
-                dset.attrs["fr"] = self.fr
-                dset.attrs["start_time"] = self.start_time
-                try:
-                    dset.attrs["file_name"] = [a.encode('utf8') for a in self.file_name]
-                except:
-                    logging.warning('No file saved')
-                if self.meta_data[0] is not None:
-                    logging.debug("Metadata for saved file: " + str(self.meta_data))
-                    dset.attrs["meta_data"] = cpk.dumps(self.meta_data)
         elif extension == '.mmap':
             base_name = name
 
@@ -274,6 +264,7 @@ class timeseries(np.ndarray):
             big_mov[:] = np.asarray(input_arr, dtype=np.float32)
             big_mov.flush()
             del big_mov, input_arr
+            save_memmap_header(fname_tot, dims, T, order, fr=self.fr)
             return fname_tot
         elif extension == '.nwb':
             if to32 and not ('float32' in str(self.dtype)):
@@ -303,6 +294,9 @@ class timeseries(np.ndarray):
                                                          indicator=indicator,
                                                          location=location)
             # Images
+            if chunks is not None or compression is not None:
+                input_arr = H5DataIO(input_arr, chunks=chunks, compression=compression,
+                                     compression_opts=compression_opts, shuffle=compression is not None)
             image_series = TwoPhotonSeries(name=var_name_hdf5,
                                            dimension=self.shape[1:],
                                            data=input_arr,
@@ -351,3 +345,281 @@ def concatenate(*args, **kwargs):
     except:
         logging.debug('no meta information passed')
         return obj.__class__(np.concatenate(*args, **kwargs))
+
+
+def _default_batch_size(frame_shape, dtype, batch_bytes=2**26):
+    """ number of frames in a batch of about batch_bytes """
+    frame_bytes = max(1, int(np.prod(frame_shape)) * np.dtype(dtype).itemsize)
+    return int(max(1, batch_bytes // frame_bytes))
+
+
+def _frame_batches(source, batch_size):
+    """ Split a movie into batches of consecutive frames
+
+    Args:
+        source: array like (ndarray, memmap, MovieReader...) or iterable
+            either indexable along its first axis, or yielding single frames or batches of frames
+
+        batch_size: int
+            number of frames per batch (for iterables this is a lower bound, batches are not split)
+
+    Returns:
+        generator over the batches, as arrays or lazy slices of source. For
+        array like sources, a batch is a (start, stop) pair to be read by the consumer
+    """
+    if hasattr(source, 'shape') and hasattr(source, '__getitem__'):
+        T = source.shape[0]
+        for start in range(0, T, batch_size):
+            yield (start, min(start + batch_size, T))
+    else:
+        buffered, n_buffered = [], 0
+        for frames in source:
+            frames = np.asarray(frames)
+            if frames.ndim == 2:
+                frames = frames[np.newaxis]
+            buffered.append(frames)
+            n_buffered += len(frames)
+            if n_buffered >= batch_size:
+                yield np.concatenate(buffered) if len(buffered) > 1 else buffered[0]
+                buffered, n_buffered = [], 0
+        if buffered:
+            yield np.concatenate(buffered) if len(buffered) > 1 else buffered[0]
+
+
+def _prefetch(func, items, n_threads):
+    """ map func over items in a thread pool, in order, keeping at most n_threads + 1 items in flight
+
+    The consumer of the results runs concurrently with the workers, so reading
+    and converting the next batches overlaps with compressing and writing the current one
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) > n_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def sample_quantiles(source, q=(1, 99), n_samples=1000):
+    """ Estimate quantiles of a movie from a subsample of its frames
+
+    Args:
+        source: array like
+            the movie, indexable along its first axis
+
+        q: sequence of floats
+            quantiles in percent
+
+        n_samples: int
+            maximum number of frames used for the estimate
+
+    Returns:
+        values: list of floats, one per quantile
+    """
+    T = source.shape[0]
+    idx = np.unique(np.linspace(0, T - 1, min(T, n_samples)).astype(int))
+    sample = np.stack([np.asarray(source[i]) for i in idx])
+    return [float(v) for v in np.nanpercentile(sample, q)]
+
+
+def save_movie_file(source,
+                    file_name,
+                    fr=30.,
+                    to32=True,
+                    batch_size=None,
+                    n_threads=None,
+                    compress=0,
+                    bigtiff=True,
+                    imagej=False,
+                    var_name_hdf5='mov',
+                    chunks=None,
+                    compression=None,
+                    compression_opts=None,
+                    quantiles=(1, 99),
+                    n_samples=1000,
+                    start_time=0,
+                    file_names=None,
+                    meta_data=None):
+    """
+    Write a movie to a TIFF, HDF5 or AVI file in batches of frames, without
+    loading it in memory
+
+    Batches are read from the source and converted in a thread pool while the
+    previous ones are compressed and written.
+
+    Args:
+        source: array like or iterable
+            the movie (T x d1 x d2), e.g. a movie, a memory mapped array, a
+            MovieReader or a generator yielding frames or batches of frames
+
+        file_name: str
+            name of the output file, with extension tif, tiff, hdf5, h5 or avi
+
+        fr: float
+            frame rate
+
+        to32: bool
+            whether to convert the frames to float32 (TIFF and HDF5)
+
+        batch_size: int
+            number of frames written at once. By default batches of about 64 MB
+
+        n_threads: int
+            number of threads reading and converting batches. By default the number of cpus
+
+        compress: int
+            zlib compression level for TIFF files (0 for uncompressed, which are
+            written as a single contiguous series)
+
+        bigtiff: bool
+            whether to write a BigTIFF file
+
+        imagej: bool
+            whether to write an ImageJ hyperstack (always uncompressed)
+
+        var_name_hdf5: str
+            name of the HDF5 dataset
+
+        chunks: tuple or True
+            chunk shape of the HDF5 dataset. True lets h5py guess it, None uses
+            whole frames with chunks of about 1 MB
+
+        compression: str
+            HDF5 compression filter ('gzip', 'lzf' or 'blosc'), None for uncompressed
+
+        compression_opts: int
+            compression level of the gzip filter
+
+        quantiles: tuple of floats
+            lower and upper percentiles mapped to 0 and 255 in AVI files
+
+        n_samples: int
+            number of frames used to estimate the AVI percentiles. They are
+            evenly spaced for array likes and taken from the start of iterables
+
+        start_time, file_names, meta_data:
+            stored as attributes of HDF5 datasets
+
+    Returns:
+        file_name: str
+
+    Raises:
+        Exception 'Extension Unknown'
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in ('.tif', '.tiff', '.hdf5', '.h5', '.avi'):
+        logging.error("Extension " + str(extension) + " unknown")
+        raise Exception('Extension Unknown')
+    if imagej and compress:
+        logging.warning('ImageJ hyperstacks are saved uncompressed')
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    is_array = hasattr(source, 'shape') and hasattr(source, '__getitem__')
+    if batch_size is None:
+        if is_array:
+            batch_size = _default_batch_size(source.shape[1:], np.float32 if to32 else source.dtype)
+        else:
+            batch_size = 100
+
+    if extension == '.avi':
+        if is_array:
+            lo, hi = sample_quantiles(source, quantiles, n_samples)
+        else:
+            # estimate the percentiles on the first frames, then write them with the rest
+            head, n_head = [], 0
+            source = iter(source)
+            for frames in source:
+                head.append(frames)
+                n_head += 1 if np.ndim(frames) == 2 else len(frames)
+                if n_head >= n_samples:
+                    break
+            if not head:
+                raise Exception('The movie to save is empty')
+            lo, hi = sample_quantiles(np.concatenate([np.reshape(frames, (-1,) + np.shape(frames)[-2:]) for frames in head]),
+                                      quantiles, n_samples)
+            source = itertools.chain(head, source)
+        scale = 255. / (hi - lo) if hi > lo else 0.
+
+        def convert(batch):
+            batch = np.asarray(source[batch[0]:batch[1]] if is_array else batch, dtype=np.float32)
+            return ((np.clip(batch, lo, hi) - lo) * scale).astype(np.uint8)
+    else:
+        def convert(batch):
+            batch = np.asarray(source[batch[0]:batch[1]] if is_array else batch)
+            if to32 and batch.dtype != np.float32:
+                batch = batch.astype(np.float32)
+            return np.ascontiguousarray(batch)
+
+    batches = _prefetch(convert, _frame_batches(source, batch_size), n_threads)
+    if extension in ('.tif', '.tiff'):
+        with tifffile.TiffWriter(file_name, bigtiff=bigtiff, imagej=imagej) as tif:
+            n_saved = 0
+            for batch in batches:
+                # without shape metadata all the pages are read back as one series
+                if imagej:
+                    # appending to an ImageJ series requires frames of the same shape
+                    for frame in batch:
+                        tif.save(frame, contiguous=True)
+                elif compress:
+                    tif.save(batch, compress=compress, metadata=None)
+                else:
+                    tif.save(batch, contiguous=True, metadata=None)
+                n_saved += len(batch)
+                logging.debug(str(n_saved) + ' frames saved')
+
+    elif extension in ('.hdf5', '.h5'):
+        from ..mmapping import _chunked_compression
+        with h5py.File(file_name, "w") as f:
+            dset = None
+            for batch in batches:
+                if dset is None:
+                    dims = batch.shape[1:]
+                    T = source.shape[0] if is_array else len(batch)
+                    if chunks is None:
+                        frames_per_chunk = _default_batch_size(dims, batch.dtype, 2**20)
+                        if is_array:
+                            frames_per_chunk = min(T, frames_per_chunk)
+                        chunks_ = (frames_per_chunk,) + tuple(dims)
+                    else:
+                        chunks_ = chunks
+                    kwargs = _chunked_compression(compression)
+                    if compression_opts is not None:
+                        kwargs['compression_opts'] = compression_opts
+                    dset = f.create_dataset(var_name_hdf5, shape=(T,) + tuple(dims), dtype=batch.dtype,
+                                            maxshape=(None,) + tuple(dims), chunks=chunks_, **kwargs)
+                    n_saved = 0
+                if n_saved + len(batch) > dset.shape[0]:
+                    dset.resize(n_saved + len(batch), axis=0)
+                dset[n_saved:n_saved + len(batch)] = batch
+                n_saved += len(batch)
+            if dset is None:
+                raise Exception('The movie to save is empty')
+            dset.attrs["fr"] = fr
+            dset.attrs["start_time"] = start_time
+            if file_names is not None:
+                try:
+                    dset.attrs["file_name"] = [a.encode('utf8') for a in file_names]
+                except:
+                    logging.warning('No file saved')
+            if meta_data is not None and meta_data[0] is not None:
+                logging.debug("Metadata for saved file: " + str(meta_data))
+                dset.attrs["meta_data"] = cpk.dumps(meta_data)
+
+    else:
+        try:
+            codec = cv2.FOURCC('I', 'Y', 'U', 'V')
+        except AttributeError:
+            codec = cv2.VideoWriter_fourcc(*'IYUV')
+        vw = None
+        for batch in batches:
+            if vw is None:
+                y, x = batch.shape[1:]
+                vw = cv2.VideoWriter(file_name, codec, fr, (x, y), isColor=True)
+            for d in batch:
+                vw.write(cv2.cvtColor(d, cv2.COLOR_GRAY2BGR))
+        if vw is not None:
+            vw.release()
+
+    return file_name
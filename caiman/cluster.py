@@ -18,24 +18,50 @@ from builtins import str
 from builtins import map
 from builtins import range
 
+import atexit
+from collections import OrderedDict
+import concurrent.futures
+import contextlib
+import cv2
+import functools
 import glob
+import hashlib
 import ipyparallel
+import itertools
 from ipyparallel import Client
 import logging
 import multiprocessing
 from multiprocessing import Pool
 import numpy as np
 import os
+import pickle
 import platform
 import psutil
+import queue
+import scipy.sparse
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
+import traceback
 from typing import Any, Dict, List, Optional, Tuple, Union
+import uuid
 
-from .mmapping import load_memmap
+try:
+    from multiprocessing import resource_tracker, shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+try:
+    import threadpoolctl
+    HAS_THREADPOOLCTL = True
+except ImportError:
+    HAS_THREADPOOLCTL = False
+
+from .mmapping import load_memmap, load_memmap_header
 
 logger = logging.getLogger(__name__)
 
@@ -295,7 +321,7 @@ def stop_server(ipcluster: str = 'ipcluster', pdir: str = None, profile: str = N
         dview: Undocumented
 
     """
-    if 'multiprocessing' in str(type(dview)):
+    if 'multiprocessing' in str(type(dview)) or isinstance(dview, ClusterExecutor):
         dview.terminate()
     else:
         logger.info("Stopping cluster...")
@@ -365,29 +391,50 @@ def setup_cluster(backend: str = 'multiprocessing',
                   n_processes: int = None,
                   single_thread: bool = False,
                   ignore_preexisting: bool = False,
-                  maxtasksperchild: int = None) -> Tuple[Any, Any, Optional[int]]:
+                  maxtasksperchild: int = None,
+                  memory_budget: Union[int, str] = None,
+                  threads_per_process: int = None) -> Tuple[Any, Any, Optional[int]]:
     """Setup and/or restart a parallel cluster.
     Args:
         backend: str
-            'multiprocessing' [alias 'local'], 'ipyparallel', and 'SLURM'
+            'multiprocessing' [alias 'local'], 'ipyparallel', 'SLURM', 'processes' and 'threads'
             ipyparallel and SLURM backends try to restart if cluster running.
             backend='multiprocessing' raises an exception if a cluster is running.
+            'processes' and 'threads' return a ClusterExecutor over a concurrent.futures
+            executor
         ignore_preexisting: bool
             If True, ignores the existence of an already running multiprocessing
             pool, which is usually indicative of a previously-started CaImAn cluster
 
+        memory_budget: int or str
+            memory available to the workers ('16GB' and the like are accepted), see
+            set_memory_budget. By default 80% of the available memory. The default number of
+            processes is reduced when their idle footprint does not fit in it
+
+        threads_per_process: int
+            threads of the BLAS, OpenMP, numexpr and OpenCV libraries in each worker, the cpus
+            being shared as n_processes x threads_per_process. By default the number of cpus
+            divided by n_processes. Not applied by the 'threads' backend, whose workers share the
+            threads of the process
+
     Returns:
         c: ipyparallel.Client object; only used for ipyparallel and SLURM backends, else None
-        dview: ipyparallel dview object, or for multiprocessing: Pool object
+        dview: ipyparallel dview object, or for multiprocessing: Pool object, or ClusterExecutor
         n_processes: number of workers in dview. None means guess at number of machine cores.
     """
 
+    if memory_budget is not None:
+        set_memory_budget(memory_budget)
+
     if n_processes is None:
         if backend == 'SLURM':
             n_processes = np.int(os.environ.get('SLURM_NPROCS'))
         else:
-            # roughly number of cores on your machine minus 1
+            # roughly number of cores on your machine minus 1, as long as the workers fit in memory
             n_processes = np.maximum(np.int(psutil.cpu_count() - 1), 1)
+            n_processes = get_memory_budget().max_workers(n_processes)
+    if threads_per_process is None:
+        threads_per_process = max((psutil.cpu_count() or 1) // int(n_processes), 1)
 
     if single_thread:
         dview = None
@@ -407,12 +454,14 @@ def setup_cluster(backend: str = 'multiprocessing',
             logger.info([pdir, profile])
             c = Client(ipython_dir=pdir, profile=profile)
             dview = c[:]
+            dview.apply_sync(_init_worker, threads_per_process)
         elif backend == 'ipyparallel':
             stop_server()
             start_server(ncpus=n_processes)
             c = Client()
             logger.info(f'Started ipyparallel cluster: Using {len(c)} processes')
             dview = c[:len(c)]
+            dview.apply_sync(_init_worker, threads_per_process)
 
         elif (backend == 'multiprocessing') or (backend == 'local'):
             if len(multiprocessing.active_children()) > 0:
@@ -438,8 +487,1319 @@ def setup_cluster(backend: str = 'multiprocessing',
                     pass
             c = None
 
-            dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
+            dview = Pool(n_processes, initializer=_init_worker, initargs=(threads_per_process,),
+                         maxtasksperchild=maxtasksperchild)
+        elif backend in ('processes', 'threads'):
+            c = None
+            dview = ClusterExecutor(backend, n_processes=int(n_processes), threads_per_process=threads_per_process)
         else:
             raise Exception('Unknown Backend')
 
     return c, dview, n_processes
+
+
+#%%
+# segments published by this process, unlinked when released or at exit
+_published_segments: Dict[str, Any] = {}
+# segments attached by this process (in the workers), kept open for the following tasks
+_attached_segments: OrderedDict = OrderedDict()
+_max_attached_segments = 16
+
+
+def _create_segment(nbytes: int):
+    shm = shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+    _published_segments[shm.name] = shm
+    return shm
+
+
+def _attach_segment(name: str):
+    if name in _published_segments:
+        return _published_segments[name]
+    if name in _attached_segments:
+        _attached_segments.move_to_end(name)
+        return _attached_segments[name]
+    # the segment belongs to the publishing process, which unlinks it. It is not registered to the
+    # resource tracker, which would unlink it when this process exits (the forked workers share the
+    # tracker of the publishing process)
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    _attached_segments[name] = shm
+    while len(_attached_segments) > _max_attached_segments:
+        old_name, old = next(iter(_attached_segments.items()))
+        try:
+            old.close()
+        except BufferError:
+            # arrays of the oldest segment are still in use
+            break
+        del _attached_segments[old_name]
+    return shm
+
+
+def _release_segment(name: str) -> None:
+    shm = _published_segments.pop(name, None)
+    if shm is None:
+        return
+    try:
+        shm.close()
+    except BufferError:
+        # the memory is freed when the last view is deleted
+        pass
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@atexit.register
+def _release_all_segments() -> None:
+    for name in list(_published_segments):
+        _release_segment(name)
+
+
+class Broadcast(object):
+    """
+    Handle to an object published once for all the workers of a cluster (see broadcast).
+
+    The handle is small and can be sent with every task instead of the object. Workers
+    retrieve the object with fetch. The publisher releases it with release, or by using
+    the handle as a context manager.
+    """
+
+    def get(self) -> Any:
+        raise NotImplementedError
+
+    def release(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class SharedArray(Broadcast):
+    """ ndarray in a shared memory segment, read by the workers as a read only view of the segment """
+
+    def __init__(self, arr: np.ndarray) -> None:
+        arr = np.ascontiguousarray(arr)
+        self.shape, self.dtype = arr.shape, arr.dtype.str
+        self.name = _create_segment(arr.nbytes).name
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=_published_segments[self.name].buf)[...] = arr
+
+    def get(self) -> np.ndarray:
+        arr = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=_attach_segment(self.name).buf)
+        arr.flags.writeable = False
+        return arr
+
+    def release(self) -> None:
+        _release_segment(self.name)
+
+
+class SharedSparse(Broadcast):
+    """ scipy.sparse matrix (csr or csc, other formats are converted to csc) whose arrays are in shared memory """
+
+    def __init__(self, mat) -> None:
+        if mat.format not in ('csr', 'csc'):
+            mat = mat.tocsc()
+        # canonical format, so that the workers never sort the read only arrays in place
+        mat = mat.copy()
+        mat.sum_duplicates()
+        mat.sort_indices()
+        self.format, self.shape = mat.format, mat.shape
+        self.arrays = [SharedArray(arr) for arr in (mat.data, mat.indices, mat.indptr)]
+
+    def get(self):
+        cls = scipy.sparse.csr_matrix if self.format == 'csr' else scipy.sparse.csc_matrix
+        mat = cls(tuple(arr.get() for arr in self.arrays), shape=self.shape, copy=False)
+        mat.has_canonical_format = True
+        return mat
+
+    def release(self) -> None:
+        for arr in self.arrays:
+            arr.release()
+
+
+class SharedObject(Broadcast):
+    """ pickled object in shared memory. Each fetch returns a new copy of the object """
+
+    def __init__(self, obj: Any) -> None:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self.nbytes = len(data)
+        self.name = _create_segment(self.nbytes).name
+        _published_segments[self.name].buf[:self.nbytes] = data
+
+    def get(self) -> Any:
+        return pickle.loads(_attach_segment(self.name).buf[:self.nbytes])
+
+    def release(self) -> None:
+        _release_segment(self.name)
+
+
+class PushedObject(Broadcast):
+    """ object pushed to the namespace of the ipyparallel engines, which can run on other machines """
+
+    def __init__(self, obj: Any, dview) -> None:
+        self.name = '_caiman_broadcast_' + uuid.uuid4().hex
+        self._dview = dview
+        dview.push({self.name: obj}, block=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dview'] = None
+        return state
+
+    def get(self) -> Any:
+        return sys.modules['__main__'].__dict__[self.name]
+
+    def release(self) -> None:
+        if self._dview is not None:
+            self._dview.execute('globals().pop({!r}, None)'.format(self.name), block=True)
+            self._dview = None
+
+
+def broadcast(obj: Any, dview=None) -> Any:
+    """
+    Publish a read only object once for all the workers of dview, instead of sending a copy
+    with every task.
+
+    With a multiprocessing pool, ndarrays and scipy.sparse matrices are copied once into
+    shared memory segments, and the workers get zero-copy read only views of them. Other
+    objects are pickled once into a segment. With ipyparallel the object is pushed to the
+    namespace of the engines. Without dview (or shared memory, python < 3.8) the object
+    itself is returned.
+
+    Example of usage:
+        C_handle = broadcast(C, dview)
+        try:
+            results = dview.map_async(func, [(C_handle, idx) for idx in blocks]).get(4294967)
+        finally:
+            release(C_handle)
+
+        def func(pars):
+            C_handle, idx = pars
+            C = fetch(C_handle)
+
+    Args:
+        obj: ndarray, scipy.sparse matrix or picklable object
+            the object to publish. It must not be modified by the workers
+
+        dview: multiprocessing pool, ipyparallel view or ClusterExecutor
+
+    Returns:
+        handle: Broadcast or obj
+            to be passed to the workers, which retrieve obj with fetch
+    """
+    if isinstance(dview, ClusterExecutor):
+        # threads share the memory of the process
+        dview = None if dview.backend in ('serial', 'threads') else dview.dview
+    if dview is None:
+        return obj
+    if 'multiprocessing' not in str(type(dview)) and hasattr(dview, 'push'):
+        return PushedObject(obj, dview)
+    if not HAS_SHARED_MEMORY:
+        return obj
+    if scipy.sparse.issparse(obj):
+        return SharedSparse(obj)
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        return SharedArray(obj)
+    return SharedObject(obj)
+
+
+def fetch(handle: Any) -> Any:
+    """ object published with broadcast (handle itself if it is not a Broadcast handle) """
+    return handle.get() if isinstance(handle, Broadcast) else handle
+
+
+def release(handle: Any) -> None:
+    """ frees the resources of an object published with broadcast (nothing if it is not a Broadcast handle) """
+    if isinstance(handle, Broadcast):
+        handle.release()
+
+
+#%%
+class _Task(object):
+    """ a task submitted to one of the backends of ClusterExecutor """
+
+    def __init__(self, handle=None, result=None, error=None) -> None:
+        self.handle = handle
+        self._result, self._error = result, error
+
+    def set_result(self, result) -> None:
+        self._result = result
+
+    def set_error(self, error) -> None:
+        self._error = error
+
+    def result(self) -> Any:
+        if isinstance(self.handle, concurrent.futures.Future):
+            return self.handle.result()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def cancel(self) -> None:
+        if isinstance(self.handle, concurrent.futures.Future):
+            try:
+                if hasattr(self.handle, 'abort'):
+                    # ipyparallel results are futures that are aborted on the engines
+                    self.handle.abort()
+                else:
+                    self.handle.cancel()
+            except Exception:
+                pass
+        # tasks of multiprocessing pools cannot be cancelled, their results are ignored
+
+
+class _MapResult(object):
+    """ result of ClusterExecutor.map_async, as the results of multiprocessing pools """
+
+    def __init__(self, results) -> None:
+        self._results = results
+
+    def get(self, timeout=None) -> List:
+        return list(self._results)
+
+
+class TaskFailure(object):
+    """ task of a ClusterExecutor map that failed after all its attempts """
+
+    def __init__(self, index: int, attempts: int, error: BaseException, timed_out: bool = False) -> None:
+        self.index = index
+        self.attempts = attempts
+        self.error = error
+        self.timed_out = timed_out
+        # the traceback of the workers is chained to the error by the backends
+        self.traceback = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+
+    def __repr__(self) -> str:
+        return 'TaskFailure(task {}, {} attempts: {!r})'.format(self.index, self.attempts, self.error)
+
+
+class MapReport(object):
+    """
+    Outcome of a ClusterExecutor map: number of tasks done, retried and run again because they were
+    late (speculative), and the tasks that failed
+    """
+
+    def __init__(self) -> None:
+        self.n_tasks: Optional[int] = None
+        self.n_done = 0
+        self.n_retries = 0
+        self.n_speculative = 0
+        self.failures: List[TaskFailure] = []
+
+    def add_failure(self, index: int, attempts: int, error: BaseException, timed_out: bool = False) -> None:
+        self.failures.append(TaskFailure(index, attempts, error, timed_out))
+        logger.error('Task {} failed after {} attempts: {!r}'.format(index, attempts, error))
+
+    @property
+    def failed_indices(self) -> List[int]:
+        return sorted(failure.index for failure in self.failures)
+
+    def __repr__(self) -> str:
+        return 'MapReport({} of {} tasks done, {} retries, {} speculative, {} failed: {})'.format(
+            self.n_done, '?' if self.n_tasks is None else self.n_tasks, self.n_retries, self.n_speculative,
+            len(self.failures), self.failed_indices)
+
+
+# interval (s) at which the running tasks are checked for timeouts and stragglers
+_poll_interval = 0.5
+
+
+class ClusterExecutor(object):
+    """
+    Executor with the same interface over the parallel backends of CaImAn: serial (dview None),
+    multiprocessing pools, concurrent.futures executors (processes or threads) and ipyparallel
+    views (whose tasks are load balanced over the engines of the view).
+
+    imap and imap_unordered stream the results as the tasks finish, keeping at most max_pending
+    tasks submitted, with a timeout, a progress callback and cancellation. The executor can also be
+    used as a dview by the functions written for multiprocessing pools and ipyparallel views
+    (map, map_sync, map_async, imap, terminate).
+
+    Example of usage:
+        executor = as_executor(dview)
+        for idx, result in executor.imap_unordered(func, pars, with_index=True, timeout=3600,
+                                                   progress=progress_logger('Patches')):
+            output[idx] = result
+    """
+
+    def __init__(self, dview=None, n_processes: int = None, threads_per_process: int = None) -> None:
+        """
+        Args:
+            dview: None, multiprocessing pool, concurrent.futures executor, ipyparallel view or
+                one of 'processes', 'threads' to start a new executor
+
+            n_processes: int
+                number of workers of a new executor (by default the number of cpus)
+
+            threads_per_process: int
+                threads of the BLAS, OpenMP, numexpr and OpenCV libraries in each worker of a new
+                'processes' executor (see limit_threads), not limited by default
+
+        Raises:
+            Exception 'Unknown cluster backend'
+        """
+        if dview in ('processes', 'threads'):
+            n_processes = n_processes or os.cpu_count() or 1
+            cls = concurrent.futures.ProcessPoolExecutor if dview == 'processes' else \
+                concurrent.futures.ThreadPoolExecutor
+            if dview == 'processes' and threads_per_process is not None:
+                dview = cls(max_workers=n_processes, initializer=_init_worker, initargs=(threads_per_process,))
+            else:
+                dview = cls(max_workers=n_processes)
+        self.dview = dview
+        # for the functions that clear the results of ipyparallel views
+        self.results: Dict = {}
+        self._cancel_events: List = []
+        if dview is None:
+            self.backend = 'serial'
+        elif isinstance(dview, concurrent.futures.ThreadPoolExecutor):
+            self.backend = 'threads'
+        elif isinstance(dview, concurrent.futures.Executor):
+            self.backend = 'futures'
+        elif 'multiprocessing' in str(type(dview)):
+            self.backend = 'multiprocessing'
+        elif hasattr(dview, 'client'):
+            self.backend = 'ipyparallel'
+            self._lview = dview.client.load_balanced_view(targets=dview.targets)
+        else:
+            raise Exception('Unknown cluster backend')
+
+    def __len__(self) -> int:
+        """ number of workers """
+        if self.backend == 'serial':
+            return 1
+        if self.backend == 'multiprocessing':
+            return self.dview._processes
+        if self.backend == 'ipyparallel':
+            return len(self.dview)
+        return self.dview._max_workers
+
+    def __repr__(self) -> str:
+        return 'ClusterExecutor({}, {} workers)'.format(self.backend, len(self))
+
+    def _submit(self, func, arg, on_done) -> _Task:
+        if self.backend == 'multiprocessing':
+            task = _Task()
+
+            def callback(result):
+                task.set_result(result)
+                on_done()
+
+            def error_callback(error):
+                task.set_error(error)
+                on_done()
+
+            task.handle = self.dview.apply_async(func, (arg,), callback=callback, error_callback=error_callback)
+            return task
+        if self.backend == 'ipyparallel':
+            future = self._lview.apply_async(func, arg)
+        else:
+            future = self.dview.submit(func, arg)
+        future.add_done_callback(lambda _: on_done())
+        return _Task(future)
+
+    def _imap(self, func, iterable, ordered: bool, timeout: Optional[float], progress, max_pending: Optional[int],
+              plan=None, retries: int = 0, task_timeout: Optional[float] = None, speculative: Optional[float] = None,
+              on_error: str = 'raise', report=None):
+        """ generator of (index, result), see imap_unordered """
+        if on_error not in ('raise', 'skip'):
+            raise Exception('on_error must be raise or skip')
+        n_total = len(iterable) if hasattr(iterable, '__len__') else None
+        cancel_event = threading.Event()
+        self._cancel_events.append(cancel_event)
+        if report is None:
+            report = MapReport()
+        report.n_tasks = n_total
+        peaks: List[int] = []
+        if plan is not None:
+            func = _MeasuredTask(func)
+
+        def unwrap(result):
+            if plan is not None:
+                result, peak = result
+                if peak is not None:
+                    peaks.append(peak)
+            return result
+
+        def failed(idx, n_attempts, error, timed_out=False):
+            """ result of a task failed after n_attempts, or raises its error """
+            report.add_failure(idx, n_attempts, error, timed_out)
+            if on_error == 'raise':
+                raise error
+            return None
+
+        try:
+            if self.backend == 'serial':
+                for idx, arg in enumerate(iterable):
+                    for attempt in range(1, retries + 2):
+                        if cancel_event.is_set():
+                            raise concurrent.futures.CancelledError()
+                        try:
+                            result = unwrap(func(arg))
+                            break
+                        except Exception as error:
+                            if attempt <= retries:
+                                report.n_retries += 1
+                                logger.warning('Task {} failed ({!r}), retrying'.format(idx, error))
+                            else:
+                                result = failed(idx, attempt, error)
+                    report.n_done += 1
+                    if progress is not None:
+                        progress(report.n_done, n_total)
+                    yield idx, result
+                return
+
+            if max_pending is None:
+                max_pending = 2 * len(self)
+            if plan is not None:
+                # the tasks take memory only while running
+                max_pending = min(max_pending, plan.n_concurrent)
+            if task_timeout is not None:
+                # the tasks start as soon as they are submitted, their running time is then known
+                max_pending = min(max_pending, len(self))
+            poll = None
+            if task_timeout is not None or speculative is not None:
+                poll = min(_poll_interval, task_timeout or _poll_interval)
+            items = enumerate(iterable)
+            done: queue.Queue = queue.Queue()
+            task_ids = itertools.count()
+            # task id -> (index, task, submission time), and index -> ids of the tasks running it
+            pending: Dict[int, Tuple[int, _Task, float]] = {}
+            copies: Dict[int, List[int]] = {}
+            args: Dict[int, Any] = {}
+            attempts: Dict[int, int] = {}
+            durations: List[float] = []
+            finished: Dict[int, Any] = {}
+            ready: List[Tuple[int, Any]] = []
+            next_index = 0
+            exhausted = False
+            last_done = time.time()
+
+            def submit(idx):
+                task_id = next(task_ids)
+                task = self._submit(func, args[idx], functools.partial(done.put, task_id))
+                pending[task_id] = (idx, task, time.time())
+                copies[idx].append(task_id)
+
+            def drop(task_id):
+                idx, task, started = pending.pop(task_id)
+                copies[idx].remove(task_id)
+                if self.backend == 'ipyparallel':
+                    # the client keeps the results of all the tasks otherwise
+                    for msg_id in task.handle.msg_ids:
+                        self.dview.client.results.pop(msg_id, None)
+                return idx, task, started
+
+            def complete(idx, result):
+                for task_id in list(copies.pop(idx)):
+                    pending.pop(task_id)[1].cancel()
+                del args[idx], attempts[idx]
+                report.n_done += 1
+                if progress is not None:
+                    progress(report.n_done, n_total)
+                ready.append((idx, result))
+
+            def retry_or_fail(idx, error, timed_out=False):
+                if copies[idx]:
+                    # another copy of the task is still running
+                    return
+                if attempts[idx] <= retries:
+                    attempts[idx] += 1
+                    report.n_retries += 1
+                    logger.warning('Task {} {} ({!r}), retrying'.format(
+                        idx, 'timed out' if timed_out else 'failed', error))
+                    submit(idx)
+                else:
+                    complete(idx, failed(idx, attempts[idx], error, timed_out))
+
+            try:
+                while True:
+                    while not exhausted and len(pending) < max_pending:
+                        try:
+                            idx, arg = next(items)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        args[idx], attempts[idx], copies[idx] = arg, 1, []
+                        submit(idx)
+                    if exhausted and speculative is not None and durations and \
+                            report.n_done >= speculative * (report.n_done + len(args)):
+                        # the stragglers are run again by the idle workers, the first copy to finish is kept.
+                        # The copies count in max_pending as the other tasks (memory budget, timeouts)
+                        now, typical = time.time(), np.median(durations)
+                        for task_id, (idx, _, started) in sorted(list(pending.items()), key=lambda x: x[1][2]):
+                            if len(pending) >= min(max_pending, len(self)):
+                                break
+                            if len(copies[idx]) == 1 and now - started > typical:
+                                report.n_speculative += 1
+                                logger.info('Task {} is running for {:.1f} s, running it again'.format(
+                                    idx, now - started))
+                                submit(idx)
+                    if not pending:
+                        break
+                    wait = timeout if poll is None else \
+                        poll if timeout is None else min(poll, max(timeout - (time.time() - last_done), 0))
+                    try:
+                        task_id = done.get(timeout=wait)
+                    except queue.Empty:
+                        task_id = None
+                    if cancel_event.is_set():
+                        raise concurrent.futures.CancelledError()
+                    now = time.time()
+                    if task_id is None:
+                        if timeout is not None and now - last_done >= timeout:
+                            raise TimeoutError('No task finished in {} s'.format(timeout))
+                        if task_timeout is not None:
+                            for task_id, (idx, task, started) in list(pending.items()):
+                                if now - started > task_timeout:
+                                    # tasks of multiprocessing pools keep running, and take a worker
+                                    drop(task_id)
+                                    task.cancel()
+                                    retry_or_fail(idx, TimeoutError(
+                                        'Task {} did not finish in {} s'.format(idx, task_timeout)), True)
+                    elif task_id in pending:
+                        # copies cancelled or timed out are ignored
+                        idx, task, started = drop(task_id)
+                        last_done = now
+                        try:
+                            result = unwrap(task.result())
+                        except Exception as error:
+                            retry_or_fail(idx, error)
+                        else:
+                            durations.append(now - started)
+                            complete(idx, result)
+                    for idx, result in ready:
+                        if not ordered:
+                            yield idx, result
+                            continue
+                        finished[idx] = result
+                        while next_index in finished:
+                            yield next_index, finished.pop(next_index)
+                            next_index += 1
+                    ready.clear()
+            finally:
+                for _, task, _ in pending.values():
+                    task.cancel()
+        finally:
+            self._cancel_events.remove(cancel_event)
+            if plan is not None:
+                plan.budget.record(plan.stage, plan.task_bytes, peaks)
+            if report.failures or report.n_retries or report.n_speculative:
+                logger.warning(str(report))
+
+    def imap_unordered(self, func, iterable, chunksize: int = None, timeout: float = None, progress=None,
+                       max_pending: int = None, with_index: bool = False, plan: 'TaskPlan' = None,
+                       retries: int = 0, task_timeout: float = None, speculative: float = None,
+                       on_error: str = 'raise', report: MapReport = None):
+        """
+        Results of func over iterable, in the order in which the tasks finish
+
+        Args:
+            func: function
+                applied to each item, it must be picklable for the process backends
+
+            iterable: iterable
+                arguments of func, consumed as tasks are submitted
+
+            chunksize: int
+                ignored, for compatibility with multiprocessing pools
+
+            timeout: float
+                maximum time (s) waiting for the next task to finish. The other tasks are cancelled and
+                TimeoutError is raised when it is exceeded
+
+            progress: function
+                called as progress(n_done, n_total) whenever a task finishes (n_total is None if
+                iterable has no length)
+
+            max_pending: int
+                maximum number of tasks submitted at the same time, which bounds the memory taken by
+                the arguments and by the results (2 per worker by default)
+
+            with_index: bool
+                whether to return the index of the item in iterable with each result
+
+            plan: TaskPlan
+                memory plan of the stage (see MemoryBudget.plan). At most plan.n_concurrent tasks
+                are submitted at the same time and their peak RSS is recorded in the budget
+
+            retries: int
+                number of times a task that raised or timed out is submitted again
+
+            task_timeout: float
+                maximum running time (s) of a task, after which it is cancelled and counted as failed.
+                At most one task per worker is then submitted at the same time. The tasks of
+                multiprocessing pools cannot be cancelled and keep their worker until they finish
+
+            speculative: float
+                fraction of the tasks done after which the tasks running for longer than the median
+                task are run again by the idle workers, the first copy to finish being kept. The
+                copies count in max_pending (and plan) as the other tasks. None to never run tasks again
+
+            on_error: str
+                'raise' to raise the error of a task failed after all its attempts (the results
+                already returned are kept by the caller), 'skip' to return None as its result
+
+            report: MapReport
+                filled with the number of tasks done, retried and run again, and the failures
+
+        Returns:
+            generator over the results (or (index, result) pairs). Closing the generator, or
+            cancel, cancels the pending tasks
+
+        Raises:
+            TimeoutError, concurrent.futures.CancelledError, exceptions raised by func
+        """
+        for idx, result in self._imap(func, iterable, False, timeout, progress, max_pending, plan, retries,
+                                      task_timeout, speculative, on_error, report):
+            yield (idx, result) if with_index else result
+
+    def imap(self, func, iterable, chunksize: int = None, timeout: float = None, progress=None,
+             max_pending: int = None, plan: 'TaskPlan' = None, retries: int = 0, task_timeout: float = None,
+             speculative: float = None, on_error: str = 'raise', report: MapReport = None):
+        """ results of func over iterable, in the order of iterable (see imap_unordered) """
+        for _, result in self._imap(func, iterable, True, timeout, progress, max_pending, plan, retries,
+                                    task_timeout, speculative, on_error, report):
+            yield result
+
+    def map(self, func, iterable, chunksize: int = None) -> List:
+        return list(self.imap(func, iterable))
+
+    def map_sync(self, func, iterable) -> List:
+        return list(self.imap(func, iterable))
+
+    def map_async(self, func, iterable, chunksize: int = None) -> _MapResult:
+        return _MapResult(self.imap(func, iterable))
+
+    def cancel(self) -> None:
+        """ cancels the running imap and imap_unordered """
+        for event in list(self._cancel_events):
+            event.set()
+
+    def terminate(self) -> None:
+        """ stops the workers of the executor """
+        self.cancel()
+        if self.backend == 'multiprocessing':
+            self.dview.terminate()
+        elif self.backend in ('futures', 'threads'):
+            if sys.version_info >= (3, 9):
+                self.dview.shutdown(wait=False, cancel_futures=True)
+            else:
+                self.dview.shutdown(wait=False)
+
+    def close(self) -> None:
+        if self.backend == 'multiprocessing':
+            self.dview.close()
+        elif self.backend in ('futures', 'threads'):
+            self.dview.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def as_executor(dview) -> ClusterExecutor:
+    """ ClusterExecutor over dview (None, multiprocessing pool, concurrent.futures executor, ipyparallel view) """
+    return dview if isinstance(dview, ClusterExecutor) else ClusterExecutor(dview)
+
+
+def progress_logger(name: str, step: float = 0.1):
+    """ progress callback of ClusterExecutor logging name and the fraction of tasks done, every step of it """
+    state = {'next': step}
+
+    def progress(n_done: int, n_total: Optional[int]) -> None:
+        if n_total is None:
+            logger.debug('{}: {} tasks done'.format(name, n_done))
+        elif n_done / n_total >= state['next'] or n_done == n_total:
+            state['next'] = (np.floor(n_done / n_total / step) + 1) * step
+            logger.info('{}: {} of {} tasks done'.format(name, n_done, n_total))
+
+    return progress
+
+
+#%%
+# memory budget of the parallel stages, see set_memory_budget
+_memory_budget = None
+# memory taken by an idle worker (interpreter, numpy, caiman and their libraries)
+_worker_bytes = 2**28
+
+
+def parse_bytes(size: Union[int, float, str]) -> int:
+    """ number of bytes of size, either a number or a string such as '16GB', '512 MB' or '2G' """
+    if not isinstance(size, str):
+        return int(size)
+    units = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    number = size.strip().upper().rstrip('IB').rstrip('B')
+    unit = number[-1] if number[-1] in units else ''
+    try:
+        return int(float(number[:len(number) - len(unit)]) * units[unit])
+    except ValueError:
+        raise Exception('Invalid memory size: ' + size)
+
+
+def _current_rss() -> int:
+    return psutil.Process().memory_info().rss
+
+
+def _reset_peak_rss() -> None:
+    """ resets the peak RSS of the process, on Linux only """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss() -> int:
+    """ peak RSS of the process since the last reset (Linux), its lifetime peak otherwise """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 2**10
+    except OSError:
+        pass
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss)
+
+
+# number of measured tasks running in this process, the tasks of nested stages are not measured
+_measured_depth = 0
+
+
+class _MeasuredTask(object):
+    """ wraps a function to also return the peak increase of RSS of the worker while running it """
+
+    def __init__(self, func) -> None:
+        self.func = func
+
+    def __call__(self, arg) -> Tuple[Any, Optional[int]]:
+        global _measured_depth
+        if _measured_depth > 0:
+            return self.func(arg), None
+        _measured_depth += 1
+        try:
+            rss = _current_rss()
+            _reset_peak_rss()
+            result = self.func(arg)
+            return result, max(_peak_rss() - rss, 0)
+        finally:
+            _measured_depth -= 1
+
+
+def estimate_task_bytes(n_pixels: int, T: int, dtype=np.float32, copies: float = 1, K: int = 0,
+                        fixed_bytes: int = 0) -> int:
+    """
+    Estimates the memory taken by a task processing n_pixels pixels over T frames
+
+    Args:
+        n_pixels: int
+            number of pixels of the task (pixels of the patch, or of the block)
+
+        T: int
+            number of frames
+
+        dtype: data type
+            type of the data held in memory by the task
+
+        copies: float
+            number of copies of the data made by the task
+
+        K: int
+            number of components, whose spatial and temporal components are held in float64
+
+        fixed_bytes: int
+            memory taken by the task regardless of its size
+
+    Returns:
+        number of bytes
+    """
+    return int(copies * n_pixels * T * np.dtype(dtype).itemsize + 8 * K * (n_pixels + T) + fixed_bytes)
+
+
+class TaskPlan(object):
+    """
+    Block size and concurrency of a parallel stage chosen by MemoryBudget.plan. Passed to
+    ClusterExecutor.imap_unordered it limits the number of tasks running at the same time, and
+    the peak RSS of each task is measured and recorded in the budget.
+    """
+
+    def __init__(self, budget, stage: str, block_size: int, n_concurrent: int, task_bytes: int) -> None:
+        self.budget = budget
+        self.stage = stage
+        self.block_size = block_size
+        self.n_concurrent = n_concurrent
+        self.task_bytes = task_bytes
+
+    def __repr__(self) -> str:
+        return 'TaskPlan({}: blocks of {}, {} concurrent tasks of {:.1f} MB)'.format(
+            self.stage, self.block_size, self.n_concurrent, self.task_bytes / 2.**20)
+
+
+class MemoryBudget(object):
+    """
+    Memory available to the parallel stages of CaImAn, shared by all the workers. The stages
+    estimate the footprint of their tasks from the shapes of the data (see estimate_task_bytes) and
+    the budget chooses the block sizes and the number of tasks running at the same time so that
+    the tasks fit together within it.
+
+    The peak RSS of the tasks is measured and reported per stage (see report), to calibrate the
+    estimates. The peak is the one of the worker process, with the 'threads' backend and when the
+    stage runs in the main process it includes the other tasks and threads of the process.
+
+    Example of usage:
+        cm.cluster.set_memory_budget('16GB')
+        ...
+        cm.cluster.get_memory_budget().report()
+    """
+
+    def __init__(self, budget: Union[int, float, str] = None, fraction: float = 0.8) -> None:
+        """
+        Args:
+            budget: int or str
+                bytes available to the workers ('16GB' and the like are accepted). By default a
+                fraction of the memory available when the stages are planned
+
+            fraction: float
+                fraction of the available memory used when budget is None
+        """
+        self._budget = None if budget is None else parse_bytes(budget)
+        self.fraction = fraction
+        self.stats: Dict[str, Dict] = OrderedDict()
+
+    @property
+    def bytes(self) -> int:
+        if self._budget is not None:
+            return self._budget
+        return int(self.fraction * psutil.virtual_memory().available)
+
+    def __repr__(self) -> str:
+        return 'MemoryBudget({:.1f} GB)'.format(self.bytes / 2.**30)
+
+    def max_workers(self, n_workers: int) -> int:
+        """ number of workers, at most n_workers, whose idle footprint fits in the budget """
+        return int(np.clip(self.bytes // _worker_bytes, 1, n_workers))
+
+    def plan(self, stage: str, bytes_per_item: int, n_items: int, n_workers: int, fixed_bytes: int = 0,
+             max_size: int = None, min_size: int = 1) -> TaskPlan:
+        """
+        Chooses the block size and the number of concurrent tasks of a stage
+
+        Every task processes a block of items (pixels, rows) and takes
+        fixed_bytes + block_size * bytes_per_item bytes. The block size is the largest, up to
+        max_size, allowing n_workers tasks within the budget; if even blocks of min_size items do not
+        fit, fewer tasks run at the same time.
+
+        Args:
+            stage: str
+                name of the stage in the logs and in the report
+
+            bytes_per_item: int
+                memory taken by each item of a block
+
+            n_items: int
+                total number of items
+
+            n_workers: int
+                number of workers of the cluster
+
+            fixed_bytes: int
+                memory taken by each task regardless of its block size
+
+            max_size: int
+                maximum block size (for instance set by the user), n_items by default
+
+            min_size: int
+                minimum block size
+
+        Returns:
+            TaskPlan
+        """
+        n_workers = max(int(n_workers), 1)
+        max_size = int(n_items if max_size is None else min(max_size, n_items))
+        min_size = int(max(min(min_size, max_size), 1))
+        bytes_per_item = max(int(bytes_per_item), 1)
+        budget = self.bytes
+        block_size = int(np.clip((budget / n_workers - fixed_bytes) // bytes_per_item, min_size, max_size))
+        task_bytes = int(fixed_bytes + block_size * bytes_per_item)
+        n_concurrent = int(np.clip(budget // task_bytes, 1, n_workers))
+        if task_bytes > budget:
+            logger.warning('{}: tasks of {:.1f} MB exceed the memory budget of {:.1f} MB'.format(
+                stage, task_bytes / 2.**20, budget / 2.**20))
+        plan = TaskPlan(self, stage, block_size, n_concurrent, task_bytes)
+        logger.debug(str(plan))
+        return plan
+
+    def record(self, stage: str, task_bytes: int, peaks: List[int]) -> None:
+        """ records the peak RSS increase of the tasks of a stage, estimated to take task_bytes each """
+        if len(peaks) == 0:
+            return
+        stats = self.stats.setdefault(stage, {'n_tasks': 0, 'estimated_bytes': 0, 'mean_peak_bytes': 0.,
+                                              'max_peak_bytes': 0})
+        n_tasks = stats['n_tasks'] + len(peaks)
+        stats['mean_peak_bytes'] = (stats['mean_peak_bytes'] * stats['n_tasks'] + np.sum(peaks)) / n_tasks
+        stats['n_tasks'] = n_tasks
+        stats['estimated_bytes'] = max(stats['estimated_bytes'], int(task_bytes))
+        stats['max_peak_bytes'] = max(stats['max_peak_bytes'], int(np.max(peaks)))
+        logger.info('{}: peak RSS per task {:.1f} MB (mean {:.1f} MB) over {} tasks, estimated {:.1f} MB'.format(
+            stage, np.max(peaks) / 2.**20, np.mean(peaks) / 2.**20, len(peaks), task_bytes / 2.**20))
+
+    def report(self) -> Dict[str, Dict]:
+        """
+        Peak RSS of the tasks of each stage
+
+        Returns:
+            dict stage -> dict with n_tasks, estimated_bytes (largest estimate of a task),
+            mean_peak_bytes and max_peak_bytes (measured increase of RSS during a task)
+        """
+        for stage, stats in self.stats.items():
+            logger.info('{}: {} tasks, estimated {:.1f} MB, peak {:.1f} MB (mean {:.1f} MB)'.format(
+                stage, stats['n_tasks'], stats['estimated_bytes'] / 2.**20, stats['max_peak_bytes'] / 2.**20,
+                stats['mean_peak_bytes'] / 2.**20))
+        return dict(self.stats)
+
+
+def set_memory_budget(budget: Union[int, float, str, MemoryBudget] = None, fraction: float = 0.8) -> MemoryBudget:
+    """
+    Sets the memory budget of the parallel stages
+
+    Args:
+        budget: int, str or MemoryBudget
+            bytes available to the workers ('16GB' and the like are accepted). None for a fraction of
+            the available memory
+
+        fraction: float
+            fraction of the available memory used when budget is None
+
+    Returns:
+        the MemoryBudget
+    """
+    global _memory_budget
+    _memory_budget = budget if isinstance(budget, MemoryBudget) else MemoryBudget(budget, fraction=fraction)
+    return _memory_budget
+
+
+def get_memory_budget() -> MemoryBudget:
+    """ memory budget of the parallel stages (80% of the available memory unless set_memory_budget was called) """
+    global _memory_budget
+    if _memory_budget is None:
+        _memory_budget = MemoryBudget()
+    return _memory_budget
+
+
+#%%
+# environment variables read by the BLAS, OpenMP and numexpr libraries when they are loaded
+_thread_env_vars = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'BLIS_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+# threads per process of a worker started by setup_cluster, None in the other processes
+_worker_threads = None
+
+
+def limit_threads(n_threads: int = None) -> Dict:
+    """
+    Limits the threads of the BLAS, OpenMP, numexpr and OpenCV libraries of this process
+
+    The libraries already loaded are limited through threadpoolctl (when installed), those loaded
+    later and the child processes through the environment variables they read.
+
+    Args:
+        n_threads: int
+            number of threads per library, None for the number of cpus (the threads per process
+            in a worker started by setup_cluster)
+
+    Returns:
+        state: dict
+            previous limits, to be passed to restore_threads
+    """
+    if n_threads is None:
+        n_threads = _worker_threads or psutil.cpu_count() or 1
+    n_threads = max(int(n_threads), 1)
+    state: Dict[str, Any] = {'env': {var: os.environ.get(var) for var in _thread_env_vars}}
+    for var in _thread_env_vars:
+        os.environ[var] = str(n_threads)
+    if HAS_THREADPOOLCTL:
+        state['threadpools'] = threadpoolctl.threadpool_limits(limits=n_threads)
+    if 'numexpr' in sys.modules:
+        state['numexpr'] = sys.modules['numexpr'].set_num_threads(n_threads)
+    try:
+        state['cv2'] = cv2.getNumThreads()
+        cv2.setNumThreads(n_threads)
+    except:
+        pass
+    return state
+
+
+def restore_threads(state: Dict) -> None:
+    """ restores the limits changed by limit_threads """
+    for var, value in state['env'].items():
+        if value is None:
+            os.environ.pop(var, None)
+        else:
+            os.environ[var] = value
+    if 'threadpools' in state:
+        state['threadpools'].restore_original_limits()
+    if 'numexpr' in state:
+        sys.modules['numexpr'].set_num_threads(state['numexpr'])
+    if 'cv2' in state:
+        cv2.setNumThreads(state['cv2'])
+
+
+@contextlib.contextmanager
+def thread_limits(n_threads: int = None):
+    """
+    Context manager limiting the threads of this process (see limit_threads). With n_threads None
+    the serial phases run by the driver use all the cpus, even when the libraries were limited by
+    environment variables.
+
+    Example of usage:
+        with thread_limits():
+            merge_components(...)
+    """
+    state = limit_threads(n_threads)
+    try:
+        yield
+    finally:
+        restore_threads(state)
+
+
+def _init_worker(n_threads: int) -> None:
+    """ initializer of the workers started by setup_cluster, limiting their threads """
+    global _worker_threads
+    _worker_threads = n_threads
+    limit_threads(n_threads)
+
+
+def worker_threads() -> Optional[int]:
+    """ threads per process of this worker when started by setup_cluster, None otherwise """
+    return _worker_threads
+
+
+#%%
+class ResultCache(object):
+    """
+    Persistent cache of task results, addressed by keys computed from the content of their inputs
+    (see hash_content). The results are pickled in cache_dir, which must be shared by the workers,
+    and the least recently used are evicted when the cache exceeds max_bytes.
+
+    The results can be stored and loaded by the workers; the files are written atomically, so that
+    concurrent workers and runs see complete results only.
+
+    Example of usage:
+        cache = ResultCache('/scratch/caiman_cache', max_bytes='20GB')
+        key = hash_content(file_fingerprint(fname), params)
+        if key not in cache:
+            cache.store(key, compute(fname, params))
+        result = cache.load(key)
+        cache.evict()
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: Union[int, str] = None) -> None:
+        """
+        Args:
+            cache_dir: str
+                directory of the cache, created if needed
+
+            max_bytes: int or str
+                size of the cache ('20GB' and the like are accepted) above which evict removes the
+                least recently used results. None for no limit
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = None if max_bytes is None else parse_bytes(max_bytes)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return 'ResultCache({})'.format(self.cache_dir)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, key: str) -> Any:
+        """
+        Result stored under key, which becomes the most recently used
+
+        Raises:
+            KeyError if there is no result for key
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def store(self, key: str, result: Any) -> None:
+        """ stores result under key """
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def size(self) -> int:
+        """ bytes taken by the results of the cache """
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')))
+
+    def evict(self, max_bytes: Union[int, str] = None) -> int:
+        """
+        Removes the least recently used results until the cache takes at most max_bytes
+
+        Args:
+            max_bytes: int or str
+                size of the cache, max_bytes of the cache by default
+
+        Returns:
+            number of results removed
+        """
+        max_bytes = self.max_bytes if max_bytes is None else parse_bytes(max_bytes)
+        if max_bytes is None:
+            return 0
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        n_removed = 0
+        for _, nbytes, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= nbytes
+            n_removed += 1
+        if n_removed:
+            logger.info('Removed {} results from {}'.format(n_removed, self))
+        return n_removed
+
+    def clear(self) -> None:
+        """ removes all the results """
+        self.evict(0)
+
+
+class CachedTask(object):
+    """
+    Task loading the result of func from a ResultCache when present, and computing and storing it
+    otherwise. It is applied to (key, arg) pairs.
+    """
+
+    def __init__(self, func, cache: ResultCache) -> None:
+        self.func = func
+        self.cache = cache
+
+    def __call__(self, key_arg: Tuple[str, Any]) -> Any:
+        key, arg = key_arg
+        try:
+            return self.cache.load(key)
+        except KeyError:
+            pass
+        except Exception as error:
+            # a result that cannot be read is computed again
+            logger.warning('Cannot load {} from {}: {!r}'.format(key, self.cache, error))
+        result = self.func(arg)
+        self.cache.store(key, result)
+        return result
+
+
+def _update_hash(h, value) -> None:
+    if isinstance(value, dict):
+        h.update(b'dict')
+        for key in sorted(value, key=str):
+            h.update(repr(key).encode())
+            _update_hash(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update('{}{}'.format(type(value).__name__, len(value)).encode())
+        for item in value:
+            _update_hash(h, item)
+    elif isinstance(value, np.ndarray):
+        h.update('ndarray{}{}'.format(value.dtype.str, value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif scipy.sparse.issparse(value):
+        value = scipy.sparse.csr_matrix(value)
+        h.update('sparse{}'.format(value.shape).encode())
+        for arr in (value.data, value.indices, value.indptr):
+            _update_hash(h, arr)
+    elif isinstance(value, np.generic):
+        _update_hash(h, value.item())
+    else:
+        h.update(repr(value).encode())
+
+
+def hash_content(*values) -> str:
+    """ key of a ResultCache from values (dicts, lists, tuples, numpy arrays, sparse matrices, scalars) """
+    h = hashlib.sha1()
+    for value in values:
+        _update_hash(h, value)
+    return h.hexdigest()
+
+
+# fingerprints of the files already read, by path, size and modification time
+_file_fingerprints: Dict[Tuple, str] = {}
+
+
+def file_fingerprint(file_name: str, n_blocks: int = 16, block_size: int = 2**20) -> str:
+    """
+    Fingerprint of the content of a file, for the keys of a ResultCache
+
+    Memory mapped files with a checksum in their header (see mmapping.save_memmap_header) are
+    identified by it, their size and their modification time (the frames can be modified in place
+    without updating the checksum). Other files are identified by their size, their modification time
+    and n_blocks blocks spread over them (the whole file when it is smaller), so that it is cheap for
+    large movies: a file rewritten since gets another fingerprint, even where the blocks are unchanged.
+
+    Args:
+        file_name: str
+            file whose content is fingerprinted
+
+        n_blocks: int
+            number of blocks read
+
+        block_size: int
+            bytes of each block
+
+    Returns:
+        hexadecimal fingerprint
+    """
+    stat = os.stat(file_name)
+    header = load_memmap_header(file_name)
+    if header is not None and header.get('checksum') is not None:
+        return hash_content(stat.st_size, stat.st_mtime_ns, header['checksum'])
+    ident = (os.path.realpath(file_name), stat.st_size, stat.st_mtime_ns, n_blocks, block_size)
+    if ident not in _file_fingerprints:
+        h = hashlib.sha1('{} {}'.format(stat.st_size, stat.st_mtime_ns).encode())
+        with open(file_name, 'rb') as f:
+            if stat.st_size <= n_blocks * block_size:
+                h.update(f.read())
+            else:
+                for offset in np.linspace(0, stat.st_size - block_size, n_blocks).astype(np.int64):
+                    f.seek(int(offset))
+                    h.update(f.read(block_size))
+        _file_fingerprints[ident] = h.hexdigest()
+    return _file_fingerprints[ident]
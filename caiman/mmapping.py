@@ -12,8 +12,11 @@ from builtins import range
 from past.builtins import basestring
 from past.utils import old_div
 
+from concurrent.futures import ThreadPoolExecutor
+import h5py
 import ipyparallel as parallel
 from itertools import chain
+import json
 import logging
 import numpy as np
 import os
@@ -22,10 +25,17 @@ import sys
 import tifffile
 from typing import Any, Dict, List, Optional, Tuple, Union
 import pathlib
+import zlib
 
 import caiman as cm
 from caiman.paths import memmap_frames_filename
 
+try:
+    import hdf5plugin
+    HAS_HDF5PLUGIN = True
+except ImportError:
+    HAS_HDF5PLUGIN = False
+
 
 def prepare_shape(mytuple: Tuple) -> Tuple:
     """ This promotes the elements inside a shape into np.uint64. It is intended to prevent overflows
@@ -35,15 +45,155 @@ def prepare_shape(mytuple: Tuple) -> Tuple:
     return tuple(map(lambda x: np.uint64(x), mytuple))
 
 
+MEMMAP_HEADER_VERSION = 1
+MEMMAP_DTYPES = ('float32', 'float16', 'uint16')
+
+
+def memmap_header_filename(filename: str) -> str:
+    """ Name of the header (sidecar json file) of a memory mapped file """
+    return str(filename) + '.json'
+
+
+def memmap_checksum(filename: str, block_size: int = 2**26) -> str:
+    """ crc32 checksum of a file, computed reading blocks of block_size bytes """
+    crc = 0
+    with open(filename, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            crc = zlib.crc32(block, crc)
+            block = f.read(block_size)
+    return 'crc32:{:08x}'.format(crc)
+
+
+def save_memmap_header(filename: str, dims: Tuple, T: int, order: str = 'C', dtype=np.float32,
+                       fr: Optional[float] = None, add_to_movie: float = 0, checksum: bool = False,
+                       offset: float = 0) -> Dict:
+    """ Write the header of a memory mapped file created by save_memmap (or by the motion correction)
+
+    The header is a json file next to the memory mapped file (see memmap_header_filename) storing its
+    shape, order and data type, together with the frame rate, the offset added to the movie, the
+    offset still to be added to the data (for integer files, see memmap_offset) and optionally a
+    checksum of the data.
+
+    Args:
+        filename: str
+            path of the memory mapped file
+
+        dims: tuple
+            frame dimensions
+
+        T: int
+            number of frames
+
+        order: str
+            whether the file is in 'C' or 'F' order
+
+        dtype: data type of the file (float32, float16 or uint16)
+
+        fr: float
+            frame rate
+
+        add_to_movie: float
+            value added to the movie when saving it
+
+        checksum: bool
+            whether to compute the checksum of the data (the file is read once)
+
+        offset: float
+            value to add to the data when it is converted to floating point (offsets are not added to
+            the data of integer files, which stay in the data type of the camera)
+
+    Returns:
+        header: dict
+            content of the header
+    """
+    header = {'version': MEMMAP_HEADER_VERSION,
+              'dims': [int(d) for d in dims],
+              'T': int(T),
+              'order': order,
+              'dtype': np.dtype(dtype).name,
+              'fr': None if fr is None else float(fr),
+              'add_to_movie': float(add_to_movie),
+              'offset': float(offset),
+              'checksum': memmap_checksum(filename) if checksum else None}
+    header_name = memmap_header_filename(filename)
+    with open(header_name + '.tmp', 'w') as f:
+        json.dump(header, f, indent=1)
+    os.replace(header_name + '.tmp', header_name)
+    return header
+
+
+def load_memmap_header(filename: str) -> Optional[Dict]:
+    """ Read the header of a memory mapped file
+
+    Args:
+        filename: str
+            path of the memory mapped file
+
+    Returns:
+        header: dict
+            content of the header (see save_memmap_header), None for files without header
+
+    Raises:
+        Exception 'Unsupported memmap header version'
+    """
+    header_name = memmap_header_filename(filename)
+    if not os.path.exists(header_name):
+        return None
+    with open(header_name, 'r') as f:
+        header = json.load(f)
+    if header.get('version', 0) > MEMMAP_HEADER_VERSION:
+        raise Exception('Unsupported memmap header version {} for file {}'.format(header.get('version'), filename))
+    return header
+
+
+def memmap_offset(filename: str) -> float:
+    """ Offset to add to the data of a memory mapped file when converting it to floating point
+
+    Integer (uint16) files store the data of the camera as they are, and the offset that save_memmap
+    adds to float files (add_to_movie) is kept in the header instead. Readers that convert frames to
+    floating point (load, MovieReader) add it, one chunk at a time. It is 0 for float files and for
+    files without header.
+    """
+    header = load_memmap_header(filename)
+    return 0 if header is None else header.get('offset', 0)
+
+
+def _memmap_info_from_filename(filename: str) -> Tuple[Tuple, int, str, np.dtype]:
+    """ dims, number of frames, order and data type encoded in the name of a memory mapped file """
+    fpart = os.path.split(filename)[-1].split('_')[1:-1]  # The filename encodes the structure of the map
+    d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-5]), int(fpart[-1]), fpart[-3]
+    dtype = np.dtype(fpart[-11]) if len(fpart) >= 12 and fpart[-12] == 'dtype' else np.dtype(np.float32)
+    return (d1, d2, d3), T, order, dtype
+
+
+def _to_memmap_dtype(Yr: np.ndarray, dtype) -> np.ndarray:
+    """ converts data to the data type of a memory mapped file, rounding and clipping for integer types """
+    dtype = np.dtype(dtype)
+    if dtype.name not in MEMMAP_DTYPES:
+        raise Exception('Memory mapped files can only be saved as ' + ', '.join(MEMMAP_DTYPES))
+    if Yr.dtype == dtype:
+        return Yr
+    if dtype.kind == 'u':
+        Yr = np.clip(np.round(Yr), np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return np.asarray(Yr).astype(dtype, copy=False)
+
+
 #%%
-def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
+def load_memmap(filename: str, mode: str = 'r', verify: bool = False) -> Tuple[Any, Tuple, int]:
     """ Load a memory mapped file created by the function save_memmap
 
+    Shape, order and data type are read from the header of the file if there is one (see
+    save_memmap_header), otherwise from the file name. Chunked stores written by save_chunked are
+    opened (read only) with load_chunked.
+
     Args:
         filename: str
             path of the file to be loaded
         mode: str
             One of 'r', 'r+', 'w+'. How to interact with files
+        verify: bool
+            whether to check the data against the checksum stored in the header (the file is read once)
 
     Returns:
         Yr:
@@ -59,17 +209,35 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
     Raises:
         ValueError "Unknown file extension"
 
+        Exception 'The size of the memmap file does not match its header'
+
+        Exception 'Checksum mismatch'
+
     """
+    if is_chunked_store(filename):
+        if mode != 'r':
+            raise Exception('Chunked stores can only be opened read only')
+        return load_chunked(filename)
     if pathlib.Path(filename).suffix != '.mmap':
         logging.error("Unknown extension for file " + str(filename))
         raise ValueError('Unknown file extension (should be .mmap)')
     # Strip path components and use CAIMAN_DATA/example_movies
     # TODO: Eventually get the code to save these in a different dir
     file_to_load = filename
-    filename = os.path.split(filename)[-1]
-    fpart = filename.split('_')[1:-1]  # The filename encodes the structure of the map
-    d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-5]), int(fpart[-1]), fpart[-3]
-    Yr = np.memmap(file_to_load, mode=mode, shape=prepare_shape((d1 * d2 * d3, T)), dtype=np.float32, order=order)
+    header = load_memmap_header(file_to_load)
+    if header is None:
+        (d1, d2, d3), T, order, dtype = _memmap_info_from_filename(file_to_load)
+    else:
+        d1, d2, d3 = (header['dims'] + [1])[:3]
+        T, order, dtype = header['T'], header['order'], np.dtype(header['dtype'])
+        if mode != 'w+':
+            if os.path.getsize(file_to_load) != d1 * d2 * d3 * T * dtype.itemsize:
+                logging.error('File {} has size {} but its header describes {} bytes'.format(
+                    file_to_load, os.path.getsize(file_to_load), d1 * d2 * d3 * T * dtype.itemsize))
+                raise Exception('The size of the memmap file does not match its header')
+            if verify and header['checksum'] is not None and memmap_checksum(file_to_load) != header['checksum']:
+                raise Exception('Checksum mismatch for file ' + str(file_to_load))
+    Yr = np.memmap(file_to_load, mode=mode, shape=prepare_shape((d1 * d2 * d3, T)), dtype=dtype, order=order)
     if d3 == 1:
         return (Yr, (d1, d2), T)
     else:
@@ -88,7 +256,8 @@ def save_memmap_each(fnames: List[str],
                      add_to_movie: float = 0,
                      border_to_0: int = 0,
                      order: str = 'C',
-                     slices=None) -> List[str]:
+                     slices=None,
+                     dtype=np.float32) -> List[str]:
     """
     Create several memory mapped files using parallel processing
 
@@ -124,6 +293,8 @@ def save_memmap_each(fnames: List[str],
 
         slices: (undocumented)
 
+        dtype: data type of the files (float32, float16 or uint16, see save_memmap)
+
     Returns:
         fnames_tot: list
             paths to the created memory map files
@@ -141,43 +312,47 @@ def save_memmap_each(fnames: List[str],
         if base_name is not None:
             pars.append([
                 f, base_name + '{:04d}'.format(idx), resize_fact[idx], remove_init, idx_xy, order,
-                var_name_hdf5, xy_shifts[idx], add_to_movie, border_to_0, slices
+                var_name_hdf5, xy_shifts[idx], add_to_movie, border_to_0, slices, dtype
             ])
         else:
             pars.append([
                 f,
                 os.path.splitext(f)[0], resize_fact[idx], remove_init, idx_xy, order, var_name_hdf5,
-                xy_shifts[idx], add_to_movie, border_to_0, slices
+                xy_shifts[idx], add_to_movie, border_to_0, slices, dtype
             ])
 
     # Perform the job using whatever computing framework we're set to use
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            fnames_new = dview.map_async(save_place_holder, pars).get(4294967)
-        else:
-            fnames_new = my_map(dview, save_place_holder, pars)
-    else:
-        fnames_new = list(map(save_place_holder, pars))
-
-    return fnames_new
+    from .cluster import as_executor
+    return as_executor(dview).map(save_place_holder, pars)
 
 
 #%%
 def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: int = 20, dview=None,
-                     add_to_mov=0) -> str:
+                     add_to_mov=0, dtype=None, checksum: bool = False, mem_budget: int = 2**31) -> str:
     """
-    Makes a large file memmap from a number of smaller files
+    Makes a large C order file memmap from a number of smaller files
+
+    The files (in C or F order) are copied by tiles (see save_tiles), so that files in F order are
+    converted to C order in a single pass.
 
     Args:
         mmap_fnames: list of memory mapped files
 
         base_name: string, will be the first portion of name to be solved
 
-        n_chunks: number of chunks in which to subdivide when saving, smaller requires more memory
+        n_chunks: unused, the memory is bounded by mem_budget. Kept for backwards compatibility
 
-        dview: cluster handle
+        dview: cluster handle. If None the tiles are written by several threads
 
-        add_to_mov: (undocumented)
+        add_to_mov: value added to the data. For integer files it is stored in the header instead (see memmap_offset)
+
+        dtype: data type of the joined file (float32, float16 or uint16). If None the data type of the first file
+
+        checksum: bool
+            whether to store the checksum of the data in the header of the file (the file is read once more)
+
+        mem_budget: int
+            maximum memory (in bytes) used by all the workers together
 
     """
 
@@ -187,7 +362,10 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
         Yr, dims, T = load_memmap(f)
         logging.debug((f, T))  # TODO: Add a text header so this isn't just numeric output, but what to say?
         tot_frames += T
+        if dtype is None:
+            dtype = Yr.dtype
         del Yr
+    header = load_memmap_header(mmap_fnames[0]) or {}
 
     d = np.prod(dims)
 
@@ -196,42 +374,46 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
         base_name = mmap_fnames[0]
         base_name = base_name[:base_name.find('_d1_')] + '-#-' + str(len(mmap_fnames))
 
-    fname_tot = memmap_frames_filename(base_name, dims, tot_frames, order)
+    fname_tot = memmap_frames_filename(base_name, dims, tot_frames, order, dtype)
     fname_tot = os.path.join(os.path.split(mmap_fnames[0])[0], fname_tot)
     logging.info("Memmap file for fname_tot: " + str(fname_tot))
 
-    big_mov = np.memmap(fname_tot, mode='w+', dtype=np.float32, shape=prepare_shape((d, tot_frames)), order='C')
-
-    step = np.int(old_div(d, n_chunks))
-    pars = []
-    for ref in range(0, d - step + 1, step):
-        pars.append([fname_tot, d, tot_frames, mmap_fnames, ref, ref + step, add_to_mov])
-
-    if len(pars[-1]) != 7:
-        raise Exception(
-            'You cannot change the number of element in list without changing the statement below (pars[]..)')
-    else:
-        # last batch should include the leftover pixels
-        pars[-1][-2] = d
+    try:
+        # a new file is created, so that existing maps of an older file with the same name stay valid
+        os.unlink(fname_tot)
+    except OSError:
+        pass
+    big_mov = np.memmap(fname_tot, mode='w+', dtype=dtype, shape=prepare_shape((d, tot_frames)), order='C')
+    del big_mov
 
+    offset = header.get('offset', 0)
+    if np.dtype(dtype).kind == 'u':
+        # integer data are copied as they are, the offset is kept in the header
+        offset, add_to_mov = offset + add_to_mov, 0
+    n_workers = _num_workers(dview)
+    pars = tile_pars(mmap_fnames, fname_tot, add_to_mov=add_to_mov, dtype=dtype,
+                     mem_budget=mem_budget // n_workers)
+    logging.debug('Writing {} tiles with {} workers'.format(len(pars), n_workers))
     if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            dview.map_async(save_portion, pars).get(4294967)
-        else:
-            my_map(dview, save_portion, pars)
-
+        from .cluster import as_executor
+        for _ in as_executor(dview).imap_unordered(save_tiles, pars):
+            pass
     else:
-        list(map(save_portion, pars))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(save_tiles, pars))
 
     np.savez(base_name + '.npz', mmap_fnames=mmap_fnames, fname_tot=fname_tot)
+    save_memmap_header(fname_tot, dims, tot_frames, order, dtype, fr=header.get('fr'),
+                       add_to_movie=header.get('add_to_movie', 0) + add_to_mov, checksum=checksum, offset=offset)
 
-    logging.info('Deleting big mov')
-    del big_mov
     sys.stdout.flush()
     return fname_tot
 
 
 def my_map(dv, func, args) -> List:
+    from .cluster import ClusterExecutor
+    if isinstance(dv, ClusterExecutor):
+        return dv.map_sync(func, args)
     v = dv
     rc = v.client
     # scatter 'id', so id=0,1,2 on engines 0,1,2
@@ -275,7 +457,7 @@ def my_map(dv, func, args) -> List:
 def save_portion(pars) -> int:
     # todo: todocument
     use_mmap_save = False
-    big_mov, d, tot_frames, fnames, idx_start, idx_end, add_to_mov = pars
+    big_mov, d, tot_frames, fnames, idx_start, idx_end, add_to_mov, dtype = pars
     Ttot = 0
     Yr_tot = np.zeros((idx_end - idx_start, tot_frames), dtype=np.float32)
     logging.debug("Shape of Yr_tot is " + str(Yr_tot.shape))
@@ -286,11 +468,12 @@ def save_portion(pars) -> int:
                T] = np.ascontiguousarray(Yr[idx_start:idx_end], dtype=np.float32) + np.float32(add_to_mov)
         Ttot = Ttot + T
         del Yr
+    Yr_tot = _to_memmap_dtype(Yr_tot, dtype)
 
     logging.debug("Index start and end are " + str(idx_start) + " and " + str(idx_end))
 
     if use_mmap_save:
-        big_mov = np.memmap(big_mov, mode='r+', dtype=np.float32, shape=prepare_shape((d, tot_frames)), order='C')
+        big_mov = np.memmap(big_mov, mode='r+', dtype=dtype, shape=prepare_shape((d, tot_frames)), order='C')
         big_mov[idx_start:idx_end, :] = Yr_tot
         del big_mov
     else:
@@ -313,13 +496,124 @@ def save_portion(pars) -> int:
     return Ttot
 
 
+def _num_workers(dview) -> int:
+    """ number of workers of a cluster handle, or of local threads if None """
+    if dview is None:
+        return min(4, os.cpu_count() or 1)
+    from .cluster import as_executor
+    return len(as_executor(dview))
+
+
+def _pwrite(fd: int, data, offset: int) -> None:
+    """ positioned write (each worker uses its own file descriptor) """
+    data = memoryview(data).cast('B')
+    while len(data):
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        data, offset = data[written:], offset + written
+
+
+def _transpose_blocked(tile: np.ndarray, block: int = 256) -> np.ndarray:
+    """ C order copy of a F order array, copied by blocks fitting in cache """
+    out = np.empty(tile.shape, dtype=tile.dtype, order='C')
+    for i in range(0, tile.shape[0], block):
+        for j in range(0, tile.shape[1], block):
+            out[i:i + block, j:j + block] = tile[i:i + block, j:j + block]
+    return out
+
+
+def tile_pars(mmap_fnames: List[str], fname_tot: str, add_to_mov: float = 0, dtype=np.float32,
+              mem_budget: int = 2**29) -> List:
+    """ Splits the copy of memory mapped files into a C order file into tiles (see save_tiles)
+
+    Each tile covers a block of frames of one file and a block of pixels. Tiles span at least 1024
+    frames (or the whole file), so that the rows written to the C order file are long, and as many
+    pixels as the memory budget allows, so that the reads from F order files are long as well.
+
+    Args:
+        mmap_fnames: list of str
+            memory mapped files (in C or F order) to be copied one after the other
+
+        fname_tot: str
+            C order memory mapped file (pixels x total number of frames) to fill
+
+        add_to_mov: float
+            value added to the data
+
+        dtype: data type of fname_tot
+
+        mem_budget: int
+            memory (in bytes) used for each tile
+
+    Returns:
+        pars: list
+            parameters of save_tiles, one entry per tile
+    """
+    Ts = []
+    for fname in mmap_fnames:
+        Yr, dims, T = load_memmap(fname)
+        Ts.append(T)
+        del Yr
+    d, tot_frames = int(np.prod(dims)), int(np.sum(Ts))
+    tile_size = max(mem_budget // 12, 1)   # float32 tile, its transpose and the converted copy
+    pars = []
+    for fname, T, frames_offset in zip(mmap_fnames, Ts, np.cumsum([0] + Ts[:-1])):
+        t_step = min(T, max(1024, tile_size // d))
+        idx_step = max(1, min(d, tile_size // t_step))
+        for t_start in range(0, T, t_step):
+            for idx_start in range(0, d, idx_step):
+                pars.append([fname_tot, tot_frames, fname, int(frames_offset), t_start, min(t_start + t_step, T),
+                             idx_start, min(idx_start + idx_step, d), add_to_mov, np.dtype(dtype).name])
+    return pars
+
+
+def save_tiles(pars: List) -> int:
+    """ Copies a tile (block of frames x block of pixels) of a memory mapped file into a C order file
+
+    The tile is read in the layout of the file, transposed by cache sized blocks if the file is in F
+    order, and written with positioned writes, so that several workers can write at the same time.
+
+    Args:
+        pars: list
+            fname_tot, tot_frames, fname, frames_offset, t_start, t_end, idx_start, idx_end, add_to_mov,
+            dtype (see tile_pars)
+
+    Returns:
+        number of frames of the tile
+    """
+    fname_tot, tot_frames, fname, frames_offset, t_start, t_end, idx_start, idx_end, add_to_mov, dtype = pars
+    Yr, _, _ = load_memmap(fname)
+    tile = np.array(Yr[idx_start:idx_end, t_start:t_end], order='K')
+    del Yr
+    if not tile.flags.c_contiguous:
+        tile = _transpose_blocked(tile)
+    if add_to_mov != 0:
+        tile = tile.astype(np.float32) + np.float32(add_to_mov)
+    tile = _to_memmap_dtype(tile, dtype)
+    itemsize = tile.dtype.itemsize
+    fd = os.open(fname_tot, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if t_end - t_start == tot_frames:
+            _pwrite(fd, tile, idx_start * tot_frames * itemsize)
+        else:
+            for row, idx in enumerate(range(idx_start, idx_end)):
+                _pwrite(fd, tile[row], (idx * tot_frames + frames_offset + t_start) * itemsize)
+    finally:
+        os.close(fd)
+    return t_end - t_start
+
+
 #%%
 def save_place_holder(pars: List) -> str:
     """ To use map reduce
     """
     # todo: todocument
 
-    (f, base_name, resize_fact, remove_init, idx_xy, order, var_name_hdf5, xy_shifts, add_to_movie, border_to_0, slices) = pars
+    (f, base_name, resize_fact, remove_init, idx_xy, order, var_name_hdf5, xy_shifts, add_to_movie, border_to_0,
+     slices, dtype) = pars
 
     return save_memmap([f],
                        base_name=base_name,
@@ -331,7 +625,8 @@ def save_place_holder(pars: List) -> str:
                        xy_shifts=xy_shifts,
                        add_to_movie=add_to_movie,
                        border_to_0=border_to_0,
-                       slices=slices)
+                       slices=slices,
+                       dtype=dtype)
 
 
 #%%
@@ -348,12 +643,16 @@ def save_memmap(filenames: List[str],
                 border_to_0=0,
                 dview=None,
                 n_chunks: int = 100,
-                slices=None) -> str:
+                slices=None,
+                dtype=np.float32,
+                fr: Optional[float] = None,
+                checksum: bool = False) -> str:
     """ Efficiently write data from a list of tif files into a memory mappable file
 
     Args:
         filenames: list
-            list of tif files or list of numpy arrays
+            list of tif files or list of numpy arrays. MovieChain entries are replaced by their files,
+            SbxMovie entries (one plane of one channel of a scanbox file) are read as files
 
         base_name: str
             the base used to build the file name. IT MUST NOT CONTAIN "_"
@@ -392,6 +691,20 @@ def save_memmap(filenames: List[str],
             directions. For instance
             slices = [slice(0,200),slice(0,100),slice(0,100)] will take
             the first 200 frames and the 100 pixels along x and y dimensions.
+
+        dtype: data type of the file. float32, float16 or uint16. float16 and uint16 halve the size of
+            the file. uint16 data are rounded and clipped to [0, 65535] and are kept in the data type
+            of the camera: the files are read without converting them to float32, and add_to_movie
+            (with the usual 0.0001) is stored in the header instead of being added to the data (see
+            memmap_offset)
+
+        fr: float
+            frame rate, stored in the header of the file
+
+        checksum: bool
+            whether to store the checksum of the data in the header of the file (the file is read once
+            more, see save_memmap_header)
+
     Returns:
         fname_new: the name of the mapped file, the format is such that
             the name will contain the frame dimensions and the number of frames
@@ -400,15 +713,30 @@ def save_memmap(filenames: List[str],
     if type(filenames) is not list:
         raise Exception('input should be a list of filenames')
 
+    # chains of files (see MovieChain) are memory mapped one file at a time
+    filenames = [part for f in filenames
+                 for part in (f.parts() if isinstance(f, cm.base.movies.MovieChain) else [f])]
+
     if slices is not None:
         slices = [slice(0, None) if sl is None else sl for sl in slices]
 
-    if len(filenames) > 1:
+    # memory mapped files that only need to be converted to C order are copied by tiles
+    only_convert = order == 'C' and all(isinstance(f, str) and f.endswith('.mmap') for f in filenames)\
+        and remove_init == 0 and idx_xy is None and xy_shifts is None and add_to_movie == 0\
+        and border_to_0 == 0 and slices is None and tuple(resize_fact) == (1, 1, 1)
+
+    if len(filenames) > 1 or (only_convert and 'order_C' not in filenames[0]):
         recompute_each_memmap = False
         for file__ in filenames:
-            if ('order_' + order not in file__) or ('.mmap' not in file__):
+            if not isinstance(file__, str) or ('order_' + order not in file__) or ('.mmap' not in file__):
                 recompute_each_memmap = True
 
+        if only_convert:
+            # the frames are copied from the original files, with the offset save_memmap_each would add
+            fname_new = cm.save_memmap_join(filenames, base_name=base_name, dview=dview,
+                                            add_to_mov=np.float32(0.0001) if recompute_each_memmap else 0,
+                                            dtype=dtype, checksum=checksum)
+            return fname_new
 
         if recompute_each_memmap or (remove_init>0) or (idx_xy is not None)\
                 or (xy_shifts is not None) or (add_to_movie != 0) or (border_to_0>0)\
@@ -427,7 +755,8 @@ def save_memmap(filenames: List[str],
                                               idx_xy=idx_xy,
                                               xy_shifts=xy_shifts,
                                               slices=slices,
-                                              add_to_movie=add_to_movie)
+                                              add_to_movie=add_to_movie,
+                                              dtype=dtype)
         else:
             fname_parts = filenames
 
@@ -436,12 +765,13 @@ def save_memmap(filenames: List[str],
             raise Exception('You cannot merge files in F order, they must be in C order for CaImAn')
 
         fname_new = cm.save_memmap_join(fname_parts, base_name=base_name,
-                                        var_name_hdf5=var_name_hdf5,
-                                        dview=dview, n_chunks=n_chunks)
+                                        dview=dview, n_chunks=n_chunks,
+                                        dtype=dtype, checksum=checksum)
 
     else:
         # TODO: can be done online
         Ttot = 0
+        integer_data = np.dtype(dtype).kind == 'u'
         for idx, f in enumerate(filenames):
             if isinstance(f, str):     # Might not always be filenames.
                 logging.debug(f)
@@ -459,8 +789,9 @@ def save_memmap(filenames: List[str],
                         Yr = Yr[remove_init:, idx_xy[0], idx_xy[1], idx_xy[2]]
 
             else:
-                if isinstance(f, basestring) or isinstance(f, list):
-                    Yr = cm.load(f, fr=1, in_memory=True, var_name_hdf5=var_name_hdf5)
+                if isinstance(f, (basestring, list, cm.base.movies.MovieChain, cm.base.movies.SbxMovie)):
+                    Yr = cm.load(f, fr=1, in_memory=True, var_name_hdf5=var_name_hdf5,
+                                 outtype=None if integer_data else np.float32)
                 else:
                     Yr = cm.movie(f)
                 if xy_shifts is not None:
@@ -500,18 +831,25 @@ def save_memmap(filenames: List[str],
             T, dims = Yr.shape[0], Yr.shape[1:]
             Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
             Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
-            Yr = np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+            if integer_data:
+                # the offset is kept in the header, so that the data stay in their data type
+                Yr = _to_memmap_dtype(np.ascontiguousarray(Yr), dtype)
+            else:
+                Yr = np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+                Yr = _to_memmap_dtype(Yr, dtype)
 
             if idx == 0:
+                if np.dtype(dtype) != np.float32:
+                    base_name = base_name + '_dtype_' + np.dtype(dtype).name
                 fname_tot = base_name + '_d1_' + str(
                     dims[0]) + '_d2_' + str(dims[1]) + '_d3_' + str(1 if len(dims) == 2 else dims[2]) + '_order_' + str(
                         order)                                                                                           # TODO: Rewrite more legibly
-                if isinstance(f, str):
+                if isinstance(f, (str, os.PathLike)):
                     fname_tot = os.path.join(os.path.split(f)[0], fname_tot)
                 if len(filenames) > 1:
                     big_mov = np.memmap(fname_tot,
                                         mode='w+',
-                                        dtype=np.float32,
+                                        dtype=dtype,
                                         shape=prepare_shape((np.prod(dims), T)),
                                         order=order)
                     big_mov[:, Ttot:Ttot + T] = Yr
@@ -521,7 +859,7 @@ def save_memmap(filenames: List[str],
                     Yr.tofile(fname_tot)
             else:
                 big_mov = np.memmap(fname_tot,
-                                    dtype=np.float32,
+                                    dtype=dtype,
                                     mode='r+',
                                     shape=prepare_shape((np.prod(dims), Ttot + T)),
                                     order=order)
@@ -539,6 +877,9 @@ def save_memmap(filenames: List[str],
         except OSError:
             pass
         os.rename(fname_tot, fname_new)
+        offset = float(np.float32(0.0001) + np.float32(add_to_movie))
+        save_memmap_header(fname_new, dims, Ttot, order, dtype, fr=fr, add_to_movie=0 if integer_data else offset,
+                           checksum=checksum, offset=offset if integer_data else 0)
 
     return fname_new
 
@@ -558,68 +899,52 @@ def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, t
         b: time x comps
     """
 
-    import pickle
+    from .cluster import as_executor, broadcast, get_memory_budget, release
     pars = []
     d1, d2 = np.shape(A)
-    b = pickle.dumps(b)
+    # b is sent once to the workers rather than with every block
+    b = b.astype(np.float32)
+    executor = as_executor(dview)
+    # each task loads its rows of A, converted to float32 by the product
+    bytes_per_row = d2 * (A.dtype.itemsize + (4 if A.dtype != np.float32 else 0)) + 8 * np.shape(b)[-1]
+    fixed_bytes = 8 * d2 * np.shape(b)[-1] if transpose else 0
+    if 'sparse' in str(type(b)):
+        fixed_bytes += 2 * (b.data.nbytes + b.indices.nbytes + b.indptr.nbytes)
+    plan = get_memory_budget().plan('parallel dot product', bytes_per_row, d1, len(executor),
+                                    fixed_bytes=fixed_bytes, max_size=block_size)
+    block_size = plan.block_size
+    b_handle = broadcast(b, dview)
     logging.debug('parallel dot product block size: ' + str(block_size))
 
     if block_size < d1:
         for idx in range(0, d1 - block_size, block_size):
             idx_to_pass = list(range(idx, idx + block_size))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+            pars.append([A.filename, idx_to_pass, b_handle, transpose])
 
         if (idx + block_size) < d1:
             idx_to_pass = list(range(idx + block_size, d1))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+            pars.append([A.filename, idx_to_pass, b_handle, transpose])
 
     else:
         idx_to_pass = list(range(d1))
-        pars.append([A.filename, idx_to_pass, b, transpose])
+        pars.append([A.filename, idx_to_pass, b_handle, transpose])
 
     logging.debug('Start product')
-    b = pickle.loads(b)
 
     if transpose:
         output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
     else:
         output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
 
-    if dview is None:
-        if transpose:
-            #            b = pickle.loads(b)
-            logging.debug('Transposing')
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
-        else:
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
-
-    else:
-        for itera in range(0, len(pars), num_blocks_per_run):
-
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
-            else:
-                results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
-
-            logging.debug('Processed:' + str([itera, itera + len(results)]))
-
+    # the blocks are added to the output as they are computed, at most num_blocks_per_run at a time
+    try:
+        for iddx, rs in executor.imap_unordered(dot_place_holder, pars, max_pending=num_blocks_per_run, plan=plan):
             if transpose:
-                logging.debug('Transposing')
-
-                for _, res in enumerate(results):
-                    output += res[1]
-
+                output += rs
             else:
-                logging.debug('Filling')
-                for res in results:
-                    output[res[0]] = res[1]
-
-            if 'multiprocessing' not in str(type(dview)):
-                dview.clear()
+                output[iddx] = rs
+    finally:
+        release(b_handle)
 
     return output
 
@@ -628,9 +953,10 @@ def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, t
 def dot_place_holder(par: List) -> Tuple:
     # todo: todocument
 
+    from .cluster import fetch
     A_name, idx_to_pass, b_, transpose = par
     A_, _, _ = load_memmap(A_name)
-    b_ = pickle.loads(b_).astype(np.float32)
+    b_ = fetch(b_)
 
     logging.debug((idx_to_pass[-1]))
     if 'sparse' in str(type(b_)):
@@ -697,3 +1023,328 @@ def save_tif_to_mmap_online(movie_iterable, save_base_name='YrOL_', order='C', a
     big_mov.flush()
     del big_mov
     return fname_tot
+
+
+CHUNKED_STORE_VERSION = 1
+CHUNKED_STORE_LAYOUTS = ('frames', 'pixels')
+
+
+def _chunked_compression(compression: Optional[str]) -> Dict:
+    """ keyword arguments of h5py create_dataset for the compression of a chunked store """
+    if compression is None:
+        return {}
+    if compression == 'blosc':
+        if not HAS_HDF5PLUGIN:
+            raise Exception('blosc compression requires the hdf5plugin package')
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression in ('lzf', 'gzip'):
+        return {'compression': compression, 'shuffle': True}
+    raise Exception('Unknown compression ' + str(compression))
+
+
+def is_chunked_store(filename: str) -> bool:
+    """ whether filename is a chunked store written by save_chunked """
+    if os.path.splitext(str(filename))[1].lower() not in ('.h5', '.hdf5'):
+        return False
+    try:
+        with h5py.File(filename, 'r') as f:
+            return 'chunked_store_version' in f.attrs
+    except OSError:
+        return False
+
+
+def save_chunked(filename: str,
+                 fname_out: Optional[str] = None,
+                 layouts: Tuple = CHUNKED_STORE_LAYOUTS,
+                 compression: Optional[str] = 'lzf',
+                 pixel_chunks: Tuple[int, int, int] = (32, 32, 256),
+                 frame_chunk_bytes: int = 2**20,
+                 dtype=np.float32,
+                 add_to_movie: float = 0,
+                 fr: Optional[float] = None,
+                 var_name_hdf5: str = 'mov') -> str:
+    """ Saves a movie in a chunked and compressed hdf5 store
+
+    The store can hold two copies of the movie: a frame-chunked one (dataset 'mov', shape (T, d1, d2),
+    chunks of whole frames) for reading frames, e.g. for motion correction or online processing,
+    and a pixel-chunked one (dataset 'pixels', shape (d1, d2, T), chunks of pixel_chunks) for reading
+    the whole time trace of a patch of pixels, e.g. for the processing in patches. Since calcium
+    imaging data compresses well, both compressed copies usually take less space than one raw memory
+    mapped file. The store is read with ChunkedStore (or load_chunked), that reads from the layout
+    which touches fewer bytes for each access, and can also be read with load and MovieReader.
+
+    Args:
+        filename: str
+            name of the movie to save in the store (any format that MovieReader can read)
+
+        fname_out: str
+            name of the store. If None the extension of filename is replaced by '_chunked.h5'
+
+        layouts: tuple
+            layouts to save, among 'frames' and 'pixels'
+
+        compression: str
+            'lzf', 'gzip', 'blosc' (lz4, requires the hdf5plugin package) or None
+
+        pixel_chunks: tuple
+            chunk shape (rows, columns, frames) of the pixel-chunked layout
+
+        frame_chunk_bytes: int
+            approximate size of a chunk of the frame-chunked layout (a number of whole frames)
+
+        dtype: data type
+            data type of the store, one of float32, float16 or uint16
+
+        add_to_movie: float
+            value added to the movie
+
+        fr: float
+            frame rate, stored as an attribute
+
+        var_name_hdf5: str
+            name of the dataset if filename is an hdf5 file
+
+    Returns:
+        fname_out: str
+            name of the store
+    """
+    layouts = tuple(layouts)
+    if not layouts or any(layout not in CHUNKED_STORE_LAYOUTS for layout in layouts):
+        raise Exception('layouts must be a non empty subset of ' + str(CHUNKED_STORE_LAYOUTS))
+    dtype = np.dtype(dtype)
+    if dtype.name not in MEMMAP_DTYPES:
+        raise Exception('Unsupported data type ' + dtype.name)
+    if fname_out is None:
+        fname_out = os.path.splitext(str(filename))[0] + '_chunked.h5'
+    comp = _chunked_compression(compression)
+
+    with cm.base.movies.MovieReader(filename, var_name_hdf5=var_name_hdf5, cache_size=0,
+                                    outtype=None) as reader:
+        T = reader.shape[0]
+        dims = tuple(int(d) for d in reader.dims)
+        if len(dims) != 2:
+            raise Exception('Chunked stores only support 2D movies')
+        pix_chunks = (min(pixel_chunks[0], dims[0]), min(pixel_chunks[1], dims[1]), min(pixel_chunks[2], T))
+        frame_chunks = (int(np.clip(frame_chunk_bytes // (np.prod(dims) * dtype.itemsize), 1, T)),) + dims
+        with h5py.File(fname_out, 'w') as f:
+            f.attrs['chunked_store_version'] = CHUNKED_STORE_VERSION
+            f.attrs['dims'] = dims
+            f.attrs['T'] = T
+            f.attrs['add_to_movie'] = add_to_movie
+            f.attrs['fr'] = np.nan if fr is None else fr
+            f.attrs['layouts'] = ','.join(layouts)
+            datasets = {}
+            if 'frames' in layouts:
+                datasets['frames'] = f.create_dataset('mov', shape=(T,) + dims, dtype=dtype,
+                                                      chunks=frame_chunks, **comp)
+            if 'pixels' in layouts:
+                datasets['pixels'] = f.create_dataset('pixels', shape=dims + (T,), dtype=dtype,
+                                                      chunks=pix_chunks, **comp)
+            # blocks of whole time chunks of the pixel layout, so that every chunk is written once
+            block = pix_chunks[2] * max(1, frame_chunks[0] // pix_chunks[2])
+            for t0 in range(0, T, block):
+                t1 = min(t0 + block, T)
+                frames = reader[t0:t1]
+                if add_to_movie != 0:
+                    frames = frames + add_to_movie
+                frames = _to_memmap_dtype(frames, dtype)
+                if 'frames' in datasets:
+                    datasets['frames'][t0:t1] = frames
+                if 'pixels' in datasets:
+                    datasets['pixels'][:, :, t0:t1] = frames.transpose(1, 2, 0)
+
+    return fname_out
+
+
+def _axis_key(key, n: int) -> Tuple[int, int, Any]:
+    """ bounding range [lo, hi) of an index along an axis of length n, and the index relative to lo """
+    if isinstance(key, (int, np.integer)):
+        k = int(key) + n if key < 0 else int(key)
+        if not 0 <= k < n:
+            raise IndexError('index ' + str(key) + ' is out of bounds for axis of size ' + str(n))
+        return k, k + 1, 0
+    if isinstance(key, slice):
+        start, stop, step = key.indices(n)
+        if step > 0:
+            stop = max(stop, start)
+            return start, stop, slice(0, stop - start, step)
+        key = np.arange(start, stop, step)
+    idx = np.asarray(key)
+    if idx.dtype == bool:
+        idx = np.nonzero(idx)[0]
+    idx = np.where(idx < 0, idx + n, idx).astype(np.int64)
+    if idx.size == 0:
+        return 0, 0, idx
+    lo, hi = int(idx.min()), int(idx.max()) + 1
+    if lo < 0 or hi > n:
+        raise IndexError('index out of bounds for axis of size ' + str(n))
+    return lo, hi, idx - lo
+
+
+def _select_box(box: np.ndarray, subs: List) -> np.ndarray:
+    """ applies the per-axis (orthogonal) selections subs to the array read from a bounding box """
+    for axis in range(len(subs) - 1, -1, -1):
+        sub = subs[axis]
+        if isinstance(sub, slice):
+            if sub != slice(0, box.shape[axis], 1):
+                box = box[(slice(None),) * axis + (sub,)]
+        else:
+            box = np.take(box, sub, axis=axis)
+    return box
+
+
+class ChunkedStore(object):
+    """
+    Reader of the chunked stores written by save_chunked.
+
+    It can be indexed like an array of shape (T, d1, d2) (with orthogonal indexing when several axes
+    are indexed by arrays) and reads from the frame-chunked or from the pixel-chunked layout,
+    whichever touches fewer bytes. The pixels method (and the Yr attribute) give the pixel rows of the
+    movie as in the (d1*d2, T) matrix returned by load_memmap, read from the pixel-chunked layout.
+
+    Example:
+        store = ChunkedStore('movie_chunked.h5')
+        frame = store[100]                   # read from the frame-chunked layout
+        patch = store[:, 10:50, 20:60]       # read from the pixel-chunked layout
+        Yr = store.Yr[idx_pixels]            # rows of the pixels idx_pixels (in F order)
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = str(filename)
+        self.f = h5py.File(self.filename, 'r')
+        if 'chunked_store_version' not in self.f.attrs:
+            self.f.close()
+            raise Exception(self.filename + ' is not a chunked store')
+        self.frames = self.f['mov'] if 'mov' in self.f else None
+        self.pixel_data = self.f['pixels'] if 'pixels' in self.f else None
+        self.dims = tuple(int(d) for d in self.f.attrs['dims'])
+        self.T = int(self.f.attrs['T'])
+        self.shape = (self.T,) + self.dims
+        self.dtype = (self.frames if self.frames is not None else self.pixel_data).dtype
+        self.add_to_movie = float(self.f.attrs['add_to_movie'])
+        self.Yr = _ChunkedPixels(self)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.T
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    @staticmethod
+    def _cost(dataset, bounds: List[Tuple[int, int]]) -> float:
+        """ bytes of the chunks of dataset touched by the bounding box bounds """
+        if dataset is None:
+            return np.inf
+        n_chunks = 1
+        for (lo, hi), c in zip(bounds, dataset.chunks):
+            if hi <= lo:
+                return 0
+            n_chunks *= (hi - 1) // c - lo // c + 1
+        return n_chunks * np.prod(dataset.chunks)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            pos = [k is Ellipsis for k in key].index(True)
+            key = key[:pos] + (slice(None),) * (3 - len(key) + 1) + key[pos + 1:]
+        if len(key) > 3:
+            raise IndexError('too many indices for a chunked store')
+        key = key + (slice(None),) * (3 - len(key))
+        bounds, subs = [], []
+        for k, n in zip(key, self.shape):
+            lo, hi, sub = _axis_key(k, n)
+            bounds.append((lo, hi))
+            subs.append(sub)
+        (t0, t1), (r0, r1), (c0, c1) = bounds
+        pixel_bounds = [(r0, r1), (c0, c1), (t0, t1)]
+        if self._cost(self.pixel_data, pixel_bounds) < self._cost(self.frames, bounds):
+            box = self.pixel_data[r0:r1, c0:c1, t0:t1].transpose(2, 0, 1)
+        else:
+            box = self.frames[t0:t1, r0:r1, c0:c1]
+        return _select_box(box, subs)
+
+    def pixels(self, idx, frames=slice(None)) -> np.ndarray:
+        """ Rows of the pixels idx (indices in F order, as the rows of Yr) for the frames frames
+
+        Args:
+            idx: array of int
+                pixel indices in F order (the row indices of the matrix returned by load_memmap)
+
+            frames: slice, int or array
+                frames to read
+
+        Returns:
+            Y: np.ndarray
+                array of shape (len(idx), number of frames)
+        """
+        idx = np.asarray(idx, dtype=np.int64).ravel()
+        t0, t1, tsub = _axis_key(frames, self.T)
+        if self.pixel_data is None:
+            # no pixel layout: read the frames and pick the pixels
+            Y = np.reshape(self.frames[t0:t1].transpose(1, 2, 0), (-1, t1 - t0), order='F')[idx]
+            return _select_box(Y, [slice(None), tsub])
+        rows, cols = np.unravel_index(idx, self.dims, order='F')
+        ch_r, ch_c = self.pixel_data.chunks[:2]
+        Y = np.zeros((len(idx), t1 - t0), dtype=self.dtype)
+        # read one spatial chunk at a time, so that only the chunks containing the pixels are read
+        chunk_id = (rows // ch_r) * (self.dims[1] // ch_c + 1) + cols // ch_c
+        for ch in np.unique(chunk_id):
+            sel = np.where(chunk_id == ch)[0]
+            r0, r1 = rows[sel].min(), rows[sel].max() + 1
+            c0, c1 = cols[sel].min(), cols[sel].max() + 1
+            box = self.pixel_data[r0:r1, c0:c1, t0:t1]
+            Y[sel] = box[rows[sel] - r0, cols[sel] - c0]
+        return _select_box(Y, [slice(None), tsub])
+
+
+class _ChunkedPixels(object):
+    """ (d1*d2, T) view of a ChunkedStore, indexed like the matrix Yr returned by load_memmap """
+
+    def __init__(self, store: ChunkedStore) -> None:
+        self.store = store
+        self.shape = (int(np.prod(store.dims)), store.T)
+        self.dtype = store.dtype
+        self.ndim = 2
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows = key[0]
+        frames = key[1] if len(key) > 1 else slice(None)
+        if isinstance(rows, (int, np.integer)):
+            return self.store.pixels([rows], frames)[0]
+        return self.store.pixels(np.arange(self.shape[0])[rows], frames)
+
+
+def load_chunked(filename: str) -> Tuple[Any, Tuple, int]:
+    """ Load a chunked store written by save_chunked, like load_memmap
+
+    Args:
+        filename: str
+            name of the store
+
+    Returns:
+        Yr: (d1*d2, T) view of the store, indexed like the memory mapped matrix of load_memmap
+            (the store itself is Yr.store)
+
+        dims: tuple
+            dimensions of the FOV
+
+        T: int
+            number of frames
+    """
+    store = ChunkedStore(filename)
+    return store.Yr, store.dims, store.T
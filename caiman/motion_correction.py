@@ -48,14 +48,18 @@ import collections
 import cv2
 import gc
 import h5py
+import hashlib
 import itertools
 import logging
 import numpy as np
 from numpy.fft import ifftshift
 import os
+import pickle
 import pylab as pl
+from scipy import fft as scipy_fft
+import shutil
 import tifffile
-from typing import List, Optional
+from typing import Dict, List, Optional
 from skimage.transform import resize as resize_sk
 from skimage.transform import warp as warp_sk
 
@@ -63,7 +67,7 @@ import caiman as cm
 import caiman.base.movies
 import caiman.motion_correction
 from caiman.paths import memmap_frames_filename
-from .mmapping import prepare_shape
+from .mmapping import prepare_shape, save_memmap_header, _to_memmap_dtype
 
 try:
     cv2.setNumThreads(0)
@@ -82,6 +86,12 @@ try:
 except ImportError:
     HAS_CUDA = False
 
+try:
+    import pyfftw
+    HAS_PYFFTW = True
+except ImportError:
+    HAS_PYFFTW = False
+
 try:
     profile
 except:
@@ -98,13 +108,15 @@ class MotionCorrect(object):
                  strides=(96, 96), overlaps=(32, 32), splits_els=14, num_splits_to_process_els=None,
                  upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv=True, nonneg_movie=True, gSig_filt=None,
                  use_cuda=False, border_nan=True, pw_rigid=False, num_frames_split=80, var_name_hdf5='mov',is3D=False,
-                 indices=(slice(None), slice(None))):
+                 indices=(slice(None), slice(None)), use_fftw=False, fftw_wisdom=None, resume=False,
+                 pyramid_levels=0, mmap_dtype='float32'):
         """
         Constructor class for motion correction operations
 
         Args:
            fname: str
-               path to file to motion correct
+               path to file to motion correct. A MovieChain, or an SbxMovie to correct one plane of
+               one channel of a scanbox file, can be given in place of a path
 
            min_mov: int16 or float32
                estimated minimum value of the movie to produce an output that is positive
@@ -173,6 +185,30 @@ class MotionCorrect(object):
             indices: tuple(slice), default: (slice(None), slice(None))
                Use that to apply motion correction only on a part of the FOV
 
+            use_fftw: bool, default: False
+               Compute the FFTs of the registration with pyFFTW plans (if available)
+
+            fftw_wisdom: str, default: None
+               File where the pyFFTW wisdom is loaded from and stored to
+
+            resume: bool, default: False
+               Resume an interrupted run. Each chunk of frames saved in a
+               memory mapped file is recorded (with its shifts and template)
+               in a journal directory next to the file. If resume is True and
+               the file exists, the recorded chunks are not processed again
+               and their shifts are read from the journal
+
+            pyramid_levels: int, default: 0
+               Number of levels (each downsampling by 2) of the coarse-to-fine
+               search of the rigid shifts, and of the bootstrapping of the
+               template. Useful for large max_shifts. 0 searches at full resolution
+
+            mmap_dtype: str, default: 'float32'
+               Data type of the memory mapped files of the corrected movie
+               ('float32', 'float16' or 'uint16'). uint16 files keep the data
+               of 16 bit cameras at half the size, with the offset added to
+               the movie stored in the header (see mmapping.memmap_offset)
+
        Returns:
            self
 
@@ -207,10 +243,15 @@ class MotionCorrect(object):
         self.var_name_hdf5 = var_name_hdf5
         self.is3D = is3D
         self.indices = indices
+        self.use_fftw = use_fftw
+        self.fftw_wisdom = fftw_wisdom
+        self.resume = resume
+        self.pyramid_levels = pyramid_levels
+        self.mmap_dtype = mmap_dtype
         if self.use_cuda and not HAS_CUDA:
             logging.debug("pycuda is unavailable. Falling back to default FFT.")
 
-    def motion_correct(self, template=None, save_movie=False):
+    def motion_correct(self, template=None, save_movie=False, order='F', base_name=None, border_to_0=0):
         """general function for performing all types of motion correction. The
         function will perform either rigid or piecewise rigid motion correction
         depending on the attribute self.pw_rigid and will perform high pass
@@ -225,6 +266,19 @@ class MotionCorrect(object):
             save_movie: bool, default: False
                 flag for saving motion corrected file(s) as memory mapped file(s)
 
+            order: 'F' or 'C', default: 'F'
+                'F' saves one memory mapped file per input file. 'C' saves all
+                the files in a single C order memory mapped file that can be
+                used directly by CNMF (same format as mmapping.save_memmap
+                with order='C'), without a second pass over the data
+
+            base_name: str, default: None
+                base of the name of the C order file (default: first file name)
+
+            border_to_0: int, default: 0
+                number of pixels on each border set to the min of the movie
+                in the C order file (see _movie_min)
+
         Returns:
             self
         """
@@ -240,8 +294,20 @@ class MotionCorrect(object):
                     for m_ in cm.load(self.fname[0], var_name_hdf5=self.var_name_hdf5,
                                       subindices=slice(400))]).min()
 
+        if save_movie and order == 'C':
+            out_memmap = self.create_memmap_C(base_name)
+        else:
+            out_memmap = None
+        # the same border value for all the chunks of all the files
+        if out_memmap and border_to_0 > 0:
+            border_value = _movie_min(self.fname, var_name_hdf5=self.var_name_hdf5, is3D=self.is3D,
+                                      indices=self.indices)
+        else:
+            border_value = None
+
         if self.pw_rigid:
-            self.motion_correct_pwrigid(template=template, save_movie=save_movie)
+            self.motion_correct_pwrigid(template=template, save_movie=save_movie, out_memmap=out_memmap,
+                                        border_to_0=border_to_0, border_value=border_value)
             if self.is3D:
                 # TODO - error at this point after saving
                 b0 = np.ceil(np.max([np.max(np.abs(self.x_shifts_els)),
@@ -251,13 +317,48 @@ class MotionCorrect(object):
                 b0 = np.ceil(np.maximum(np.max(np.abs(self.x_shifts_els)),
                                     np.max(np.abs(self.y_shifts_els))))
         else:
-            self.motion_correct_rigid(template=template, save_movie=save_movie)
+            self.motion_correct_rigid(template=template, save_movie=save_movie, out_memmap=out_memmap,
+                                      border_to_0=border_to_0, border_value=border_value)
             b0 = np.ceil(np.max(np.abs(self.shifts_rig)))
         self.border_to_0 = b0.astype(np.int)
         self.mmap_file = self.fname_tot_els if self.pw_rigid else self.fname_tot_rig
         return self
 
-    def motion_correct_rigid(self, template=None, save_movie=False) -> None:
+    def create_memmap_C(self, base_name=None):
+        """ create the C order memory mapped file (pixels x time) in which the
+        corrected frames of all the files are saved
+
+        Args:
+            base_name: str, default: None
+                base of the file name (default: name of the first file)
+
+        Returns:
+            out_memmap: tuple
+                name and shape of the file, index of the first frame of each file
+        """
+        dims_T = [cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=self.var_name_hdf5)
+                  for fname in self.fname]
+        dims = np.zeros(dims_T[0][0])[self.indices].shape
+        frames = [T for _, T in dims_T]
+        if base_name is None:
+            base_name = os.path.split(self.fname[0])[-1][:-4] + ('_els_' if self.pw_rigid else '_rig_')
+        dtype = np.dtype(self.mmap_dtype)
+        fname_tot = os.path.join(os.path.split(self.fname[0])[0],
+                                 memmap_frames_filename(base_name, dims, sum(frames), 'C', dtype))
+        shape_mov = (np.prod(dims), sum(frames))
+        if self.resume and os.path.exists(fname_tot) and \
+                os.path.getsize(fname_tot) == np.prod(shape_mov) * dtype.itemsize:
+            logging.info('Resuming saving file {}'.format(fname_tot))
+        else:
+            np.memmap(fname_tot, mode='w+', dtype=dtype, shape=prepare_shape(shape_mov), order='C')
+            save_memmap_header(fname_tot, dims, sum(frames), 'C', dtype,
+                               offset=_memmap_offset(dtype, -self.min_mov, self.nonneg_movie, 'C'))
+            _reset_journal(fname_tot)
+            logging.info('Saving file as {}'.format(fname_tot))
+        return fname_tot, shape_mov, np.cumsum([0] + frames[:-1])
+
+    def motion_correct_rigid(self, template=None, save_movie=False, out_memmap=None, border_to_0=0,
+                             border_value=None) -> None:
         """
         Perform rigid motion correction
 
@@ -268,6 +369,16 @@ class MotionCorrect(object):
             save_movie_rigid:Bool
                 save the movies vs just get the template
 
+            out_memmap: tuple
+                output of create_memmap_C. If provided, the movies are saved in
+                that C order file instead of one F order file per movie
+
+            border_to_0: int
+                number of pixels on each border set to the min of the movie when saving
+
+            border_value: float
+                value of the border pixels (default: see _movie_min)
+
         Important Fields:
             self.fname_tot_rig: name of the mmap file saved
 
@@ -284,7 +395,8 @@ class MotionCorrect(object):
         self.fname_tot_rig:List = []
         self.shifts_rig:List = []
 
-        for fname_cur in self.fname:
+        out_fname, out_shape, offsets = out_memmap if out_memmap else (None, None, [0] * len(self.fname))
+        for fname_cur, frames_offset in zip(self.fname, offsets):
             _fname_tot_rig, _total_template_rig, _templates_rig, _shifts_rig = motion_correct_batch_rigid(
                 fname_cur,
                 self.max_shifts,
@@ -302,7 +414,18 @@ class MotionCorrect(object):
                 border_nan=self.border_nan,
                 var_name_hdf5=self.var_name_hdf5,
                 is3D=self.is3D,
-                indices=self.indices)
+                indices=self.indices,
+                use_fftw=self.use_fftw,
+                fftw_wisdom=self.fftw_wisdom,
+                order='C' if out_memmap else 'F',
+                out_fname=out_fname,
+                out_shape=out_shape,
+                frames_offset=frames_offset,
+                border_to_0=border_to_0,
+                border_value=border_value,
+                resume=self.resume,
+                pyramid_levels=self.pyramid_levels,
+                mmap_dtype=self.mmap_dtype)
             if template is None:
                 self.total_template_rig = _total_template_rig
 
@@ -310,7 +433,8 @@ class MotionCorrect(object):
             self.fname_tot_rig += [_fname_tot_rig]
             self.shifts_rig += _shifts_rig
 
-    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False) -> None:
+    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False,
+                               out_memmap=None, border_to_0:int=0, border_value=None) -> None:
         """Perform pw-rigid motion correction
 
         Args:
@@ -323,6 +447,16 @@ class MotionCorrect(object):
             show_template: boolean
                 whether to show the updated template at each iteration
 
+            out_memmap: tuple
+                output of create_memmap_C. If provided, the movies are saved in
+                that C order file instead of one F order file per movie
+
+            border_to_0: int
+                number of pixels on each border set to the min of the movie when saving
+
+            border_value: float
+                value of the border pixels (default: see _movie_min)
+
         Important Fields:
             self.fname_tot_els: name of the mmap file saved
             self.templates_els: template updated by iterating  over the chunks
@@ -353,7 +487,8 @@ class MotionCorrect(object):
             self.z_shifts_els:List = []
 
         self.coord_shifts_els:List = []
-        for name_cur in self.fname:
+        out_fname, out_shape, offsets = out_memmap if out_memmap else (None, None, [0] * len(self.fname))
+        for name_cur, frames_offset in zip(self.fname, offsets):
             _fname_tot_els, new_template_els, _templates_els,\
                 _x_shifts_els, _y_shifts_els, _z_shifts_els, _coord_shifts_els = motion_correct_batch_pwrigid(
                     name_cur, self.max_shifts, self.strides, self.overlaps, -self.min_mov,
@@ -362,7 +497,10 @@ class MotionCorrect(object):
                     num_splits_to_process=None, num_iter=num_iter, template=self.total_template_els,
                     shifts_opencv=self.shifts_opencv, save_movie=save_movie, nonneg_movie=self.nonneg_movie, gSig_filt=self.gSig_filt,
                     use_cuda=self.use_cuda, border_nan=self.border_nan, var_name_hdf5=self.var_name_hdf5, is3D=self.is3D,
-                    indices=self.indices)
+                    indices=self.indices, use_fftw=self.use_fftw, fftw_wisdom=self.fftw_wisdom,
+                    order='C' if out_memmap else 'F', out_fname=out_fname, out_shape=out_shape,
+                    frames_offset=frames_offset, border_to_0=border_to_0, border_value=border_value,
+                    resume=self.resume, pyramid_levels=self.pyramid_levels, mmap_dtype=self.mmap_dtype)
             if not self.is3D:
                 if show_template:
                     pl.imshow(new_template_els)
@@ -926,13 +1064,17 @@ def motion_correct_iteration(img, template, frame_num, max_shift_w=25,
 
 @profile
 def motion_correct_iteration_fast(img, template, max_shift_w=10, max_shift_h=10):
-    """ For using in online realtime scenarios """
+    """ For using in online realtime scenarios. template can be an ndarray
+    or a TemplateRegistrar (the cropped template is then cached across calls) """
     h_i, w_i = template.shape
     ms_h = max_shift_h
     ms_w = max_shift_w
 
-    templ_crop = template[max_shift_h:h_i - max_shift_h,
-                          max_shift_w:w_i - max_shift_w].astype(np.float32)
+    if isinstance(template, TemplateRegistrar):
+        templ_crop = template.cropped_template(max_shift_h, max_shift_w)
+    else:
+        templ_crop = template[max_shift_h:h_i - max_shift_h,
+                              max_shift_w:w_i - max_shift_w].astype(np.float32)
 
     res = cv2.matchTemplate(img, templ_crop, cv2.TM_CCORR_NORMED)
     top_left = cv2.minMaxLoc(res)[3]
@@ -1270,6 +1412,51 @@ def _upsampled_dft(data, upsampled_region_size,
     return output
 
 
+def _upsampled_dft_batch(data, upsampled_region_size,
+                         upsample_factor=1, axis_offsets=None):
+    """
+    Upsampled DFT by matrix multiplication for a stack of 2D arrays.
+
+    Equivalent to calling _upsampled_dft on every element of data with its
+    own offsets, but the kernels of all the elements are built at once and
+    the products are computed with batched matrix multiplications.
+
+    Args:
+        data : 3D ndarray
+            stack of DFTs (N x H x W) to upsample
+
+        upsampled_region_size : integer
+            size of the (square) region to be sampled
+
+        upsample_factor : integer, optional
+            The upsampling factor.  Defaults to 1.
+
+        axis_offsets : ndarray, optional
+            N x 2 array with the offsets of the region to be sampled for each
+            element of the stack. Defaults to None (uses image center)
+
+    Returns:
+        output : 3D ndarray
+            N x upsampled_region_size x upsampled_region_size upsampled DFTs
+    """
+    num_frames, d1, d2 = data.shape
+    if axis_offsets is None:
+        axis_offsets = np.zeros((num_frames, 2))
+    axis_offsets = np.reshape(axis_offsets, (num_frames, 2))
+    region = np.arange(int(upsampled_region_size))
+
+    row_kernel = np.exp(
+        (-1j * 2 * np.pi / (d1 * upsample_factor)) *
+        (region[None, :, None] - axis_offsets[:, 0, None, None]) *
+        (ifftshift(np.arange(d1)) - np.floor(d1 / 2))[None, None, :])
+    col_kernel = np.exp(
+        (-1j * 2 * np.pi / (d2 * upsample_factor)) *
+        (ifftshift(np.arange(d2)) - np.floor(d2 / 2))[None, :, None] *
+        (region[None, None, :] - axis_offsets[:, 1, None, None]))
+
+    return np.matmul(np.matmul(row_kernel, data), col_kernel)
+
+
 def _compute_phasediff(cross_correlation_max):
     """
     Compute global phase difference between the two images (should be zero if images are non-negative).
@@ -1749,6 +1936,410 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+
+def _shift_mask(size, shift_lb=None, shift_ub=None, max_shift=None):
+    """ boolean mask of the admissible (whole pixel) shifts along one axis of
+    the cross correlation, same conventions as register_translation """
+    mask = np.ones(size, dtype=bool)
+    if (shift_lb is not None) or (shift_ub is not None):
+        if (shift_lb < 0) and (shift_ub >= 0):
+            mask[shift_ub:shift_lb] = False
+        else:
+            mask[:shift_lb] = False
+            mask[shift_ub:] = False
+    else:
+        mask[max_shift:-max_shift] = False
+    return mask
+
+
+def register_translation_batch(src_images, target_image, upsample_factor=1,
+                               shifts_lb=None, shifts_ub=None, max_shifts=(10, 10)):
+    """
+    Batched version of register_translation: registers a stack of 2D images
+    to the same target image.
+
+    The forward FFTs, the cross-power spectra, the peak search and the
+    refinement with the upsampled DFT are computed for all the images at
+    once. The spectrum of the target is computed only once per call. When
+    registering several stacks to the same target use TemplateRegistrar
+    directly.
+
+    Args:
+        src_images : ndarray
+            N x H x W stack of images to register
+
+        target_image : ndarray
+            H x W reference image
+
+        upsample_factor : int, optional
+            Upsampling factor. Images will be registered to within
+            ``1 / upsample_factor`` of a pixel. Default is 1 (no upsampling)
+
+        shifts_lb, shifts_ub : ndarray, optional
+            lower and upper bounds on the shifts, either common to all images
+            (length 2) or one per image (N x 2)
+
+        max_shifts : tuple
+            max shifts in x and y, used when bounds are not provided
+
+    Returns:
+        shifts : ndarray
+            N x 2 array of shifts (in pixels) required to register each image
+            with ``target_image``
+
+        src_freq : ndarray
+            N x H x W scaled DFTs of the images (as returned by register_translation)
+
+        phasediff : ndarray
+            global phase difference between each image and the target
+
+    Raises:
+        ValueError "Error: images must really be same size for "
+                         "register_translation_batch"
+    """
+    registrar = TemplateRegistrar(target_image, upsample_factor=upsample_factor, max_shifts=max_shifts)
+    return registrar.register_batch(src_images, shifts_lb=shifts_lb, shifts_ub=shifts_ub)
+
+
+def _downsample_mean(images, factor):
+    """ downsample the last two axes of images by averaging factor x factor
+    blocks (the pixels that do not fill a block are discarded) """
+    h, w = (d // factor for d in images.shape[-2:])
+    images = images[..., :h * factor, :w * factor]
+    return images.reshape(images.shape[:-2] + (h, factor, w, factor)).mean(axis=(-3, -1))
+
+
+class TemplateRegistrar(object):
+    """
+    Registration of 2D images to a fixed template, or to a fixed stack of
+    templates (e.g. the patches of a template for pw-rigid registration).
+
+    Everything that depends only on the template and on the registration
+    parameters is computed once (at first use) and reused for every image:
+    the spectrum of the template, the frequency grids, the kernels of the
+    upsampled DFT and the masks of the admissible shifts. The registrar of
+    the patches of the template (for pw-rigid registration) is cached as well.
+    Optionally the FFTs are computed with pyFFTW plans, whose wisdom can be
+    persisted to disk so that the planning cost is paid only once.
+
+    Registering an image gives the same results as register_translation with
+    target_image set to the template (up to the precision of dtype).
+
+    For large shifts a coarse-to-fine search can be used (pyramid_levels > 0):
+    the shifts are first estimated on images downsampled by 2**pyramid_levels,
+    and then searched at full resolution only inside a window of +/-
+    2**pyramid_levels pixels around the coarse estimate.
+    """
+
+    def __init__(self, template, upsample_factor=10, max_shifts=(10, 10),
+                 use_fftw=False, fftw_wisdom=None, dtype=np.float64, pyramid_levels=0):
+        """
+        Args:
+            template: ndarray
+                reference image (2D) or stack of reference images (... x H x W)
+
+            upsample_factor: int
+                images are registered to within 1/upsample_factor of a pixel
+
+            max_shifts: tuple
+                max shifts in x and y, used when bounds are not provided
+
+            use_fftw: bool
+                compute the FFTs with pyFFTW plans (if available)
+
+            fftw_wisdom: str
+                path to the file used to load/store the pyFFTW wisdom
+
+            dtype: np.float32 or np.float64
+                precision of images, spectra and kernels
+
+            pyramid_levels: int
+                number of levels (each downsampling by 2) of the coarse-to-fine
+                search. 0 searches the shifts at full resolution only
+        """
+        if template.ndim < 2:
+            raise NotImplementedError("TemplateRegistrar only supports 2D images")
+
+        self.dtype = np.dtype(dtype)
+        self.template = np.asarray(template, dtype=self.dtype)
+        self.shape = self.template.shape[-2:]
+        self.size = int(np.prod(self.shape))
+        self.upsample_factor = upsample_factor
+        self.max_shifts = max_shifts
+        self.use_fftw = use_fftw and HAS_PYFFTW
+        self.fftw_wisdom = fftw_wisdom
+        self.pyramid_levels = pyramid_levels
+        if use_fftw and not HAS_PYFFTW:
+            logging.debug("pyfftw is unavailable. Falling back to scipy.fft")
+        if self.use_fftw and fftw_wisdom is not None and os.path.exists(fftw_wisdom):
+            with open(fftw_wisdom, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        self._plans:Dict = {}
+        self._masks:Dict = {}
+        self._patches:Dict = {}
+        self._crops:Dict = {}
+        self._template_freq = None
+        self._template_mean = None
+        self._kernels:Dict = {}
+        self._coarse = None
+        # frequencies of the (scaled) DFT along each axis
+        self.freqs = [ifftshift(np.arange(d)) - np.floor(d / 2) for d in self.shape]
+        self.upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+
+    @property
+    def template_freq(self):
+        """ scaled DFT of the template (computed at first use) """
+        if self._template_freq is None:
+            self._template_mean, self._template_freq = self._centered_fft2(self.template)
+        return self._template_freq
+
+    def _centered_fft2(self, x):
+        """ scaled DFT of images that are centered before the transform, so
+        that an offset (e.g. add_to_movie) does not swamp the signal in the
+        rounding errors of single precision. Returns the means (float64) and
+        the spectra, with the DC term set to the exact mean """
+        x = np.asarray(x)
+        means = x.mean(axis=(-2, -1), dtype=np.float64)
+        freq = self.fft2((x - means[..., None, None]).astype(self.dtype)) / self.size
+        freq[..., 0, 0] = means
+        return means, freq
+
+    def _region_kernels(self, region_size, upsample_factor):
+        """ offset independent factors of the matrix multiply DFT kernels (cached) """
+        key = (region_size, upsample_factor)
+        if key not in self._kernels:
+            region = np.arange(region_size)
+            row_kernel = np.exp((-1j * 2 * np.pi / (self.shape[0] * upsample_factor)) *
+                                region[:, None] * self.freqs[0][None, :])
+            col_kernel = np.exp((-1j * 2 * np.pi / (self.shape[1] * upsample_factor)) *
+                                self.freqs[1][:, None] * region[None, :])
+            self._kernels[key] = (row_kernel, col_kernel)
+        return self._kernels[key]
+
+    def _dft_region(self, image_product, region_size, upsample_factor, sample_region_offset):
+        """ unnormalized cross-correlations sampled on a region_size x region_size
+        grid of spacing 1/upsample_factor, starting at -sample_region_offset
+        (one offset per image, in units of the grid) """
+        shape = self.shape
+        row_kernel, col_kernel = self._region_kernels(region_size, upsample_factor)
+        row_kernel = (row_kernel[None] * np.exp(
+            (1j * 2 * np.pi / (shape[0] * upsample_factor)) *
+            sample_region_offset[:, 0, None, None] * self.freqs[0][None, None, :])).astype(image_product.dtype)
+        col_kernel = (col_kernel[None] * np.exp(
+            (1j * 2 * np.pi / (shape[1] * upsample_factor)) *
+            sample_region_offset[:, 1, None, None] * self.freqs[1][None, :, None])).astype(image_product.dtype)
+        return np.matmul(np.matmul(row_kernel, image_product.conj()), col_kernel).conj()
+
+    @property
+    def coarse_registrar(self):
+        """ registrar of the downsampled template (coarse-to-fine search) """
+        if self._coarse is None:
+            factor = 2 ** self.pyramid_levels
+            self._coarse = TemplateRegistrar(
+                _downsample_mean(self.template, factor), upsample_factor=1,
+                max_shifts=tuple(int(np.ceil(ms / factor)) for ms in self.max_shifts),
+                use_fftw=self.use_fftw, fftw_wisdom=self.fftw_wisdom, dtype=self.dtype)
+        return self._coarse
+
+    def _plan(self, kind, shape, dtype, **kwargs):
+        key = (kind, shape, dtype)
+        if key not in self._plans:
+            self._plans[key] = getattr(pyfftw.builders, kind)(
+                pyfftw.empty_aligned(shape, dtype=dtype), planner_effort='FFTW_MEASURE', threads=1, **kwargs)
+            if self.fftw_wisdom is not None:
+                tmp_name = self.fftw_wisdom + '.' + str(os.getpid())
+                with open(tmp_name, 'wb') as f:
+                    pickle.dump(pyfftw.export_wisdom(), f)
+                os.replace(tmp_name, self.fftw_wisdom)
+        return self._plans[key]
+
+    def fft2(self, x):
+        """ DFT over the last two axes """
+        if self.use_fftw:
+            return self._plan('fft2', x.shape, x.dtype)(x).copy()
+        return scipy_fft.fft2(x)
+
+    def ifft2(self, x):
+        """ inverse DFT over the last two axes """
+        if self.use_fftw:
+            return self._plan('ifft2', x.shape, x.dtype)(x).copy()
+        return scipy_fft.ifft2(x)
+
+    def irfft2(self, x):
+        """ inverse DFT over the last two axes of a Hermitian spectrum
+        (real output with last two dimensions equal to self.shape) """
+        x = np.ascontiguousarray(x[..., :self.shape[1] // 2 + 1])
+        if self.use_fftw:
+            return self._plan('irfft2', x.shape, x.dtype, s=self.shape)(x).copy()
+        return scipy_fft.irfft2(x, s=self.shape)
+
+    def _shift_mask(self, axis, shift_lb=None, shift_ub=None, max_shift=None):
+        key = (axis, shift_lb, shift_ub, max_shift)
+        if key not in self._masks:
+            self._masks[key] = _shift_mask(self.shape[axis], shift_lb, shift_ub, max_shift)
+        return self._masks[key]
+
+    def register_batch(self, src_images, shifts_lb=None, shifts_ub=None):
+        """
+        Register a stack of images to the template.
+
+        Args:
+            src_images : ndarray
+                N x H x W stack of images to register. If the registrar holds
+                a stack of templates (P x H x W) the images can be N x P x H x W
+                and each image is registered to the corresponding template
+
+            shifts_lb, shifts_ub : ndarray, optional
+                lower and upper bounds on the shifts, either common to all
+                images (length 2) or broadcastable to the images (e.g. N x 2,
+                or N x 1 x 2 for stacks of templates)
+
+        Returns:
+            shifts : ndarray
+                (N x ... x 2) array of shifts (in pixels) required to register
+                each image with the template
+
+            src_freq : ndarray
+                scaled DFTs of the images (same shape as src_images)
+
+            phasediff : ndarray
+                global phase difference between each image and the template
+        """
+        if src_images.ndim < 3 or src_images.shape[-2:] != self.shape:
+            raise ValueError("Error: images must really be same size for "
+                             "register_translation_batch")
+
+        shape = self.shape
+        size = self.size
+        upsample_factor = self.upsample_factor
+        # scaled DFTs, consistent with the opencv path of register_translation
+        src_means, src_freq = self._centered_fft2(src_images)
+        template_freq = self.template_freq
+
+        # Cross-power spectra. The DC term is constant over the shifts and is
+        # added back in double precision
+        image_product = src_freq * template_freq.conj()
+        lead_shape = image_product.shape[:-2]
+        image_product = image_product.reshape((-1,) + shape)
+        num_frames = image_product.shape[0]
+        dc = np.broadcast_to(src_means * self._template_mean, lead_shape).reshape(-1)
+        image_product[:, 0, 0] = 0
+
+        # admissible shifts along each axis (per image if bounds are provided)
+        if (shifts_lb is not None) or (shifts_ub is not None):
+            shifts_lb = np.broadcast_to(shifts_lb, lead_shape + (2,)).reshape(-1, 2)
+            shifts_ub = np.broadcast_to(shifts_ub, lead_shape + (2,)).reshape(-1, 2)
+            masks = [np.stack([self._shift_mask(ax, lb, ub) for lb, ub in zip(shifts_lb[:, ax], shifts_ub[:, ax])])
+                     for ax in range(2)]
+        else:
+            masks = [self._shift_mask(ax, max_shift=self.max_shifts[ax])[None] for ax in range(2)]
+
+        if self.pyramid_levels > 0:
+            # coarse estimate on the downsampled images: only the shifts within
+            # +/- 2**pyramid_levels pixels of it are admissible
+            factor = 2 ** self.pyramid_levels
+            coarse_shifts = self.coarse_registrar.register_batch(
+                _downsample_mean(src_images, factor),
+                shifts_lb=None if shifts_lb is None else (shifts_lb // factor).reshape(lead_shape + (2,)),
+                shifts_ub=None if shifts_ub is None else (-(-shifts_ub // factor)).reshape(lead_shape + (2,)))[0]
+            window = np.arange(-factor, factor + 1)
+            for ax in range(2):
+                candidates = np.mod(coarse_shifts.reshape(-1, 2)[:, ax, None] * factor + window, shape[ax]).astype(int)
+                window_mask = np.zeros((num_frames, shape[ax]), dtype=bool)
+                np.put_along_axis(window_mask, candidates, True, axis=1)
+                masks[ax] = masks[ax] & window_mask
+
+        # Whole-pixel shift - Compute cross-correlation by an IFFT. The images
+        # are real, hence the cross-correlation is real as well
+        cross_correlation = self.irfft2(image_product) + dc[:, None, None] / size
+        # Locate maximum within the admissible shifts
+        new_cross_corr = np.abs(cross_correlation)
+        new_cross_corr *= masks[0][:, :, None] & masks[1][:, None, :]
+        maxima = np.unravel_index(np.argmax(new_cross_corr.reshape(num_frames, -1), axis=1), shape)
+        midpoints = np.fix(np.array(shape) / 2)
+        shifts = np.stack(maxima, axis=1).astype(np.float64)
+        shifts = np.where(shifts > midpoints, shifts - np.array(shape), shifts)
+
+        if upsample_factor == 1:
+            CCmax = cross_correlation.reshape(num_frames, -1).max(1)
+        # If upsampling > 1, then refine estimate with matrix multiply DFT
+        else:
+            # Initial shift estimate in upsampled grid
+            shifts = np.round(shifts * upsample_factor) / upsample_factor
+            upsampled_region_size = self.upsampled_region_size
+            # Center of output array at dftshift + 1
+            dftshift = np.fix(upsampled_region_size / 2.0)
+            normalization = (size * upsample_factor ** 2)
+            # Matrix multiply DFT around the current shift estimates
+            sample_region_offset = dftshift - shifts * upsample_factor
+            cross_correlation = self._dft_region(image_product, upsampled_region_size, upsample_factor,
+                                                 sample_region_offset)
+            cross_correlation = cross_correlation / normalization + dc[:, None, None] / normalization
+            # Locate maxima and map back to original pixel grid
+            cross_correlation = cross_correlation.reshape(num_frames, -1)
+            maxima = np.stack(np.unravel_index(
+                np.argmax(np.abs(cross_correlation), axis=1),
+                (upsampled_region_size,) * 2), axis=1).astype(np.float64)
+            maxima -= dftshift
+            shifts = shifts + maxima / upsample_factor
+            CCmax = cross_correlation.max(1)
+
+        # If its only one row or column the shift along that dimension has no
+        # effect. We set to zero.
+        for dim in range(2):
+            if shape[dim] == 1:
+                shifts[:, dim] = 0
+
+        return (shifts.reshape(lead_shape + (2,)), src_freq,
+                _compute_phasediff(CCmax).reshape(lead_shape))
+
+    def register(self, src_image, shifts_lb=None, shifts_ub=None):
+        """
+        Register an image (or for stacks of templates, a stack of images) to
+        the template. Same outputs as register_translation.
+        """
+        if shifts_lb is not None:
+            shifts_lb = np.asarray(shifts_lb)[None]
+        if shifts_ub is not None:
+            shifts_ub = np.asarray(shifts_ub)[None]
+        shifts, src_freq, phasediff = self.register_batch(src_image[None], shifts_lb, shifts_ub)
+        return shifts[0], src_freq[0], phasediff[0]
+
+    def apply_shifts_dft(self, src_freq, shifts, diffphase, border_nan=True):
+        """
+        Same as apply_shifts_dft on a spectrum returned by register, with the
+        phase ramp built as the outer product of the cached 1D ramps.
+        """
+        d1, d2 = self.shape
+        Greg = src_freq * np.outer(np.exp(-1j * 2 * np.pi * shifts[0] * self.freqs[0] / d1),
+                                   np.exp(-1j * 2 * np.pi * shifts[1] * self.freqs[1] / d2))
+        Greg *= np.exp(1j * diffphase)
+        new_img = np.real(self.ifft2(Greg)) * self.size
+        return _apply_border_dft(new_img, shifts[::-1], border_nan)
+
+    def patch_registrar(self, overlaps, strides):
+        """
+        Registrar of the stack of patches of the template laid out as in
+        sliding_window (see sliding_window_patches).
+        """
+        key = (tuple(overlaps), tuple(strides))
+        if key not in self._patches:
+            self._patches[key] = TemplateRegistrar(
+                sliding_window_patches(self.template, overlaps, strides)[0],
+                upsample_factor=self.upsample_factor, max_shifts=self.max_shifts,
+                use_fftw=self.use_fftw, fftw_wisdom=self.fftw_wisdom, dtype=self.dtype)
+        return self._patches[key]
+
+    def cropped_template(self, max_shift_h, max_shift_w):
+        """ template cropped by the max shifts (float32), as used by
+        motion_correct_iteration_fast """
+        key = (max_shift_h, max_shift_w)
+        if key not in self._crops:
+            h_i, w_i = self.shape
+            self._crops[key] = self.template[max_shift_h:h_i - max_shift_h,
+                                             max_shift_w:w_i - max_shift_w].astype(np.float32)
+        return self._crops[key]
+
 #%%
 
 def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True):
@@ -1833,6 +2424,13 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True)
         Greg = np.dstack([np.real(Greg), np.imag(Greg)])
         new_img = ifftn(Greg)[:, :, 0]
 
+    return _apply_border_dft(new_img, shifts, border_nan)
+
+
+def _apply_border_dft(new_img, shifts, border_nan=True):
+    """ deal with the borders of an image shifted by apply_shifts_dft
+    (shifts are in the order used internally by apply_shifts_dft) """
+    is3D = new_img.ndim == 3
     if border_nan is not False:
         max_w, max_h, min_w, min_h = 0, 0, 0, 0
         max_h, max_w = np.ceil(np.maximum(
@@ -1913,6 +2511,44 @@ def sliding_window(image, overlaps, strides):
             # yield the current window
             yield (dim_1, dim_2, x, y, image[x:x + windowSize[0], y:y + windowSize[1]])
 
+def sliding_window_patches(image, overlaps, strides):
+    """ all the patches of sliding_window extracted at once from a strided
+    view of the image
+
+    Args:
+        image: ndarray
+            image (or stack of images, ... x d1 x d2)
+
+        overlaps: tuple
+            overlap between patches along each dimension
+
+        strides: tuple
+            stride in each dimension
+
+    Returns:
+        patches: ndarray
+            ... x num_patches x patch_d1 x patch_d2 array of patches, in the
+            same order as sliding_window
+
+        xy_grid: list
+            dim_1, dim_2 coordinates of each patch in the patch grid
+
+        start_step: list
+            x, y bottom border of each patch in the original matrix
+    """
+    windowSize = np.add(overlaps, strides)
+    d1, d2 = image.shape[-2:]
+    range_1 = np.array(list(range(0, d1 - windowSize[0], strides[0])) + [d1 - windowSize[0]])
+    range_2 = np.array(list(range(0, d2 - windowSize[1], strides[1])) + [d2 - windowSize[1]])
+    windows = np.lib.stride_tricks.as_strided(
+        image, shape=image.shape[:-2] + (d1 - windowSize[0] + 1, d2 - windowSize[1] + 1) + tuple(windowSize),
+        strides=image.strides + image.strides[-2:], writeable=False)
+    patches = windows[..., range_1[:, None], range_2[None, :], :, :]
+    patches = patches.reshape(image.shape[:-2] + (-1,) + tuple(windowSize))
+    xy_grid = [(dim_1, dim_2) for dim_1 in range(len(range_1)) for dim_2 in range(len(range_2))]
+    start_step = [(x, y) for x in range_1 for y in range_2]
+    return patches, xy_grid, start_step
+
 def sliding_window_3d(image, overlaps, strides):
     """ efficiently and lazily slides a window across the image
 
@@ -1997,7 +2633,7 @@ def high_pass_filter_space(img_orig, gSig_filt):
 
 def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None, upsample_factor_grid=4,
                      upsample_factor_fft=10, show_movie=False, max_deviation_rigid=2, add_to_movie=0, shifts_opencv=False, gSig_filt=None,
-                     use_cuda=False, border_nan=True):
+                     use_cuda=False, border_nan=True, registrar=None):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
         2) motion correcting each patch separately
@@ -2048,6 +2684,10 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         border_nan : bool or string, optional
             specifies how to deal with borders. (True, False, 'copy', 'min')
 
+        registrar: TemplateRegistrar
+            registrar of template + add_to_movie, reused across frames. If
+            provided its max_shifts and upsample_factor are used
+
     Returns:
         (new_img, total_shifts, start_step, xy_grid)
             new_img: ndarray, corrected image
@@ -2056,7 +2696,6 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
     """
 
     img = img.astype(np.float64).copy()
-    template = template.astype(np.float64).copy()
 
     if gSig_filt is not None:
 
@@ -2064,11 +2703,15 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         img = high_pass_filter_space(img_orig, gSig_filt)
 
     img = img + add_to_movie
-    template = template + add_to_movie
+    if registrar is None:
+        template = template.astype(np.float64) + add_to_movie
 
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    if registrar is None:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    else:
+        rigid_shts, sfr_freq, diffphase = registrar.register(img)
 
     if max_deviation_rigid == 0:
 
@@ -2085,16 +2728,18 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                 raise Exception(
                     'The use of FFT and filtering options have not been tested. Set opencv=True')
 
-            new_img = apply_shifts_dft(
-                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
+            if registrar is None:
+                new_img = apply_shifts_dft(
+                    sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
+            else:
+                new_img = registrar.apply_shifts_dft(
+                    sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
 
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
         xy_grid = [(it[0], it[1]) for it in sliding_window(
-            template, overlaps=overlaps, strides=strides)]
+            img, overlaps=overlaps, strides=strides)]
         num_tiles = np.prod(np.add(xy_grid[-1], 1))
         imgs = [it[-1]
                 for it in sliding_window(img, overlaps=overlaps, strides=strides)]
@@ -2113,9 +2758,16 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
+        if registrar is None:
+            templates = [
+                it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
+            shfts_et_all = [register_translation(
+                a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
+                imgs, templates, [upsample_factor_fft] * num_tiles)]
+        else:
+            shfts, _, diffs_phase = registrar.patch_registrar(overlaps, strides).register(
+                np.stack(imgs), shifts_lb=lb_shifts, shifts_ub=ub_shifts)
+            shfts_et_all = list(zip(shfts, [None] * num_tiles, diffs_phase))
         shfts = [sshh[0] for sshh in shfts_et_all]
         diffs_phase = [sshh[2] for sshh in shfts_et_all]
         # create a vector field
@@ -2136,7 +2788,8 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                              # borderValue=add_to_movie)
             total_shifts = [
                     (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
-            return m_reg - add_to_movie, total_shifts, None, None
+            start_step = [(it[2], it[3]) for it in sliding_window(img, overlaps=overlaps, strides=strides)]
+            return m_reg - add_to_movie, total_shifts, start_step, xy_grid
 
         # create automatically upsample parameters if not passed
         if newoverlaps is None:
@@ -2512,19 +3165,21 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
     # cv2.OPTFLOW_FARNEBACK_GAUSSIAN
     import scipy
     vmin, vmax = -1, 1
-    m = cm.load(fname)
+    reader = cm.base.movies.MovieReader(fname, cache_size=0)
 
-    max_shft_x = np.int(np.ceil((np.shape(m)[1] - final_size_x) / 2))
-    max_shft_y = np.int(np.ceil((np.shape(m)[2] - final_size_y) / 2))
-    max_shft_x_1 = - ((np.shape(m)[1] - max_shft_x) - (final_size_x))
-    max_shft_y_1 = - ((np.shape(m)[2] - max_shft_y) - (final_size_y))
+    max_shft_x = np.int(np.ceil((reader.shape[1] - final_size_x) / 2))
+    max_shft_y = np.int(np.ceil((reader.shape[2] - final_size_y) / 2))
+    max_shft_x_1 = - ((reader.shape[1] - max_shft_x) - (final_size_x))
+    max_shft_y_1 = - ((reader.shape[2] - max_shft_y) - (final_size_y))
     if max_shft_x_1 == 0:
         max_shft_x_1 = None
 
     if max_shft_y_1 == 0:
         max_shft_y_1 = None
     logging.info([max_shft_x, max_shft_x_1, max_shft_y, max_shft_y_1])
-    m = m[:, max_shft_x:max_shft_x_1, max_shft_y:max_shft_y_1]
+    # only the cropped field of view is read
+    m = cm.movie(reader[:, max_shft_x:max_shft_x_1, max_shft_y:max_shft_y_1])
+    reader.close()
     if np.sum(np.isnan(m)) > 0:
         logging.info(m.shape)
         logging.warning('Movie contains NaN')
@@ -2598,7 +3253,10 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
 def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_splits_to_process=None, num_iter=1,
                                template=None, shifts_opencv=False, save_movie_rigid=False, add_to_movie=None,
                                nonneg_movie=False, gSig_filt=None, subidx=slice(None, None, 1), use_cuda=False,
-                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None))):
+                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None)),
+                               use_fftw=False, fftw_wisdom=None, order='F', out_fname=None, out_shape=None,
+                               frames_offset=0, border_to_0=0, border_value=None, resume=False, pyramid_levels=0,
+                               mmap_dtype='float32'):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2639,6 +3297,35 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        use_fftw: bool, default: False
+           Compute the FFTs of the registration with pyFFTW plans (if available)
+
+        fftw_wisdom: str, default: None
+           File where the pyFFTW wisdom is loaded from and stored to
+
+        order: 'F' or 'C', default: 'F'
+           order of the memory mapped file where the corrected movie is saved
+
+        out_fname, out_shape: str, tuple, default: None
+           existing memory mapped file (and its shape) where the corrected
+           movie is saved, starting at frame frames_offset. By default a new
+           file is created
+
+        border_to_0: int, default: 0
+           number of pixels on each border set to the min of the movie when saving
+
+        border_value: float, default: None
+           value of the border pixels (default: see _movie_min)
+
+        resume: bool, default: False
+           if the output file exists, only process the chunks not recorded in its journal
+
+        pyramid_levels: int, default: 0
+           number of levels of the coarse-to-fine search of the rigid shifts (see TemplateRegistrar)
+
+        mmap_dtype: str, default: 'float32'
+           data type of the memory mapped file (see MotionCorrect)
+
     Returns:
          fname_tot_rig: str
 
@@ -2659,7 +3346,12 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     Ts = np.arange(T)[subidx].shape[0]
     step = Ts // 10 if is3D else Ts // 50
     corrected_slicer = slice(subidx.start, subidx.stop, step + 1)
-    m = cm.load(fname, var_name_hdf5=var_name_hdf5, subindices=corrected_slicer)
+    if isinstance(fname, tuple) or is3D:
+        m = cm.load(fname, var_name_hdf5=var_name_hdf5, subindices=corrected_slicer)
+    else:
+        # only the frames used for the template are read
+        with cm.base.movies.MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+            m = cm.movie(np.array(reader[corrected_slicer]))
 
     if len(m.shape) < 3:
         m = cm.load(fname, var_name_hdf5=var_name_hdf5)
@@ -2682,6 +3374,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
             template = caiman.motion_correction.bin_median_3d(m) # motion_correct_3d has not been implemented yet - instead initialize to just median image
 #            template = caiman.motion_correction.bin_median_3d(
 #                    m.motion_correct_3d(max_shifts[2], max_shifts[1], max_shifts[0], template=None)[0])
+        elif pyramid_levels > 0:
+            template = caiman.motion_correction.bin_median(
+                    register_to_median(m, max_shifts, pyramid_levels=pyramid_levels))
         else:
             template = caiman.motion_correction.bin_median(
                     m.motion_correct(max_shifts[1], max_shifts[0], template=None)[0])
@@ -2717,7 +3412,10 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
                                                              dview=dview, save_movie=save_movie, base_name=base_name, subidx = subidx,
                                                              num_splits=num_splits_to_process, shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                              use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                             indices=indices)
+                                                             indices=indices, use_fftw=use_fftw, fftw_wisdom=fftw_wisdom, order=order,
+                                                             out_fname=out_fname, out_shape=out_shape, frames_offset=frames_offset,
+                                                             border_to_0=border_to_0, border_value=border_value, resume=resume,
+                                                             pyramid_levels=pyramid_levels, mmap_dtype=mmap_dtype)
         if is3D:
             new_templ = np.nanmedian(np.stack([r[-1] for r in res_rig]), 0)           
         else:
@@ -2747,7 +3445,9 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                  splits=56, num_splits_to_process=None, num_iter=1,
                                  template=None, shifts_opencv=False, save_movie=False, nonneg_movie=False, gSig_filt=None,
                                  use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                 indices=(slice(None), slice(None))):
+                                 indices=(slice(None), slice(None)), use_fftw=False, fftw_wisdom=None, order='F',
+                                 out_fname=None, out_shape=None, frames_offset=0, border_to_0=0, border_value=None,
+                                 resume=False, pyramid_levels=0, mmap_dtype='float32'):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2797,6 +3497,35 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        use_fftw: bool, default: False
+           Compute the FFTs of the registration with pyFFTW plans (if available)
+
+        fftw_wisdom: str, default: None
+           File where the pyFFTW wisdom is loaded from and stored to
+
+        order: 'F' or 'C', default: 'F'
+           order of the memory mapped file where the corrected movie is saved
+
+        out_fname, out_shape: str, tuple, default: None
+           existing memory mapped file (and its shape) where the corrected
+           movie is saved, starting at frame frames_offset. By default a new
+           file is created
+
+        border_to_0: int, default: 0
+           number of pixels on each border set to the min of the movie when saving
+
+        border_value: float, default: None
+           value of the border pixels (default: see _movie_min)
+
+        resume: bool, default: False
+           if the output file exists, only process the chunks not recorded in its journal
+
+        pyramid_levels: int, default: 0
+           number of levels of the coarse-to-fine search of the rigid shifts (see TemplateRegistrar)
+
+        mmap_dtype: str, default: 'float32'
+           data type of the memory mapped file (see MotionCorrect)
+
     Returns:
         fname_tot_rig: str
 
@@ -2835,7 +3564,7 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                 if isinstance(fname, tuple):
                     logging.debug('saving mmap of ' + fname[0] + 'to' +fname[-1])
                 else:
-                    logging.debug('saving mmap of ' + fname)
+                    logging.debug('saving mmap of ' + str(fname))
 
         if isinstance(fname, tuple):
             base_name=os.path.split(fname[0])[-1][:-4] + '_els_'
@@ -2846,11 +3575,14 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                                             add_to_movie=add_to_movie, template=old_templ, max_shifts=max_shifts,
                                                             max_deviation_rigid=max_deviation_rigid,
                                                             newoverlaps=newoverlaps, newstrides=newstrides,
-                                                            upsample_factor_grid=upsample_factor_grid, order='F', dview=dview, save_movie=save_movie,
+                                                            upsample_factor_grid=upsample_factor_grid, order=order, dview=dview, save_movie=save_movie,
                                                             base_name=base_name, num_splits=num_splits_to_process,
                                                             shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                             use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                            indices=indices)
+                                                            indices=indices, use_fftw=use_fftw, fftw_wisdom=fftw_wisdom,
+                                                            out_fname=out_fname, out_shape=out_shape, frames_offset=frames_offset,
+                                                            border_to_0=border_to_0, border_value=border_value, resume=resume,
+                                                            pyramid_levels=pyramid_levels, mmap_dtype=mmap_dtype)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
         if gSig_filt is not None:
@@ -2881,6 +3613,231 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     return fname_tot_els, total_template, templates, x_shifts, y_shifts, z_shifts, coord_shifts
 
 
+#%%
+def register_to_median(m, max_shifts, pyramid_levels=0, num_iter=2):
+    """ motion correct a movie by registering its frames to its (iteratively
+    refined) median, as movie.motion_correct does, with FFT registration
+    instead of template matching. The template is refined on the movie
+    downsampled by 2**pyramid_levels, and only the last registration is
+    carried out at full resolution (coarse-to-fine, see TemplateRegistrar).
+    Used for bootstrapping the template when the shifts are large.
+
+    Args:
+        m: ndarray 3D
+            movie (time along the first dimension)
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        pyramid_levels: int
+            number of levels of the coarse-to-fine search
+
+        num_iter: int
+            number of times the template is updated
+
+    Returns:
+        corrected: ndarray 3D
+            motion corrected movie
+    """
+    mov = np.asarray(m, dtype=np.float32)
+    factor = 2 ** pyramid_levels
+    coarse = _downsample_mean(mov, factor)
+    shifts = np.zeros((len(mov), 2))
+    for _ in range(num_iter - 1):
+        corrected = np.stack([apply_shift_iteration(img, (-sh[0], -sh[1])) for img, sh in zip(coarse, shifts)])
+        registrar = TemplateRegistrar(bin_median(corrected), upsample_factor=10,
+                                      max_shifts=tuple(int(np.ceil(ms / factor)) for ms in max_shifts),
+                                      dtype=np.float32)
+        shifts = registrar.register_batch(coarse)[0]
+
+    corrected = np.stack([apply_shift_iteration(img, (-sh[0] * factor, -sh[1] * factor))
+                          for img, sh in zip(mov, shifts)])
+    registrar = TemplateRegistrar(bin_median(corrected), upsample_factor=10, max_shifts=max_shifts,
+                                  pyramid_levels=pyramid_levels, dtype=np.float32)
+    shifts = registrar.register_batch(mov)[0]
+    return np.stack([apply_shift_iteration(img, (-sh[0], -sh[1])) for img, sh in zip(mov, shifts)])
+
+
+def rigid_correct_batch(imgs, template, max_shifts, add_to_movie=0, upsample_factor_fft=10,
+                        shifts_opencv=False, gSig_filt=None, border_nan=True, batch_size=32,
+                        registrar=None):
+    """ perform rigid motion correction of a stack of frames, registering
+    batch_size frames at a time with a TemplateRegistrar. Gives the same
+    results as calling tile_and_correct with max_deviation_rigid=0 on each
+    frame, but the spectrum of the template is computed only once.
+
+    Args:
+        imgs: ndarray 3D
+            frames to correct (time along the first dimension)
+
+        template: ndarray
+            reference image
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        add_to_movie: float
+            value added to frames and template before registration
+
+        upsample_factor_fft: int
+            resolution of fractional shifts
+
+        shifts_opencv: bool
+            apply shifts with opencv (faster but induces some smoothing)
+
+        gSig_filt: tuple
+            standard deviation of the high pass filter used for registration (1p data)
+
+        border_nan : bool or string, optional
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+        batch_size: int
+            number of frames registered together
+
+        registrar: TemplateRegistrar
+            registrar of template + add_to_movie. If provided, template,
+            max_shifts and upsample_factor_fft are ignored
+
+    Returns:
+        mc: ndarray 3D (float32)
+            corrected frames
+
+        total_shifts: list
+            shifts applied to each frame
+    """
+    if gSig_filt is not None and not shifts_opencv:
+        raise Exception(
+            'The use of FFT and filtering options have not been tested. Set opencv=True')
+
+    if registrar is None:
+        registrar = TemplateRegistrar(template.astype(np.float64) + add_to_movie,
+                                      upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+    mc = np.zeros(imgs.shape, dtype=np.float32)
+    total_shifts = []
+    for start in range(0, len(imgs), batch_size):
+        batch = np.array(imgs[start:start + batch_size], dtype=np.float64)
+        if gSig_filt is not None:
+            batch_orig = batch
+            batch = np.stack([high_pass_filter_space(img, gSig_filt) for img in batch_orig])
+        batch = batch + add_to_movie
+        shifts, src_freq, diffphase = registrar.register_batch(batch)
+
+        for count, (sh, dph) in enumerate(zip(shifts, diffphase)):
+            if shifts_opencv:
+                img = batch_orig[count] if gSig_filt is not None else batch[count]
+                new_img = apply_shift_iteration(img, (-sh[0], -sh[1]), border_nan=border_nan)
+            else:
+                new_img = registrar.apply_shifts_dft(src_freq[count], (-sh[0], -sh[1]), dph, border_nan=border_nan)
+            mc[start + count] = new_img - add_to_movie
+            total_shifts.append((-sh[0], -sh[1]))
+
+    return mc, total_shifts
+
+def tile_and_correct_batch(imgs, template, strides, overlaps, max_shifts, max_deviation_rigid=2,
+                           add_to_movie=0, upsample_factor_fft=10, gSig_filt=None, batch_size=8,
+                           registrar=None):
+    """ perform piecewise rigid motion correction of a stack of frames with
+    the shifts applied through opencv (same as tile_and_correct with
+    shifts_opencv=True). For each batch of frames
+        1) the rigid shifts of all the frames are estimated in one batched registration
+        2) the patches of all the frames are extracted from a strided view and
+           registered to the patches of the template in one batched registration
+        3) the motion field of each frame is upsampled and applied with a single cv2.remap
+    All the computations are carried out in float32.
+
+    Args:
+        imgs: ndarray 3D
+            frames to correct (time along the first dimension)
+
+        template: ndarray
+            reference image
+
+        strides: tuple
+            strides of the patches in which the FOV is subdivided
+
+        overlaps: tuple
+            amount of pixel overlaping between patches along each dimension
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        max_deviation_rigid: int
+            maximum deviation in shifts of each patch from the rigid shift
+
+        add_to_movie: float
+            value added to frames and template before registration
+
+        upsample_factor_fft: int
+            resolution of fractional shifts
+
+        gSig_filt: tuple
+            standard deviation of the high pass filter used for registration (1p data)
+
+        batch_size: int
+            number of frames registered together
+
+        registrar: TemplateRegistrar
+            registrar of template + add_to_movie. If provided, template,
+            max_shifts and upsample_factor_fft are ignored
+
+    Returns:
+        mc: ndarray 3D (float32)
+            corrected frames
+
+        total_shifts: list
+            for each frame, list of the shifts of each patch
+
+        start_step: list
+            x, y bottom border of each patch (the same for all the frames)
+
+        xy_grid: list
+            dim_1, dim_2 coordinates of each patch in the patch grid
+    """
+    if registrar is None:
+        registrar = TemplateRegistrar(template.astype(np.float32) + np.float32(add_to_movie),
+                                      upsample_factor=upsample_factor_fft, max_shifts=max_shifts,
+                                      dtype=np.float32)
+    patch_registrar = registrar.patch_registrar(overlaps, strides)
+    _, xy_grid, start_step = sliding_window_patches(registrar.template, overlaps, strides)
+    dim_grid = tuple(np.add(xy_grid[-1], 1))
+    dims = registrar.shape
+    x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
+        np.float32), np.arange(0., dims[0]).astype(np.float32))
+
+    mc = np.zeros(imgs.shape, dtype=np.float32)
+    total_shifts = []
+    for start in range(0, len(imgs), batch_size):
+        batch = np.array(imgs[start:start + batch_size], dtype=np.float32)
+        if gSig_filt is not None:
+            batch_orig = batch
+            batch = np.stack([high_pass_filter_space(img, gSig_filt) for img in batch_orig])
+        batch = batch + np.float32(add_to_movie)
+
+        # rigid shifts and bounds for the shifts of the patches
+        rigid_shts, _, _ = registrar.register_batch(batch)
+        if max_deviation_rigid is not None:
+            lb_shifts = np.ceil(rigid_shts - max_deviation_rigid).astype(int)[:, None]
+            ub_shifts = np.floor(rigid_shts + max_deviation_rigid).astype(int)[:, None]
+        else:
+            lb_shifts = None
+            ub_shifts = None
+
+        shfts, _, _ = patch_registrar.register_batch(
+            sliding_window_patches(batch, overlaps, strides)[0], shifts_lb=lb_shifts, shifts_ub=ub_shifts)
+
+        if gSig_filt is not None:
+            batch = batch_orig
+        for count, (img, sh) in enumerate(zip(batch, shfts)):
+            shift_img_x = np.reshape(sh[:, 0], dim_grid).astype(np.float32)
+            shift_img_y = np.reshape(sh[:, 1], dim_grid).astype(np.float32)
+            m_reg = cv2.remap(img, cv2.resize(shift_img_y, dims[::-1]) + x_grid,
+                              cv2.resize(shift_img_x, dims[::-1]) + y_grid,
+                              cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+            mc[start + count] = m_reg - add_to_movie
+            total_shifts.append([(-x, -y) for x, y in sh])
+
+    return mc, total_shifts, start_step, xy_grid
+
 #%% in parallel
 def tile_and_correct_wrapper(params):
     """Does motion correction on specified image frames
@@ -2896,17 +3853,19 @@ def tile_and_correct_wrapper(params):
     """
     # todo todocument
 
-
-    try:
-        cv2.setNumThreads(0)
-    except:
-        pass  # 'Open CV is naturally single threaded'
+    # the workers started by setup_cluster have their threads limited already
+    if cm.cluster.worker_threads() is None:
+        try:
+            cv2.setNumThreads(0)
+        except:
+            pass  # 'Open CV is naturally single threaded'
 
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
         shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, var_name_hdf5, \
-        is3D, indices = params
-
+        is3D, indices, use_fftw, fftw_wisdom, order, frames_offset, border_to_0, border_value, journal, \
+        pyramid_levels, mmap_dtype = params
+    template = cm.cluster.fetch(template)
 
     if isinstance(img_name,tuple):
         name, extension = os.path.splitext(img_name[0])[:2]
@@ -2915,59 +3874,223 @@ def tile_and_correct_wrapper(params):
     extension = extension.lower()
     shift_info = []
 
-    imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
-    imgs = imgs[(slice(None),) + indices]
-    mc = np.zeros(imgs.shape, dtype=np.float32)
+    if isinstance(img_name, tuple) or is3D:
+        imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
+        imgs = imgs[(slice(None),) + indices]
+    else:
+        # only the frames and the pixels of the chunk are read
+        with cm.base.movies.MovieReader(img_name, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+            imgs = cm.movie(np.array(reader[(idxs,) + tuple(indices)]))
     if not imgs[0].shape == template.shape:
         template = template[indices]
-    for count, img in enumerate(imgs):
-        if count % 10 == 0:
-            logging.debug(count)
-        if is3D:
-            mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img[indices], template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xyz_grid])
+    if not is3D and not (HAS_CUDA and use_cuda):
+        # the template is fixed for the whole chunk. The pw-rigid opencv path works in float32
+        dtype = np.float32 if (max_deviation_rigid != 0 and shifts_opencv) else np.float64
+        registrar = TemplateRegistrar(template.astype(dtype) + dtype(add_to_movie), upsample_factor=10,
+                                      max_shifts=max_shifts, use_fftw=use_fftw, fftw_wisdom=fftw_wisdom,
+                                      dtype=dtype, pyramid_levels=pyramid_levels)
+    else:
+        registrar = None
+    if max_deviation_rigid == 0 and registrar is not None:
+        # rigid registration of the whole chunk with batched FFTs
+        mc, total_shifts = rigid_correct_batch(imgs, template, max_shifts, add_to_movie=add_to_movie,
+                                               upsample_factor_fft=10, shifts_opencv=shifts_opencv,
+                                               gSig_filt=gSig_filt, border_nan=border_nan,
+                                               registrar=registrar)
+        shift_info = [[total_shift, None, None] for total_shift in total_shifts]
+    elif shifts_opencv and registrar is not None:
+        # pw-rigid registration of all the patches of a batch of frames at once
+        mc, total_shifts, start_step, xy_grid = tile_and_correct_batch(
+            imgs, template, strides, overlaps, max_shifts, max_deviation_rigid=max_deviation_rigid,
+            add_to_movie=add_to_movie, upsample_factor_fft=10, gSig_filt=gSig_filt, registrar=registrar)
+        shift_info = [[total_shift, start_step, xy_grid] for total_shift in total_shifts]
+    else:
+        mc = np.zeros(imgs.shape, dtype=np.float32)
+        for count, img in enumerate(imgs):
+            if count % 10 == 0:
+                logging.debug(count)
+            if is3D:
+                mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img[indices], template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan)
+                shift_info.append([total_shift, start_step, xyz_grid])
             
-        else:
-            mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xy_grid])
+            else:
+                mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan,
+                                                                           registrar=registrar)
+                shift_info.append([total_shift, start_step, xy_grid])
 
     if out_fname is not None:
-        outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
-                         shape=prepare_shape(shape_mov), order='F')
-        if nonneg_movie:
+        outv = np.memmap(out_fname, mode='r+', dtype=mmap_dtype,
+                         shape=prepare_shape(shape_mov), order=order)
+        integer_data = np.dtype(mmap_dtype).kind == 'u'
+        if nonneg_movie and not integer_data:
             bias = np.float32(add_to_movie)
         else:
             bias = 0
-        outv[:, idxs] = np.reshape(
-            mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
+        mov = mc.astype(np.float32) + bias
+        if border_to_0 > 0:
+            min_mov = np.float32(border_value) + bias
+            mov[:, :border_to_0] = min_mov
+            mov[:, :, :border_to_0] = min_mov
+            mov[:, :, -border_to_0:] = min_mov
+            mov[:, -border_to_0:] = min_mov
+        if integer_data:
+            # the offsets are stored in the header of the file (see _memmap_offset)
+            mov = _to_memmap_dtype(np.nan_to_num(mov), mmap_dtype)
+        elif order == 'C':
+            # same offset added by mmapping.save_memmap to the files used by CNMF
+            mov += np.float32(0.0001)
+        outv[:, np.add(idxs, frames_offset)] = np.reshape(mov, (len(mov), -1), order='F').T
+        outv.flush()
     new_temp = np.nanmean(mc, 0)
     new_temp[np.isnan(new_temp)] = np.nanmin(new_temp)
+    if journal is not None:
+        # the chunk is recorded only once its frames are on disk
+        _save_journal_entry(journal, np.add(idxs, frames_offset), (shift_info, idxs, new_temp))
     return shift_info, idxs, new_temp
 
+
+def _memmap_offset(mmap_dtype, add_to_movie, nonneg_movie, order):
+    """ offset of a memory mapped file of the corrected movie, stored in its header for integer files
+
+    Float files have the offset (add_to_movie for nonneg_movie, and 0.0001 for C order files as in
+    mmapping.save_memmap) added to the data. Integer files keep the data as they are and store it in
+    the header instead
+    """
+    if np.dtype(mmap_dtype).kind != 'u':
+        return 0
+    offset = np.float32(0.0001) if order == 'C' else np.float32(0)
+    if nonneg_movie:
+        offset += np.float32(add_to_movie)
+    return float(offset)
+
+
+def _journal_dir(fname_tot):
+    """ directory of the journal of the chunks saved in a memory mapped file """
+    return os.path.splitext(fname_tot)[0] + '_journal'
+
+
+def _reset_journal(fname_tot):
+    shutil.rmtree(_journal_dir(fname_tot), ignore_errors=True)
+
+
+def _movie_min(fnames, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None)), num_frames=400):
+    """
+    min of num_frames frames evenly spaced over the movie files, which replaces the min of the whole
+    movie for the borders of the corrected frames (see border_to_0)
+
+    Args:
+        fnames: str, tuple or list
+            movie, or list of movies
+
+        num_frames: int
+            number of frames read in each movie
+
+    Returns:
+        min of the frames, ignoring NaNs
+    """
+    if not isinstance(fnames, list):
+        fnames = [fnames]
+    min_mov = np.inf
+    for fname in fnames:
+        _, T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=var_name_hdf5)
+        idxs = np.unique(np.linspace(0, T - 1, min(num_frames, T)).astype(int))
+        if isinstance(fname, tuple) or is3D:
+            imgs = cm.load(fname, subindices=idxs, var_name_hdf5=var_name_hdf5, is3D=is3D)
+            imgs = imgs[(slice(None),) + tuple(indices)]
+        else:
+            with cm.base.movies.MovieReader(fname, var_name_hdf5=var_name_hdf5, cache_size=0) as reader:
+                imgs = np.array(reader[(idxs,) + tuple(indices)])
+        min_mov = min(min_mov, float(np.nanmin(imgs)))
+    return min_mov
+
+
+def _journal_key(template, *args):
+    """ key identifying the template and parameters a chunk was corrected with """
+    key = hashlib.md5(np.ascontiguousarray(template).tobytes())
+    key.update(repr(args).encode())
+    return key.hexdigest()
+
+
+def _journal_entry_name(journal_dir, frames):
+    return os.path.join(journal_dir, 'frames_{}_{}.pickle'.format(frames[0], frames[-1]))
+
+
+def _save_journal_entry(journal, frames, result):
+    """ atomically record that the frames of a chunk have been saved """
+    journal_dir, key = journal
+    os.makedirs(journal_dir, exist_ok=True)
+    fname = _journal_entry_name(journal_dir, frames)
+    tmp_name = fname + '.' + str(os.getpid())
+    with open(tmp_name, 'wb') as f:
+        pickle.dump({'key': key, 'result': result}, f)
+    os.replace(tmp_name, fname)
+
+
+def _load_journal_entry(journal, frames):
+    """ result of a chunk recorded in the journal, None if the chunk has to
+    be processed (not recorded, or recorded with a different template or parameters) """
+    journal_dir, key = journal
+    fname = _journal_entry_name(journal_dir, frames)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'rb') as f:
+            entry = pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        return None
+    return entry['result'] if entry['key'] == key else None
+
 def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0, template=None,
                                 max_shifts=(12, 12), max_deviation_rigid=3, newoverlaps=None, newstrides=None,
                                 upsample_factor_grid=4, order='F', dview=None, save_movie=True,
                                 base_name=None, subidx = None, num_splits=None, shifts_opencv=False, nonneg_movie=False, gSig_filt=None,
                                 use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                indices=(slice(None), slice(None))):
+                                indices=(slice(None), slice(None)), use_fftw=False, fftw_wisdom=None,
+                                out_fname=None, out_shape=None, frames_offset=0, border_to_0=0, border_value=None,
+                                resume=False, pyramid_levels=0, mmap_dtype='float32'):
     """
+    Motion correct a file in chunks (in parallel if dview is not None). If
+    save_movie is True, the corrected frames are written by each worker in a
+    memory mapped file (pixels x time) of the given order.
+
+    out_fname, out_shape: str, tuple
+        existing memory mapped file (and its shape) in which the corrected
+        frames are written. By default a new file is created for fname
+
+    frames_offset: int
+        index in out_fname of the first frame of fname
+
+    border_to_0: int
+        number of pixels on each border set to border_value
+
+    border_value: float
+        value of the border pixels, the same for all the chunks. By default the min of frames sampled
+        over the movie (see _movie_min)
+
+    resume: bool
+        if the output file exists, only process the chunks that are not
+        recorded as saved in its journal (see MotionCorrect)
+
+    pyramid_levels: int
+        number of levels of the coarse-to-fine search of the rigid shifts (see TemplateRegistrar)
 
+    mmap_dtype: str
+        data type of the memory mapped file (see MotionCorrect)
     """
-    # todo todocument
     if isinstance(fname,tuple):
         name, extension = os.path.splitext(fname[0])[:2]
     else:
@@ -3003,40 +4126,83 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
         save_movie = False
         #logging.warning('**** MOVIE NOT SAVED BECAUSE num_splits is not None ****')
 
-    if save_movie:
+    if save_movie and out_fname is not None:
+        fname_tot:Optional[str] = out_fname
+        shape_mov = out_shape
+    elif save_movie:
         if base_name is None:
             base_name = os.path.split(fname)[1][:-4]
-        fname_tot:Optional[str] = memmap_frames_filename(base_name, dims, T, order)
+        fname_tot = memmap_frames_filename(base_name, dims, T, order, mmap_dtype)
         if isinstance(fname,tuple):
             fname_tot = os.path.join(os.path.split(fname[0])[0], fname_tot)
         else:
             fname_tot = os.path.join(os.path.split(fname)[0], fname_tot)
 
-        np.memmap(fname_tot, mode='w+', dtype=np.float32,
-                  shape=prepare_shape(shape_mov), order=order)
-        logging.info('Saving file as {}'.format(fname_tot))
+        if resume and os.path.exists(fname_tot) and \
+                os.path.getsize(fname_tot) == np.prod(shape_mov) * np.dtype(mmap_dtype).itemsize:
+            logging.info('Resuming saving file {}'.format(fname_tot))
+        else:
+            np.memmap(fname_tot, mode='w+', dtype=mmap_dtype,
+                      shape=prepare_shape(shape_mov), order=order)
+            save_memmap_header(fname_tot, dims, T, order, mmap_dtype,
+                               offset=_memmap_offset(mmap_dtype, add_to_movie, nonneg_movie, order))
+            _reset_journal(fname_tot)
+            logging.info('Saving file as {}'.format(fname_tot))
     else:
         fname_tot = None
 
+    if fname_tot is not None and border_to_0 > 0 and border_value is None:
+        border_value = _movie_min(fname, var_name_hdf5=var_name_hdf5, is3D=is3D, indices=indices)
+
+    if fname_tot is not None:
+        journal = (_journal_dir(fname_tot), _journal_key(
+            template, strides, overlaps, max_shifts, add_to_movie, max_deviation_rigid, upsample_factor_grid,
+            newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, border_nan, indices, order,
+            border_to_0, border_value, pyramid_levels))
+    else:
+        journal = None
+
+    # the template is sent once to the workers rather than with every chunk
+    template_handle = cm.cluster.broadcast(template, dview)
     pars = []
-    for idx in idxs:
+    res_journal = {}
+    for count, idx in enumerate(idxs):
+        if resume and journal is not None:
+            res_journal[count] = _load_journal_entry(journal, np.add(idx, frames_offset))
+            if res_journal[count] is not None:
+                continue
         logging.debug('Processing: frames: {}'.format(idx))
-        pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
+        pars.append([fname, fname_tot, idx, shape_mov, template_handle, strides, overlaps, max_shifts, np.array(
             add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
             newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji,
-            use_cuda, border_nan, var_name_hdf5, is3D, indices])
+            use_cuda, border_nan, var_name_hdf5, is3D, indices, use_fftw, fftw_wisdom,
+            order, frames_offset, border_to_0, border_value, journal, pyramid_levels, np.dtype(mmap_dtype).name])
+    if resume and journal is not None:
+        logging.info('{} of {} chunks recorded in the journal'.format(len(idxs) - len(pars), len(idxs)))
 
-    if dview is not None:
+    if dview is not None and HAS_CUDA and use_cuda:
         logging.info('** Starting parallel motion correction **')
-        if HAS_CUDA and use_cuda:
+        try:
             res = dview.map(tile_and_correct_wrapper,pars)
             dview.map(close_cuda_process, range(len(pars)))
-        elif 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(tile_and_correct_wrapper, pars).get(4294967)
-        else:
-            res = dview.map_sync(tile_and_correct_wrapper, pars)
+        finally:
+            cm.cluster.release(template_handle)
         logging.info('** Finished parallel motion correction **')
     else:
-        res = list(map(tile_and_correct_wrapper, pars))
+        # the chunks are corrected as the workers become available, and collected as they finish.
+        # A chunk that fails is corrected again once
+        res = [None] * len(pars)
+        try:
+            for count, res_chunk in cm.cluster.as_executor(dview).imap_unordered(
+                    tile_and_correct_wrapper, pars, with_index=True, retries=1,
+                    progress=cm.cluster.progress_logger('Motion correction')):
+                res[count] = res_chunk
+        finally:
+            cm.cluster.release(template_handle)
+
+    if resume and journal is not None:
+        res_new = iter(res)
+        res = [res_journal[count] if res_journal.get(count) is not None else next(res_new)
+               for count in range(len(idxs))]
 
     return fname_tot, res
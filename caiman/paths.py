@@ -3,6 +3,7 @@
 
 """
 
+import numpy as np
 import os
 from typing import Tuple
 
@@ -33,13 +34,16 @@ def caiman_datadir_exists() -> bool:
 # In the future we may consistently store these somewhere under the caiman_datadir
 
 
-def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str = 'F') -> str:
+def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str = 'F', dtype=np.float32) -> str:
     # Some functions calling this have the first part of *their* dims Tuple be the number of frames.
     # They *must* pass a slice to this so dims is only X, Y, and optionally Z. Frames is passed separately.
+    # The data type is only encoded when it is not float32, so that the names of float32 files are unchanged
     dimfield_0 = dims[0]
     dimfield_1 = dims[1]
     if len(dims) == 3:
         dimfield_2 = dims[2]
     else:
         dimfield_2 = 1
+    if np.dtype(dtype) != np.float32:
+        basename = f"{basename}_dtype_{np.dtype(dtype).name}"
     return f"{basename}_d1_{dimfield_0}_d2_{dimfield_1}_d3_{dimfield_2}_order_{order}_frames_{frames}_.mmap"
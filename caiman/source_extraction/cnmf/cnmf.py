@@ -29,7 +29,6 @@ import inspect
 import logging
 import numpy as np
 import os
-import psutil
 import scipy
 import sys
 import glob
@@ -335,6 +334,10 @@ class CNMF(object):
         else:
             logging.warning("Error: File not found, with file list:\n" + fnames[0])
             raise Exception('File not found!')
+        # the whole FOV steps use the memory mapped data as they are, without the offset of integer files
+        # (see mmapping.memmap_offset), which only the readers of the patches add
+        if np.dtype(self.params.get('motion', 'mmap_dtype')).kind != 'f':
+            raise Exception('fit_file needs a floating point memory mapped file, set mmap_dtype to float32 or float16')
 
         base_name = pathlib.Path(fnames[0]).stem + "_memmap_"
         if extension == '.mmap':
@@ -342,28 +345,28 @@ class CNMF(object):
             Yr, dims, T = mmapping.load_memmap(fnames[0])
             if np.isfortran(Yr):
                 raise Exception('The file should be in C order (see save_memmap function)')
+            if Yr.dtype.kind != 'f':
+                raise Exception('fit_file needs a floating point memory mapped file (see save_memmap function)')
         else:
             if motion_correct:
-                mc = MotionCorrect(fnames, dview=self.dview, **self.params.motion)
-                mc.motion_correct(save_movie=True)
-                fname_mc = mc.fname_tot_els if self.params.motion['pw_rigid'] else mc.fname_tot_rig
-                if self.params.get('motion', 'pw_rigid'):
-                    b0 = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
-                                            np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
-                    self.estimates.shifts = [mc.x_shifts_els, mc.y_shifts_els]
-                else:
-                    b0 = np.ceil(np.max(np.abs(mc.shifts_rig))).astype(np.int)
-                    self.estimates.shifts = mc.shifts_rig
-                # TODO - b0 is currently direction inspecific, which can cause
+                # TODO - border_to_0 is currently direction inspecific, which can cause
                 # sub-optimal behavior. See
                 # https://github.com/flatironinstitute/CaImAn/pull/618#discussion_r313960370
                 # for further details.
                 # b0 = 0 if self.params.get('motion', 'border_nan') is 'copy' else 0
                 b0 = 0
-                fname_new = mmapping.save_memmap(fname_mc, base_name=base_name, order='C',
-                                                 border_to_0=b0)
+                # the corrected frames are written directly in the C order
+                # file used by CNMF, without a second pass with save_memmap
+                mc = MotionCorrect(fnames, dview=self.dview, **self.params.motion)
+                mc.motion_correct(save_movie=True, order='C', base_name=base_name, border_to_0=b0)
+                fname_new = mc.mmap_file[0]
+                if self.params.get('motion', 'pw_rigid'):
+                    self.estimates.shifts = [mc.x_shifts_els, mc.y_shifts_els]
+                else:
+                    self.estimates.shifts = mc.shifts_rig
             else:
-                fname_new = mmapping.save_memmap(fnames, base_name=base_name, order='C')
+                fname_new = mmapping.save_memmap(fnames, base_name=base_name, order='C',
+                                                 dtype=self.params.get('motion', 'mmap_dtype'))
             Yr, dims, T = mmapping.load_memmap(fname_new)
 
         images = np.reshape(Yr.T, [T] + list(dims), order='F')
@@ -484,12 +487,12 @@ class CNMF(object):
 
         logging.info(('Using ' + str(self.params.get('patch', 'n_processes')) + ' processes'))
         if self.params.get('preprocess', 'n_pixels_per_process') is None:
-            avail_memory_per_process = psutil.virtual_memory()[
-                1] / 2.**30 / self.params.get('patch', 'n_processes')
-            mem_per_pix = 3.6977678498329843e-09
-            npx_per_proc = np.int(avail_memory_per_process / 8. / mem_per_pix / T)
-            npx_per_proc = np.int(np.minimum(npx_per_proc, np.prod(self.dims) // self.params.get('patch', 'n_processes')))
-            self.params.set('preprocess', {'n_pixels_per_process': npx_per_proc})
+            # blocks of pixels fitting in the memory budget, each taking about 8 float32 copies of its pixels
+            n_processes = self.params.get('patch', 'n_processes')
+            plan = cluster.get_memory_budget().plan(
+                'pixels per process', cluster.estimate_task_bytes(1, T, copies=8), np.prod(self.dims),
+                n_processes, max_size=max(np.prod(self.dims) // n_processes, 1))
+            self.params.set('preprocess', {'n_pixels_per_process': plan.block_size})
 
         self.params.set('spatial', {'n_pixels_per_process': self.params.get('preprocess', 'n_pixels_per_process')})
 
@@ -894,11 +897,13 @@ class CNMF(object):
         self.params.set('temporal', kwargs_new)
 
 
-        self.estimates.C, self.estimates.A, self.estimates.b, self.estimates.f, self.estimates.S, \
-        self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, \
-        self.estimates.g, self.estimates.YrA, self.estimates.lam = update_temporal_components(
-                Y, self.estimates.A, self.estimates.b, self.estimates.C, self.estimates.f, dview=self.dview,
-                **self.params.get_group('temporal'))
+        # the driver uses all the cpus, also for the phases it runs serially
+        with cluster.thread_limits():
+            self.estimates.C, self.estimates.A, self.estimates.b, self.estimates.f, self.estimates.S, \
+            self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, \
+            self.estimates.g, self.estimates.YrA, self.estimates.lam = update_temporal_components(
+                    Y, self.estimates.A, self.estimates.b, self.estimates.C, self.estimates.f, dview=self.dview,
+                    **self.params.get_group('temporal'))
         self.estimates.R = self.estimates.YrA
         return self
 
@@ -938,16 +943,18 @@ class CNMF(object):
     def merge_comps(self, Y, mx=50, fast_merge=True, max_merge_area=None):
         """merges components
         """
-        self.estimates.A, self.estimates.C, self.estimates.nr, self.estimates.merged_ROIs, self.estimates.S, \
-        self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, self.estimates.g, self.empty_merged, \
-        self.estimates.YrA =\
-            merge_components(Y, self.estimates.A, self.estimates.b, self.estimates.C, self.estimates.YrA,
-                             self.estimates.f, self.estimates.S, self.estimates.sn, self.params.get_group('temporal'),
-                             self.params.get_group('spatial'), dview=self.dview,
-                             bl=self.estimates.bl, c1=self.estimates.c1, sn=self.estimates.neurons_sn,
-                             g=self.estimates.g, thr=self.params.get('merging', 'merge_thr'), mx=mx,
-                             fast_merge=fast_merge, merge_parallel=self.params.get('merging', 'merge_parallel'),
-                             max_merge_area=max_merge_area)
+        # the driver uses all the cpus, also for the phases it runs serially
+        with cluster.thread_limits():
+            self.estimates.A, self.estimates.C, self.estimates.nr, self.estimates.merged_ROIs, self.estimates.S, \
+            self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, self.estimates.g, self.empty_merged, \
+            self.estimates.YrA =\
+                merge_components(Y, self.estimates.A, self.estimates.b, self.estimates.C, self.estimates.YrA,
+                                 self.estimates.f, self.estimates.S, self.estimates.sn, self.params.get_group('temporal'),
+                                 self.params.get_group('spatial'), dview=self.dview,
+                                 bl=self.estimates.bl, c1=self.estimates.c1, sn=self.estimates.neurons_sn,
+                                 g=self.estimates.g, thr=self.params.get('merging', 'merge_thr'), mx=mx,
+                                 fast_merge=fast_merge, merge_parallel=self.params.get('merging', 'merge_parallel'),
+                                 max_merge_area=max_merge_area)
 
         return self
 
@@ -28,10 +28,15 @@ import os
 import scipy
 from sklearn.decomposition import NMF
 import time
-from typing import Set
+from typing import Dict, List, Set, Tuple
+
+from ...cluster import (CachedTask, MapReport, ResultCache, as_executor, broadcast, estimate_task_bytes,
+                        extract_patch_coordinates, fetch, file_fingerprint, hash_content,
+                        get_memory_budget, progress_logger, release)
+
+# float32 copies of a patch made while fitting it
+_patch_copies = 6
 
-from ...mmapping import load_memmap
-from ...cluster import extract_patch_coordinates
 
 #%%
 def cnmf_patches(args_in):
@@ -47,7 +52,8 @@ def cnmf_patches(args_in):
                 dimensions of the original movie across y, x, and time
 
             params:
-                CNMFParms object containing all the parameters for the various algorithms
+                CNMFParms object containing all the parameters for the various algorithms, or its
+                handle published with caiman.cluster.broadcast
 
             rf: int
                 half-size of the square patch in pixel
@@ -88,6 +94,7 @@ def cnmf_patches(args_in):
     import logging
     from . import cnmf
     file_name, idx_, shapes, params = args_in
+    params = fetch(params)
 
     logger = logging.getLogger(__name__)
     name_log = os.path.basename(
@@ -102,7 +109,9 @@ def cnmf_patches(args_in):
     logger.debug(name_log + 'START')
 
     logger.debug(name_log + 'Read file')
-    Yr, dims, timesteps = load_memmap(file_name)
+    from ...base.movies import MovieReader
+    reader = MovieReader(file_name)
+    dims, timesteps = reader.dims, len(reader)
 
     # slicing array (takes the min and max index in n-dimensional space and
     # cuts the box they define)
@@ -115,24 +124,17 @@ def cnmf_patches(args_in):
     # insert slice for timesteps, equivalent to :
     slices.insert(0, slice(timesteps))
 
-    images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
+    # only the pixels of the patch are read
     if params.get('patch', 'in_memory'):
-        images = np.array(images[slices], dtype=np.float32)
+        images = np.array(reader[tuple(slices)], dtype=np.float32)
     else:
-        images = images[slices]
+        images = reader[tuple(slices)]
 
     logger.debug(name_log+'file loaded')
 
     if (np.sum(np.abs(np.diff(images.reshape(timesteps, -1).T)))) > 0.1:
 
-        opts = copy(params)
-        opts.set('patch', {'n_processes': 1, 'rf': None, 'stride': None})
-        for group in ('init', 'temporal', 'spatial'):
-            opts.set(group, {'nb': params.get('patch', 'nb_patch')})
-        for group in ('preprocess', 'temporal'):
-            opts.set(group, {'p': params.get('patch', 'p_patch')})
-
-        cnm = cnmf.CNMF(n_processes=1, params=opts)
+        cnm = cnmf.CNMF(n_processes=1, params=_patch_params(params))
 
         cnm = cnm.fit(images)
         return [idx_, shapes, scipy.sparse.coo_matrix(cnm.estimates.A),
@@ -142,9 +144,79 @@ def cnmf_patches(args_in):
                 cnm.params.to_dict(), cnm.estimates.YrA]
     else:
         return None
+
+
+def _patch_params(params):
+    """ parameters of CNMF within a patch """
+    opts = copy(params)
+    opts.set('patch', {'n_processes': 1, 'rf': None, 'stride': None})
+    for group in ('init', 'temporal', 'spatial'):
+        opts.set(group, {'nb': params.get('patch', 'nb_patch')})
+    for group in ('preprocess', 'temporal'):
+        opts.set(group, {'p': params.get('patch', 'p_patch')})
+    return opts
+
+
+# parameters that do not change the results of a patch, left out of the keys of the patch cache
+_patch_key_ignored = {'fnames', 'mmap_F', 'mmap_C', 'n_processes', 'memory_fact', 'n_pixels_per_process',
+                      'retries', 'task_timeout', 'speculative', 'cache_dir', 'cache_size',
+                      # used when merging the results of the patches, not on each patch
+                      'del_duplicates', 'low_rank_background', 'remove_very_bad_comps'}
+
+
+def _patch_key(fingerprint: str, dims, idx_, params) -> str:
+    """ key of the result of a patch in the patch cache, from the movie, the patch and the parameters used by CNMF on it """
+    opts = _patch_params(params)
+    groups = ['data', 'init', 'preprocess', 'patch']
+    if not params.get('patch', 'only_init'):
+        groups += ['spatial', 'temporal', 'merging']
+    used = {group: {key: val for key, val in opts.get_group(group).items() if key not in _patch_key_ignored}
+            for group in groups}
+    return hash_content(fingerprint, tuple(dims), np.asarray(idx_), used)
 # %%
 
 
+class _RowBuffer(object):
+    """ rows of a float32 matrix appended as they come, grown by amortized reallocation """
+
+    def __init__(self, n_cols: int, capacity: int = 16) -> None:
+        self.data = np.zeros((capacity, n_cols), dtype=np.float32)
+        self.n_rows = 0
+
+    def append(self, rows) -> None:
+        rows = np.atleast_2d(rows)
+        n_rows = self.n_rows + len(rows)
+        if n_rows > len(self.data):
+            # in place when possible, the buffer is not referenced elsewhere
+            self.data.resize((max(n_rows, 3 * len(self.data) // 2 + 1), self.data.shape[1]), refcheck=False)
+        self.data[self.n_rows:n_rows] = rows
+        self.n_rows = n_rows
+
+    def finalize(self) -> np.ndarray:
+        """ the matrix of the rows appended, the buffer being trimmed in place """
+        self.data.resize((self.n_rows, self.data.shape[1]), refcheck=False)
+        return self.data
+
+
+def _take_rows(X: np.ndarray, order) -> np.ndarray:
+    """ X[order] for a permutation order, computed in place following its cycles """
+    done = np.zeros(len(order), dtype=bool)
+    for start in range(len(order)):
+        if done[start]:
+            continue
+        done[start] = True
+        if order[start] == start:
+            continue
+        row = X[start].copy()
+        i = start
+        while order[i] != start:
+            X[i] = X[order[i]]
+            i = order[i]
+            done[i] = True
+        X[i] = row
+    return X
+
+
 def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                      memory_fact=1, border_pix=0, low_rank_background=True,
                      del_duplicates=False, indices=[slice(None)]*3):
@@ -179,7 +251,8 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
         memory_fact: double
             unitless number accounting how much memory should be used.
             It represents the fration of patch processed in a single thread.
-             You will need to try different values to see which one would work
+            The number of patches processed at the same time is limited by the memory budget
+            (see caiman.cluster.set_memory_budget)
 
         low_rank_background: bool
             if True the background is approximated with gnb components. If false every patch keeps its background (overlaps are randomly assigned to one spatial component only)
@@ -228,49 +301,65 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     params_copy.set('spatial', {'n_pixels_per_process': npx_per_proc})
     params_copy.set('temporal', {'n_pixels_per_process': npx_per_proc})
 
+    # the parameters are sent once to the workers rather than with every patch
+    params_handle = broadcast(params_copy, dview)
+
     idx_flat, idx_2d = extract_patch_coordinates(
         dims, rfs, strides, border_pix=border_pix, indices=indices[1:])
     args_in = []
     patch_centers = []
     for id_f, id_2d in zip(idx_flat, idx_2d):
         #        print(id_2d)
-        args_in.append((file_name, id_f, id_2d, params_copy))
+        args_in.append((file_name, id_f, id_2d, params_handle))
         if del_duplicates:
             foo = np.zeros(d, dtype=bool)
             foo[id_f] = 1
             patch_centers.append(scipy.ndimage.center_of_mass(
                 foo.reshape(dims, order='F')))
     logging.info('Patch size: {0}'.format(id_2d))
+    # the results of the patches already processed with the same movie and parameters are loaded from the cache
+    task = cnmf_patches
+    cache_dir = params.get('patch', 'cache_dir')
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir, max_bytes=params.get('patch', 'cache_size'))
+        fingerprint = file_fingerprint(file_name)
+        keys = [_patch_key(fingerprint, dims, id_f, params_copy) for id_f in idx_flat]
+        logging.info('{} of {} patches found in {}'.format(sum(key in cache for key in keys), len(keys), cache))
+        task = CachedTask(cnmf_patches, cache)
+        args_in = list(zip(keys, args_in))
+    executor = as_executor(dview)
+    # as many patches run at the same time as fit in the memory budget
+    patch_bytes = estimate_task_bytes(max(len(id_f) for id_f in idx_flat), T, copies=_patch_copies,
+                                      K=params.get('init', 'K') or 0)
+    plan = get_memory_budget().plan('CNMF patches', patch_bytes, 1, len(executor))
     st = time.time()
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            file_res = dview.map_async(cnmf_patches, args_in).get(4294967)
-        else:
-            try:
-                file_res = dview.map_sync(cnmf_patches, args_in)
-                dview.results.clear()
-            except:
-                print('Something went wrong')
-                raise
-            finally:
-                logging.info('Patch processing complete')
-
-    else:
-        file_res = list(map(cnmf_patches, args_in))
-
-    logging.info('Elapsed time for processing patches: \
-                 {0}s'.format(str(time.time() - st).split('.')[0]))
-    # count components
-    count = 0
+    center_psf = params.get('init', 'center_psf')
+    num_patches = len(args_in)
+    # the results of the patches are folded into the whole FOV as they finish, and released. The
+    # traces are appended to growing buffers, with the patch of each row. The patches failed after
+    # all their attempts are left out as the empty ones
+    C_buf, YrA_buf, F_buf = _RowBuffer(T), _RowBuffer(T), _RowBuffer(T)
+    S_buf = _RowBuffer(T) if center_psf else None
+    comp_patch: List[int] = []
+    bgr_patch: List[int] = []
+    # patch index -> (idx_, shapes, spatial components, background components, f, bl, c1, neurons_sn, g)
+    patches: Dict[int, Tuple] = {}
+    mask = np.zeros(d, dtype=np.uint8)
+    sn_tot = np.zeros((d))
     count_bgr = 0
-    patch_id = 0
-    num_patches = len(file_res)
-    for jj, fff in enumerate(file_res):
-        if fff is not None:
+    report = MapReport()
+    logging.info('Embedding patches results into whole FOV')
+    try:
+        for jj, fff in executor.imap_unordered(task, args_in, with_index=True, plan=plan,
+                                               progress=progress_logger('CNMF patches'),
+                                               retries=params.get('patch', 'retries'),
+                                               task_timeout=params.get('patch', 'task_timeout'),
+                                               speculative=params.get('patch', 'speculative'),
+                                               on_error='skip', report=report):
+            if fff is None:
+                continue
             idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
-            for _ in range(np.shape(b)[-1]):
-                count_bgr += 1
-
+            del fff
             A = A.tocsc()
             if del_duplicates:
                 keep = []
@@ -282,94 +371,79 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                                   np.array(patch_centers)]) == jj:
                         keep.append(ii)
                 A = A[:, keep]
-                file_res[jj][2] = A
-                file_res[jj][4] = C[keep]
+                C = C[keep]
                 if S is not None:
-                    file_res[jj][6] = S[keep]
-                    file_res[jj][7] = bl[keep]
-                    file_res[jj][8] = c1[keep]
-                    file_res[jj][9] = neurons_sn[keep]
-                    file_res[jj][10] = g[keep]
-                file_res[jj][-1] = YrA[keep]
-
-            # for ii in range(np.shape(A)[-1]):
-            #     new_comp = A[:, ii] / np.sqrt(A[:, ii].power(2).sum())
-            #     if new_comp.sum() > 0:
-            #         count += 1
-            count += np.sum(A.sum(0) > 0)
-
-            patch_id += 1
-
-    # INITIALIZING
-    nb_patch = params.get('patch', 'nb_patch')
-    C_tot = np.zeros((count, T), dtype=np.float32)
-    if params.get('init', 'center_psf'):
-        S_tot = np.zeros((count, T), dtype=np.float32)
-    else:
-        S_tot = None
-    YrA_tot = np.zeros((count, T), dtype=np.float32)
-    F_tot = np.zeros((max(0, num_patches * nb_patch), T), dtype=np.float32)
-    mask = np.zeros(d, dtype=np.uint8)
-    sn_tot = np.zeros((d))
-
-    f_tot, bl_tot, c1_tot, neurons_sn_tot, g_tot, idx_tot, id_patch_tot, shapes_tot = [
-    ], [], [], [], [], [], [], []
-    patch_id, empty, count_bgr, count = 0, 0, 0, 0
-    idx_tot_B, idx_tot_A, a_tot, b_tot = [], [], [], []
-    idx_ptr_B, idx_ptr_A = [0], [0]
-
-    # instead of filling in the matrices, construct lists with their non-zero
-    # entries and coordinates
-    logging.info('Embedding patches results into whole FOV')
-    for fff in file_res:
-        if fff is not None:
-
-            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
-            A = A.tocsc()
+                    S, bl, c1, neurons_sn, g = S[keep], bl[keep], c1[keep], neurons_sn[keep], g[keep]
+                YrA = YrA[keep]
 
             sn_tot[idx_] = sn
-            f_tot.append(f)
-            bl_tot.append(bl)
-            c1_tot.append(c1)
-            neurons_sn_tot.append(neurons_sn)
-            g_tot.append(g)
-            idx_tot.append(idx_)
-            shapes_tot.append(shapes)
             mask[idx_] += 1
 
+            # instead of filling in the matrices, construct lists with their non-zero
+            # entries and coordinates
+            a_patch = []
+            for ii in range(np.shape(A)[-1]):
+                new_comp = A[:, ii]  # / np.sqrt(A[:, ii].power(2).sum())
+                if new_comp.sum() > 0:
+                    a_patch.append(new_comp.toarray().flatten())
+                    C_buf.append(C[ii, :])
+                    if center_psf:
+                        S_buf.append(S[ii, :])
+                    YrA_buf.append(YrA[ii, :])
+                    comp_patch.append(jj)
+
             if scipy.sparse.issparse(b):
                 b = scipy.sparse.csc_matrix(b)
-                b_tot.append(b.data)
-                idx_ptr_B += list(b.indptr[1:] - b.indptr[:-1])
-                idx_tot_B.append(idx_[b.indices])
+                b_patch = ([b.data], [idx_[b.indices]], list(b.indptr[1:] - b.indptr[:-1]))
             else:
-                for ii in range(np.shape(b)[-1]):
-                    b_tot.append(b[:, ii])
-                    idx_tot_B.append(idx_)
-                    idx_ptr_B.append(len(idx_))
-                    # F_tot[patch_id, :] = f[ii, :]
+                b_patch = ([b[:, ii] for ii in range(np.shape(b)[-1])], [idx_] * np.shape(b)[-1],
+                           [len(idx_)] * np.shape(b)[-1])
             count_bgr += b.shape[-1]
-            if nb_patch >= 0:
-                F_tot[patch_id * nb_patch:(patch_id + 1) * nb_patch] = f
-            else:  # full background per patch
-                F_tot = np.concatenate([F_tot, f])
+            if f is not None:
+                F_buf.append(f)
+                bgr_patch += [jj] * np.atleast_2d(f).shape[0]
+            patches[jj] = (idx_, shapes, a_patch, b_patch, f, bl, c1, neurons_sn, g)
+            del A, b, C, S, YrA
+    finally:
+        release(params_handle)
+        if cache_dir is not None:
+            cache.evict()
+        logging.info('Patch processing complete')
 
-            for ii in range(np.shape(A)[-1]):
-                new_comp = A[:, ii]  # / np.sqrt(A[:, ii].power(2).sum())
-                if new_comp.sum() > 0:
-                    a_tot.append(new_comp.toarray().flatten())
-                    idx_tot_A.append(idx_)
-                    idx_ptr_A.append(len(idx_))
-                    C_tot[count, :] = C[ii, :]
-                    if params.get('init', 'center_psf'):
-                        S_tot[count, :] = S[ii, :]
-                    YrA_tot[count, :] = YrA[ii, :]
-                    id_patch_tot.append(patch_id)
-                    count += 1
-
-            patch_id += 1
-        else:
-            empty += 1
+    logging.info('Elapsed time for processing patches: \
+                 {0}s'.format(str(time.time() - st).split('.')[0]))
+
+    # the components are ordered as the patches, whatever the order in which these finished
+    order = sorted(patches)
+    patch_ids = {jj: patch_id for patch_id, jj in enumerate(order)}
+    comp_order = np.argsort(comp_patch, kind='stable')
+    C_tot = _take_rows(C_buf.finalize(), comp_order)
+    YrA_tot = _take_rows(YrA_buf.finalize(), comp_order)
+    S_tot = _take_rows(S_buf.finalize(), comp_order) if center_psf else None
+    F_tot = _take_rows(F_buf.finalize(), np.argsort(bgr_patch, kind='stable'))
+    id_patch_tot = [patch_ids[comp_patch[i]] for i in comp_order]
+    count = len(comp_patch)
+    empty = num_patches - len(order)
+    del C_buf, YrA_buf, S_buf, F_buf, comp_patch, bgr_patch
+
+    f_tot, bl_tot, c1_tot, neurons_sn_tot, g_tot, idx_tot, shapes_tot = [], [], [], [], [], [], []
+    idx_tot_B, idx_tot_A, a_tot, b_tot = [], [], [], []
+    idx_ptr_B, idx_ptr_A = [0], [0]
+    for jj in order:
+        idx_, shapes, a_patch, b_patch, f, bl, c1, neurons_sn, g = patches.pop(jj)
+        f_tot.append(f)
+        bl_tot.append(bl)
+        c1_tot.append(c1)
+        neurons_sn_tot.append(neurons_sn)
+        g_tot.append(g)
+        idx_tot.append(idx_)
+        shapes_tot.append(shapes)
+        a_tot += a_patch
+        idx_tot_A += [idx_] * len(a_patch)
+        idx_ptr_A += [len(idx_)] * len(a_patch)
+        b_tot += b_patch[0]
+        idx_tot_B += b_patch[1]
+        idx_ptr_B += b_patch[2]
 
     logging.debug('Skipped %d empty patches', empty)
     if count_bgr > 0:
@@ -388,10 +462,6 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     A_tot = scipy.sparse.csc_matrix(
         (a_tot, idx_tot_A, idx_ptr_A), shape=(d, count), dtype=np.float32)
 
-    C_tot = C_tot[:count, :]
-    YrA_tot = YrA_tot[:count, :]
-    F_tot = F_tot[:count_bgr]
-
     optional_outputs = dict()
     optional_outputs['b_tot'] = b_tot
     optional_outputs['f_tot'] = f_tot
@@ -406,6 +476,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     optional_outputs['B'] = B_tot
     optional_outputs['F'] = F_tot
     optional_outputs['mask'] = mask
+    optional_outputs['failures'] = report.failures
 
     logging.info("Constructing background")
 
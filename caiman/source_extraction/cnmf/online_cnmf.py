@@ -47,7 +47,7 @@ from ... import mmapping
 from ...components_evaluation import compute_event_exceptionality
 from ...motion_correction import (motion_correct_iteration_fast,
                                   tile_and_correct, high_pass_filter_space,
-                                  sliding_window)
+                                  sliding_window, TemplateRegistrar)
 from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap, load_graph
 from ...utils.stats import pd_solve
 from ... import summary_images
@@ -1146,9 +1146,36 @@ class OnACID(object):
         self.t_detect:List = []
         self.t_motion:List = []
         self.t_stat:List = []
+        templ_cache = MotionTemplateCache(refresh=self.params.get('online', 'motion_template_refresh'),
+                                          window=self.params.get('online', 'motion_template_window'),
+                                          mode=self.params.get('online', 'motion_template_activity'),
+                                          upsample_factor=10, max_shifts=self.params.motion['max_shifts'],
+                                          use_fftw=self.params.motion['use_fftw'],
+                                          fftw_wisdom=self.params.motion['fftw_wisdom'])
+        self.t_template = templ_cache.t_template
         ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
         d1, d2 = self.params.get('data', 'dims')
         max_shifts_online = self.params.get('online', 'max_shifts_online')
+
+        def build_template(activity):
+            # template for the motion correction of the current frame frame_
+            templ = self.estimates.Ab.dot(activity).reshape(self.params.get('data', 'dims'), order='F')#*self.img_norm
+            if self.is1p and self.estimates.W is not None:
+                if ssub_B == 1:
+                    B = self.estimates.W.dot((frame_ - templ).flatten(order='F') - self.estimates.b0) + self.estimates.b0
+                    B = B.reshape(self.params.get('data', 'dims'), order='F')
+                else:
+                    b0 = self.estimates.b0.reshape((d1, d2), order='F')#*self.img_norm
+                    bc2 = downscale(frame_ - templ - b0, (ssub_B, ssub_B)).flatten(order='F')
+                    Wb = self.estimates.W.dot(bc2).reshape(((d1 - 1) // ssub_B + 1, (d2 - 1) // ssub_B + 1), order='F')
+                    B = b0 + np.repeat(np.repeat(Wb, ssub_B, 0), ssub_B, 1)[:d1, :d2]
+                templ += B
+            if self.params.get('online', 'normalize'):
+                templ *= self.img_norm
+            if self.is1p:
+                templ = high_pass_filter_space(templ, self.params.motion['gSig_filt'])
+            return templ
+
         if extra_files == 0:     # check whether there are any additional files
             process_files = fls[:init_files]     # end processing at this file
             init_batc_iter = [init_batch]         # place where to start
@@ -1172,115 +1199,119 @@ class OnACID(object):
                 process_files = fls[:init_files + extra_files]
                 init_batc_iter = [0] * (extra_files + init_files)
 
+            prefetch = self.params.get('online', 'prefetch_queue') > 0
+            if prefetch:
+                # frames (across files) are read ahead of the processing
+                frame_iter = caiman.base.movies.PrefetchIterator(
+                    process_files, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
+                    subindices=[slice(init_batc, None, None) for init_batc in init_batc_iter],
+                    queue_size=self.params.get('online', 'prefetch_queue'),
+                    num_threads=self.params.get('online', 'prefetch_threads'))
+
         #     Go through all files
-            for file_count, ffll in enumerate(process_files):
-                logging.warning('Now processing file {}'.format(ffll))
-                Y_ = caiman.base.movies.load_iter(
-                    ffll, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
-                    subindices=slice(init_batc_iter[file_count], None, None))
-
-                old_comps = self.N     # number of existing components
-                frame_count = -1
-                while True:   # process each file
-                    try:
-                        frame = next(Y_)
-                        if model_LN is not None:
-                            if self.params.get('ring_CNN', 'remove_activity'):
-                                activity = self.estimates.Ab[:,:self.N].dot(self.estimates.C_on[:self.N, t-1]).reshape(self.params.get('data', 'dims'), order='F')
-                                if self.params.get('online', 'normalize'):
-                                    activity *= self.img_norm
-                            else:
-                                activity = 0.
-#                                frame = frame.astype(np.float32) - activity
-                            frame = frame - np.squeeze(model_LN.predict(np.expand_dims(np.expand_dims(frame.astype(np.float32) - activity, 0), -1)))
-                            frame = np.maximum(frame, 0)
-                        frame_count += 1
-                        t_frame_start = time()
-                        if np.isnan(np.sum(frame)):
-                            raise Exception('Frame ' + str(frame_count) +
-                                            ' contains NaN')
-                        if t % 500 == 0:
-                            logging.info('Epoch: ' + str(iter + 1) + '. ' + str(t) +
-                                         ' frames have beeen processed in total. ' +
-                                         str(self.N - old_comps) +
-                                         ' new components were added. Total # of components is '
-                                         + str(self.estimates.Ab.shape[-1] - self.params.get('init', 'nb')))
-                            old_comps = self.N
-
-                        # Downsample and normalize
-                        frame_ = frame.copy().astype(np.float32)
-                        if self.params.get('online', 'ds_factor') > 1:
-                            frame_ = cv2.resize(frame_, self.img_norm.shape[::-1])
-
-                        if self.params.get('online', 'normalize'):
-                            frame_ -= self.img_min     # make data non-negative
-                        t_mot = time()
-
-                        # Motion Correction
-                        if self.params.get('online', 'motion_correct'):    # motion correct
-                            templ = self.estimates.Ab.dot(
-                                    np.median(self.estimates.C_on[:self.M, t-51:t-1], 1)).reshape(self.params.get('data', 'dims'), order='F')#*self.img_norm
-                            if self.is1p and self.estimates.W is not None:
-                                if ssub_B == 1:
-                                    B = self.estimates.W.dot((frame_ - templ).flatten(order='F') - self.estimates.b0) + self.estimates.b0
-                                    B = B.reshape(self.params.get('data', 'dims'), order='F')
+            try:
+                for file_count, ffll in enumerate(process_files):
+                    logging.warning('Now processing file {}'.format(ffll))
+                    if prefetch:
+                        Y_ = frame_iter.iter_file(file_count)
+                    else:
+                        Y_ = caiman.base.movies.load_iter(
+                            ffll, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
+                            subindices=slice(init_batc_iter[file_count], None, None))
+
+                    old_comps = self.N     # number of existing components
+                    frame_count = -1
+                    while True:   # process each file
+                        try:
+                            frame = next(Y_)
+                            if model_LN is not None:
+                                if self.params.get('ring_CNN', 'remove_activity'):
+                                    activity = self.estimates.Ab[:,:self.N].dot(self.estimates.C_on[:self.N, t-1]).reshape(self.params.get('data', 'dims'), order='F')
+                                    if self.params.get('online', 'normalize'):
+                                        activity *= self.img_norm
                                 else:
-                                    b0 = self.estimates.b0.reshape((d1, d2), order='F')#*self.img_norm
-                                    bc2 = downscale(frame_ - templ - b0, (ssub_B, ssub_B)).flatten(order='F')
-                                    Wb = self.estimates.W.dot(bc2).reshape(((d1 - 1) // ssub_B + 1, (d2 - 1) // ssub_B + 1), order='F')
-                                    B = b0 + np.repeat(np.repeat(Wb, ssub_B, 0), ssub_B, 1)[:d1, :d2]
-                                templ += B
+                                    activity = 0.
+    #                                frame = frame.astype(np.float32) - activity
+                                frame = frame - np.squeeze(model_LN.predict(np.expand_dims(np.expand_dims(frame.astype(np.float32) - activity, 0), -1)))
+                                frame = np.maximum(frame, 0)
+                            frame_count += 1
+                            t_frame_start = time()
+                            if np.isnan(np.sum(frame)):
+                                raise Exception('Frame ' + str(frame_count) +
+                                                ' contains NaN')
+                            if t % 500 == 0:
+                                logging.info('Epoch: ' + str(iter + 1) + '. ' + str(t) +
+                                             ' frames have beeen processed in total. ' +
+                                             str(self.N - old_comps) +
+                                             ' new components were added. Total # of components is '
+                                             + str(self.estimates.Ab.shape[-1] - self.params.get('init', 'nb')))
+                                old_comps = self.N
+
+                            # Downsample and normalize
+                            frame_ = frame.copy().astype(np.float32)
+                            if self.params.get('online', 'ds_factor') > 1:
+                                frame_ = cv2.resize(frame_, self.img_norm.shape[::-1])
+
                             if self.params.get('online', 'normalize'):
-                                templ *= self.img_norm
-                            if self.is1p:
-                                templ = high_pass_filter_space(templ, self.params.motion['gSig_filt'])
-                            if self.params.get('motion', 'pw_rigid'):
-                                frame_cor, shift, _, xy_grid = tile_and_correct(frame_, templ, self.params.motion['strides'], self.params.motion['overlaps'],
-                                                                                self.params.motion['max_shifts'], newoverlaps=None, newstrides=None, upsample_factor_grid=4,
-                                                                                upsample_factor_fft=10, show_movie=False, max_deviation_rigid=self.params.motion['max_deviation_rigid'],
-                                                                                add_to_movie=0, shifts_opencv=True, gSig_filt=None,
-                                                                                use_cuda=False, border_nan='copy')
+                                frame_ -= self.img_min     # make data non-negative
+                            t_mot = time()
+
+                            # Motion Correction
+                            if self.params.get('online', 'motion_correct'):    # motion correct
+                                # the template (and its FFTs) is rebuilt every motion_template_refresh frames
+                                registrar = templ_cache.get(self.estimates.C_on[:self.M], t, build_template)
+                                templ = templ_cache.template
+                                if self.params.get('motion', 'pw_rigid'):
+                                    frame_cor, shift, _, xy_grid = tile_and_correct(frame_, templ, self.params.motion['strides'], self.params.motion['overlaps'],
+                                                                                    self.params.motion['max_shifts'], newoverlaps=None, newstrides=None, upsample_factor_grid=4,
+                                                                                    upsample_factor_fft=10, show_movie=False, max_deviation_rigid=self.params.motion['max_deviation_rigid'],
+                                                                                    add_to_movie=0, shifts_opencv=True, gSig_filt=None,
+                                                                                    use_cuda=False, border_nan='copy', registrar=registrar)
+                                else:
+                                    if self.is1p:
+                                        frame_orig = frame_.copy()
+                                        frame_ = high_pass_filter_space(frame_, self.params.motion['gSig_filt'])
+                                    frame_cor, shift = motion_correct_iteration_fast(
+                                            frame_, registrar, max_shifts_online, max_shifts_online)
+                                    if self.is1p:
+                                        M = np.float32([[1, 0, shift[1]], [0, 1, shift[0]]])
+                                        frame_cor = cv2.warpAffine(
+                                            frame_orig, M, frame_.shape[::-1], flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REFLECT)
+
+                                self.estimates.shifts.append(shift)
                             else:
-                                if self.is1p:
-                                    frame_orig = frame_.copy()
-                                    frame_ = high_pass_filter_space(frame_, self.params.motion['gSig_filt'])
-                                frame_cor, shift = motion_correct_iteration_fast(
-                                        frame_, templ, max_shifts_online, max_shifts_online)
-                                if self.is1p:
-                                    M = np.float32([[1, 0, shift[1]], [0, 1, shift[0]]])
-                                    frame_cor = cv2.warpAffine(
-                                        frame_orig, M, frame_.shape[::-1], flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REFLECT)
-
-                            self.estimates.shifts.append(shift)
-                        else:
-                            templ = None
-                            frame_cor = frame_
+                                templ = None
+                                frame_cor = frame_
 
-                        self.t_motion.append(time() - t_mot)
+                            self.t_motion.append(time() - t_mot)
                         
-                        if self.params.get('online', 'normalize'):
-                            frame_cor = frame_cor/self.img_norm
-                        # Fit next frame
-                        self.fit_next(t, frame_cor.reshape(-1, order='F'))
-                        # Show
-                        if self.params.get('online', 'show_movie'):
-                            self.t = t
-                            vid_frame = self.create_frame(frame_cor, resize_fact=resize_fact)
-                            if self.params.get('online', 'save_online_movie'):
-                                out.write(vid_frame)
-                                for rp in range(len(self.estimates.ind_new)*2):
+                            if self.params.get('online', 'normalize'):
+                                frame_cor = frame_cor/self.img_norm
+                            # Fit next frame
+                            self.fit_next(t, frame_cor.reshape(-1, order='F'))
+                            # Show
+                            if self.params.get('online', 'show_movie'):
+                                self.t = t
+                                vid_frame = self.create_frame(frame_cor, resize_fact=resize_fact)
+                                if self.params.get('online', 'save_online_movie'):
                                     out.write(vid_frame)
+                                    for rp in range(len(self.estimates.ind_new)*2):
+                                        out.write(vid_frame)
 
-                            cv2.imshow('frame', vid_frame)
-                            for rp in range(len(self.estimates.ind_new)*2):
                                 cv2.imshow('frame', vid_frame)
-                            if cv2.waitKey(1) & 0xFF == ord('q'):
-                                break
-                        t += 1
-                        t_online.append(time() - t_frame_start)
-                    except  (StopIteration, RuntimeError):
-                        break
-        
+                                for rp in range(len(self.estimates.ind_new)*2):
+                                    cv2.imshow('frame', vid_frame)
+                                if cv2.waitKey(1) & 0xFF == ord('q'):
+                                    break
+                            t += 1
+                            t_online.append(time() - t_frame_start)
+                        except  (StopIteration, RuntimeError):
+                            break
+            finally:
+                if prefetch:
+                    # stop the reading threads also if the processing fails
+                    frame_iter.close()
+
             self.Ab_epoch.append(self.estimates.Ab.copy())
 
         if self.params.get('online', 'normalize'):
@@ -1977,6 +2008,54 @@ class RingBuffer(np.ndarray):
             return np.concatenate([self[(self.cur - num_frames):], self[:self.cur]], axis=0)
 
 
+class MotionTemplateCache(object):
+    """ caches the TemplateRegistrar of the online motion correction. The template
+    is rebuilt every refresh frames from the activity of the components, either the
+    median over the last window frames ('median') or an exponential moving average
+    with time constant window frames, updated at every frame ('ema')"""
+
+    def __init__(self, refresh=1, window=50, mode='median', **registrar_kwargs):
+        self.refresh = refresh
+        self.window = window
+        self.mode = mode
+        self.registrar_kwargs = registrar_kwargs
+        self.activity = None
+        self.registrar = None
+        self.template = None
+        self.t_built = None
+        self.t_template:List = []
+
+    def get(self, C, t, build_template):
+        """ returns the TemplateRegistrar for frame t
+
+        Args:
+            C: np.ndarray
+                temporal traces of the components (# components X time)
+
+            t: int
+                current frame, the activity up to frame t-1 is used
+
+            build_template: callable
+                maps the activity of the components to the template image
+
+        Returns:
+            registrar: TemplateRegistrar
+        """
+        t_start = time()
+        if self.mode == 'ema':
+            if self.activity is None or len(self.activity) != len(C):
+                self.activity = np.median(C[:, t - self.window - 1:t - 1], 1)
+            else:
+                self.activity = self.activity + (C[:, t - 1] - self.activity) / self.window
+        if self.registrar is None or t - self.t_built >= self.refresh:
+            activity = self.activity if self.mode == 'ema' else np.median(C[:, t - self.window - 1:t - 1], 1)
+            self.template = build_template(activity)
+            self.registrar = TemplateRegistrar(self.template, **self.registrar_kwargs)
+            self.t_built = t
+        self.t_template.append(time() - t_start)
+        return self.registrar
+
+
 #%%
 def csc_append(a, b):
     """ Takes in 2 csc_matrices and appends the second one to the right of the first one.
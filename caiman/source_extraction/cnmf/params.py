@@ -132,6 +132,26 @@ class CNMFParams(object):
             in_memory: bool, default: True
                 Whether to load patches in memory
 
+            retries: int, default: 1
+                Number of times a patch that failed or timed out is processed again. Patches failed
+                after all their attempts are left out of the results
+
+            task_timeout: float or None, default: None
+                Maximum time (s) for processing a patch
+
+            speculative: float or None, default: None
+                Fraction of the patches processed after which the slowest patches are processed
+                again by the idle workers (within the memory budget). None to never process a patch
+                twice at the same time
+
+            cache_dir: str or None, default: None
+                Directory where the results of the patches are cached. The patches processed before
+                with the same movie and parameters are loaded from it rather than processed again
+
+            cache_size: int or str, default: 10GB
+                Size of the patch cache (e.g. '20GB') above which the least recently used results
+                are removed
+
         PRE-PROCESS PARAMS (CNMFParams.preprocess) #############
 
             sn: np.array or None, default: None
@@ -463,6 +483,17 @@ class CNMFParams(object):
             motion_correct: bool, default: True
                 Whether to perform motion correction during online processing
 
+            motion_template_activity: str, default: 'median'
+                Activity of the components used for building the motion template. 'median' for the median
+                over the last motion_template_window frames, 'ema' for an exponential moving average (updated
+                at each frame) with time constant motion_template_window
+
+            motion_template_refresh: int, default: 1
+                Rebuild the motion template (and its FFTs) every X frames. In between the cached template is used
+
+            motion_template_window: int, default: 50
+                Number of frames over which the activity of the components is averaged for the motion template
+
             movie_name_online: str, default: 'online_movie.avi'
                 Name of saved movie (appended in the data directory)
 
@@ -480,6 +511,15 @@ class CNMFParams(object):
             path_to_model: str, default: os.path.join(caiman_datadir(), 'model', 'cnn_model_online.h5')
                 Path to online CNN classifier
 
+            prefetch_queue: int, default: 0
+                Number of chunks of frames read ahead in the background during online processing (reading
+                continues across consecutive files). If 0 frames are read synchronously. A positive value
+                starts prefetch_threads reading threads that run concurrently with the processing of the
+                frames (and with the threads of numpy/OpenCV)
+
+            prefetch_threads: int, default: 2
+                Number of threads used for reading and decoding the prefetched frames
+
             rval_thr: float, default: 0.8
                 space correlation threshold for accepting a new component
 
@@ -544,6 +584,12 @@ class CNMFParams(object):
             min_mov: float or None, default: None
                 minimum value of movie. If None it get computed.
 
+            mmap_dtype: str, default: 'float32'
+                data type of the memory mapped files of the corrected movie ('float32', 'float16' or
+                'uint16'). uint16 keeps the data of 16 bit cameras at half the size of float32, the offset
+                added to the movie is then stored in the header of the file. CNMF.fit_file needs float32 or
+                float16
+
             niter_rig: int, default: 1
                 number of iterations rigid motion correction.
 
@@ -562,6 +608,14 @@ class CNMFParams(object):
             pw_rigid: bool, default: False
                 flag for performing pw-rigid motion correction.
 
+            pyramid_levels: int, default: 0
+                number of levels (each downsampling by 2) of the coarse-to-fine search of the rigid shifts.
+                Useful for large max_shifts. 0 searches the shifts at full resolution
+
+            resume: bool, default: False
+                flag for resuming an interrupted motion correction. The chunks recorded as finished in the
+                journal next to the output memory mapped file are not processed again
+
             shifts_opencv: bool, default: True
                 flag for applying shifts using cubic interpolation (otherwise FFT)
 
@@ -583,6 +637,12 @@ class CNMFParams(object):
             indices: tuple(slice), default: (slice(None), slice(None))
                 Use that to apply motion correction only on a part of the FOV
 
+            use_fftw: bool, default: False
+                flag for computing the FFTs of the registration with pyFFTW plans (if available)
+
+            fftw_wisdom: str or None, default: None
+                file where the pyFFTW wisdom is loaded from and stored to. If None wisdom is not persisted
+
         RING CNN PARAMETERS (CNMFParams.ring_CNN)
 
             n_channels: int, default: 2
@@ -641,6 +701,8 @@ class CNMFParams(object):
 
         self.patch = {
             'border_pix': border_pix,
+            'cache_dir': None,
+            'cache_size': 10 * 2**30,
             'del_duplicates': del_duplicates,
             'in_memory': True,
             'low_rank_background': low_rank_background,
@@ -650,11 +712,14 @@ class CNMFParams(object):
             'only_init': only_init_patch,
             'p_patch': 0,                 # AR order within patch
             'remove_very_bad_comps': remove_very_bad_comps,
+            'retries': 1,
             'rf': rf,
             'skip_refinement': False,
+            'speculative': None,
             'p_ssub': p_ssub,             # spatial downsampling factor
             'stride': stride,
             'p_tsub': p_tsub,             # temporal downsampling factor
+            'task_timeout': None,
         }
 
         self.preprocess = {
@@ -803,6 +868,9 @@ class CNMFParams(object):
             'minibatch_shape': minibatch_shape,  # number of frames in each minibatch
             'minibatch_suff_stat': minibatch_suff_stat,
             'motion_correct': True,            # flag for motion correction
+            'motion_template_activity': 'median',  # activity for the motion template ('median' or 'ema')
+            'motion_template_refresh': 1,      # rebuild the motion template every X frames
+            'motion_template_window': 50,      # number of frames for the activity of the motion template
             'movie_name_online': 'online_movie.mp4',  # filename of saved movie (appended to directory where data is located)
             'normalize': False,                # normalize frame
             'n_refit': n_refit,                # Additional iterations to simultaneously refit
@@ -811,6 +879,8 @@ class CNMFParams(object):
             'opencv_codec': 'H264',            # FourCC video codec for saving movie. Check http://www.fourcc.org/codecs.php
             'path_to_model': os.path.join(caiman_datadir(), 'model',
                                           'cnn_model_online.h5'),
+            'prefetch_queue': 0,               # number of chunks of frames read ahead (0 to disable)
+            'prefetch_threads': 2,             # number of threads for reading ahead
             'ring_CNN': False,                 # flag for using a ring CNN background model 
             'rval_thr': rval_thr,              # space correlation threshold
             'save_online_movie': False,        # flag for saving online movie
@@ -838,6 +908,7 @@ class CNMFParams(object):
             'max_deviation_rigid': 3,           # maximum deviation between rigid and non-rigid
             'max_shifts': (6, 6),               # maximum shifts per dimension (in pixels)
             'min_mov': None,                    # minimum value of movie
+            'mmap_dtype': 'float32',            # data type of the memory mapped corrected movie
             'niter_rig': 1,                     # number of iterations rigid motion correction
             'nonneg_movie': True,               # flag for producing a non-negative movie
             'num_frames_split': 80,             # split across time every x frames
@@ -845,13 +916,17 @@ class CNMFParams(object):
             'num_splits_to_process_rig': None,  # DO NOT MODIFY
             'overlaps': (32, 32),               # overlap between patches in pw-rigid motion correction
             'pw_rigid': False,                  # flag for performing pw-rigid motion correction
+            'pyramid_levels': 0,                # levels of coarse-to-fine search of rigid shifts
+            'resume': False,                    # flag for resuming an interrupted motion correction
             'shifts_opencv': True,              # flag for applying shifts using cubic interpolation (otherwise FFT)
             'splits_els': 14,                   # number of splits across time for pw-rigid registration
             'splits_rig': 14,                   # number of splits across time for rigid registration
             'strides': (96, 96),                # how often to start a new patch in pw-rigid registration
             'upsample_factor_grid': 4,          # motion field upsampling factor during FFT shifts
             'use_cuda': False,                  # flag for using a GPU
-            'indices': (slice(None), slice(None))  # part of FOV to be corrected
+            'indices': (slice(None), slice(None)),  # part of FOV to be corrected
+            'use_fftw': False,                  # flag for using pyFFTW plans for registration
+            'fftw_wisdom': None                 # file for persisting pyFFTW wisdom
         }
 
         self.ring_CNN = {
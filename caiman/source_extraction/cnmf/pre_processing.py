@@ -24,6 +24,7 @@ import tempfile
 import logging
 from builtins import map
 from builtins import range
+from ...cluster import as_executor, get_memory_budget
 from ...mmapping import load_memmap
 from past.builtins import basestring
 from past.utils import old_div
@@ -217,7 +218,8 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
             number of processes/threads to use concurrently
 
         n_pixels_per_process: [optional] int
-            number of pixels to be simultaneously processed by each process
+            number of pixels to be simultaneously processed by each process, reduced if the
+            blocks do not fit in the memory budget (see caiman.cluster.set_memory_budget)
 
         backend: [optional] string
             the type of concurrency to be employed. only 'multithreading' for the moment
@@ -231,6 +233,14 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
     """
     folder = tempfile.mkdtemp()
 
+    executor = as_executor(dview)
+    # each task loads its pixels and computes the fft of at most max_num_samples_fft frames
+    T = Y.shape[-1]
+    T_fft = min(T, kwargs.get('max_num_samples_fft', 3072))
+    plan = get_memory_budget().plan('noise estimation', T * np.dtype(Y.dtype).itemsize + 40 * T_fft,
+                                    Y.shape[0], len(executor), max_size=n_pixels_per_process)
+    n_pixels_per_process = plan.block_size
+
     # Pre-allocate a writeable shared memory map as a container for the
     # results of the parallel computation
     pixel_groups = list(
@@ -250,28 +260,13 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
         argsin.append(
             (Y_name, Y.shape[0] - pixels_remaining, pixels_remaining, kwargs))
 
-    if dview is None:
-        print('Single Thread')
-        results = list(map(fft_psd_multithreading, argsin))
-
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                fft_psd_multithreading, argsin).get(4294967)
-        else:
-            ne = len(dview)
-            print(('Running on %d engines.' % (ne)))
-            if dview.client.profile == 'default':
-                results = dview.map_sync(fft_psd_multithreading, argsin)
-
-            else:
-                print(('PROFILE:' + dview.client.profile))
-                results = dview.map_sync(fft_psd_multithreading, argsin)
-
-    _, _, psx_ = results[0]
+    logging.debug('Running on {} workers'.format(len(executor)))
+    # the results are stored as the pixel groups finish
     sn_s = np.zeros(Y.shape[0])
-    psx_s = np.zeros((Y.shape[0], psx_.shape[-1]))
-    for idx, sn, psx_ in results:
+    psx_s = None
+    for idx, sn, psx_ in executor.imap_unordered(fft_psd_multithreading, argsin, plan=plan):
+        if psx_s is None:
+            psx_s = np.zeros((Y.shape[0], psx_.shape[-1]))
         sn_s[idx] = sn
         psx_s[idx, :] = psx_
 
@@ -31,9 +31,9 @@ import shutil
 from sklearn.decomposition import NMF
 import tempfile
 import time
-import psutil
 from typing import List
 
+from ...cluster import as_executor, broadcast, fetch, get_memory_budget, release
 from ...mmapping import load_memmap, parallel_dot_product
 from ...utils.stats import csc_column_remove
 
@@ -220,6 +220,12 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     # we create a pixel group array (chunks for the cnmf)for the parrallelization of the process
     logging.info('Updating Spatial Components using lasso lars')
     cct = np.diag(C.dot(C.T))
+    executor = as_executor(dview)
+    # each task loads its pixels, and regresses each of them on the traces of the nearby components
+    max_comps = max([len(idx) for idx in ind2_] + [0]) + 1
+    plan = get_memory_budget().plan('update spatial', T * np.dtype(Y.dtype).itemsize, np.prod(dims), len(executor),
+                                    fixed_bytes=4 * 8 * T * max_comps, max_size=n_pixels_per_process)
+    n_pixels_per_process = plan.block_size
     pixel_groups = []
     for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
         pixel_groups.append([Y_name, C_name, sn, ind2_[i:i + n_pixels_per_process], list(
@@ -228,16 +234,10 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         pixel_groups.append([Y_name, C_name, sn, ind2_[(i + n_pixels_per_process):np.prod(dims)], list(
             range(i + n_pixels_per_process, np.prod(dims))), method_ls, cct])
     #A_ = scipy.sparse.lil_matrix((d, nr + np.size(f, 0)))
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(
-                regression_ipyparallel, pixel_groups).get(4294967)
-        else:
-            parallel_result = dview.map_sync(
-                regression_ipyparallel, pixel_groups)
-            dview.results.clear()
-    else:
-        parallel_result = list(map(regression_ipyparallel, pixel_groups))
+    try:
+        parallel_result = list(executor.imap_unordered(regression_ipyparallel, pixel_groups, plan=plan))
+    finally:
+        release(C_name)
     data:List = []
     rows:List = []
     cols:List = []
@@ -277,9 +277,9 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         A_ = csr_matrix(A_)
         logging.info("Computing residuals")
         if 'memmap' in str(type(Y)):
+            # the block size is further limited by the memory budget
             bl_siz1 = Y.shape[0] // (num_blocks_per_run_spat - 1)
-            bl_siz2 = psutil.virtual_memory().available // (4*Y.shape[-1]*(num_blocks_per_run_spat + 1))
-            Y_resf = parallel_dot_product(Y, f.T, dview=dview, block_size=min(bl_siz1, bl_siz2), num_blocks_per_run=num_blocks_per_run_spat) - \
+            Y_resf = parallel_dot_product(Y, f.T, dview=dview, block_size=bl_siz1, num_blocks_per_run=num_blocks_per_run_spat) - \
                 A_.dot(C[:nr].dot(f.T))
         else:
             # Y*f' - A*(C*f')
@@ -338,8 +338,8 @@ def regression_ipyparallel(pars):
        for each pixel the search is limited to a few spatial components
 
        Args:
-           C_name: string
-                memmap C
+           C_name: string or Broadcast handle
+                memmap C, or C published by creatememmap
 
            Y_name: string
                 memmap Y
@@ -385,7 +385,7 @@ def regression_ipyparallel(pars):
         C = np.load(C_name, mmap_mode='r')
         C = np.array(C)
     else:
-        C = C_name
+        C = fetch(C_name)
 
     _, T = np.shape(C)  # initialize values
     As = []
@@ -1110,8 +1110,8 @@ def creatememmap(Y, Cf, dview):
                calcium activity of each neuron + background components
 
        Returns:
-           C_name: string
-                the memmaped name of Cf
+           C_name: Broadcast handle
+                the handle of Cf published for the workers (Cf itself if dview is None)
 
            Y_name: string
                 the memmaped name of Y
@@ -1130,8 +1130,8 @@ def creatememmap(Y, Cf, dview):
         Y_name = Y
         C_name = Cf
     else:
-        C_name = os.path.join(folder, 'C_temp.npy')
-        np.save(C_name, Cf)
+        # Cf is published once for all the workers (see caiman.cluster.broadcast)
+        C_name = broadcast(Cf, dview)
 
         if type(Y) is np.core.memmap:  # if input file is already memory mapped then find the filename
             Y_name = Y.filename
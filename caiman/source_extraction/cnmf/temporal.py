@@ -13,7 +13,6 @@ from scipy.sparse import spdiags, diags, coo_matrix, csc_matrix  # ,csgraph
 import scipy
 import numpy as np
 import platform
-import psutil
 from .deconvolution import constrained_foopsi
 from .utilities import update_order_greedy
 import sys
@@ -201,10 +200,9 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
     logging.info('Generating residuals')
 #    dview_res = None if block_size >= 500 else dview
     if 'memmap' in str(type(Y)):
+        # the block size is further limited by the memory budget
         bl_siz1 = d // (np.maximum(num_blocks_per_run_temp - 1, 1))
-        bl_siz2 = int(psutil.virtual_memory().available/(num_blocks_per_run_temp + 1) - 4*A.nnz) // int(4*T)
-        # block_size_temp
-        YA = parallel_dot_product(Y, A.tocsr(), dview=dview, block_size=min(bl_siz1, bl_siz2),
+        YA = parallel_dot_product(Y, A.tocsr(), dview=dview, block_size=bl_siz1,
                                   transpose=True, num_blocks_per_run=num_blocks_per_run_temp) * diags(1. / nA);
     else:
         YA = (A.T.dot(Y).T) * diags(1. / nA)
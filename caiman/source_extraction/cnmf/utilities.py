@@ -958,7 +958,7 @@ def get_file_size(file_name, var_name_hdf5='mov'):
     it/them in memory. An exception is thrown if the files have FOVs with
     different sizes
         Args:
-            file_name: str or list
+            file_name: str or list or MovieChain or SbxMovie
                 locations of file(s) in memory
 
             var_name_hdf5: 'str'
@@ -971,6 +971,7 @@ def get_file_size(file_name, var_name_hdf5='mov'):
             T: list
                 number of timesteps in each file
     """
+    from ...base.movies import MovieChain, SbxMovie
     if isinstance(file_name, str):
         if os.path.exists(file_name):
             _, extension = os.path.splitext(file_name)[:2]
@@ -981,8 +982,13 @@ def get_file_size(file_name, var_name_hdf5='mov'):
                 if mjv == 2:
                     extension = '.h5'
             if extension == '.tif' or extension == '.tiff':
-                tffl = tifffile.TiffFile(file_name)
-                siz = tffl.series[0].shape
+                from ...base.movies import tiff_index
+                index = tiff_index(file_name)
+                if index is not None:
+                    siz = index.shape
+                else:
+                    with tifffile.TiffFile(file_name) as tffl:
+                        siz = tffl.series[0].shape
                 T, dims = siz[0], siz[1:]
             elif extension == '.avi':
                 cap = cv2.VideoCapture(file_name)
@@ -1015,30 +1021,17 @@ def get_file_size(file_name, var_name_hdf5='mov'):
                                       'named {0}'.format(var_name_hdf5))
                         raise Exception('Variable not found. Use one of the above')
                 T, dims = siz[0], siz[1:]
-            elif extension in ('.sbx'):
-                from ...base.movies import loadmat_sbx
-                info = loadmat_sbx(file_name[:-4]+ '.mat')['info']
-                dims = tuple((info['sz']).astype(int))
-                # Defining number of channels/size factor
-                if info['channels'] == 1:
-                    info['nChan'] = 2
-                    factor = 1
-                elif info['channels'] == 2:
-                    info['nChan'] = 1
-                    factor = 2
-                elif info['channels'] == 3:
-                    info['nChan'] = 1
-                    factor = 2
-            
-                # Determine number of frames in whole file
-                T = int(os.path.getsize(
-                    file_name[:-4] + '.sbx') / info['recordsPerBuffer'] / info['sz'][1] * factor / 4 - 1)
-                
+            elif extension == '.sbx':
+                from ...base.movies import sbxshape
+                d2, d1, T = sbxshape(file_name)
+                dims = (d1, d2)
             else:
                 raise Exception('Unknown file type')
             dims = tuple(dims)
         else:
             raise Exception('File not found!')
+    elif isinstance(file_name, (MovieChain, SbxMovie)):
+        dims, T = file_name.dims, len(file_name)
     elif isinstance(file_name, tuple):
         from ...base.movies import load
         dims = load(file_name[0], var_name_hdf5=var_name_hdf5).shape
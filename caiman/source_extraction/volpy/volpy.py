@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+from ...cluster import MapReport, as_executor, progress_logger
 from . import atm
 from . import spikepursuit
 from .volparams import volparams
@@ -93,49 +94,34 @@ class VOLPY(object):
             volspike = atm.volspike
     
    
-        N = len(self.params.data['index'])
-        times = int(np.ceil(N/n_processes))
-        for j in range(times):
-            if j < (times - 1):
-                li = [k for k in range(j*n_processes, (j+1)*n_processes)]
+        args_in = []
+        for i in range(len(self.params.data['index'])):
+            ROIs = self.params.data['ROIs'][i]
+            if self.params.data['weights'] is None:
+                weights = None
             else:
-                li = [k for k in range(j*n_processes, N )]
-   
-            args_in = []
-            
-            for i in li:
-                ROIs = self.params.data['ROIs'][i]
-                if self.params.data['weights'] is None:
-                    weights = None
-                else:
-                    weights = self.params.data['weights'][i]
-                args_in.append([fnames, fr, i, ROIs, weights, self.params.volspike])
-
-            if 'multiprocessing' in str(type(dview)):
-                results_part = dview.map_async(volspike, args_in).get(4294967)
-            elif dview is not None:
-                results_part = dview.map_sync(volspike, args_in)
-            else:
-                results_part = list(map(volspike, args_in))
-                    
-            results = results + results_part
-        
+                weights = self.params.data['weights'][i]
+            args_in.append([fnames, fr, i, ROIs, weights, self.params.volspike])
+
+        # the neurons are processed as the workers become available, at most 2 per worker at a
+        # time, and collected as they finish. The estimates of the neurons that failed are None
+        results = [None] * len(args_in)
+        executor = as_executor(dview)
+        max_pending = 2 * (n_processes if n_processes is not None else len(executor))
+        report = MapReport()
+        for idx, res in executor.imap_unordered(volspike, args_in, with_index=True, max_pending=max_pending,
+                                                progress=progress_logger('VolPy'), on_error='skip', report=report):
+            results[idx] = res
+
         N = len(results)
         print(N)
-        self.estimates['spikeTimes'] = [results[i]['spikeTimes'] for i in range(N)]
-        self.estimates['trace'] = [results[i]['yFilt'] for i in range(N)]
-        self.estimates['recons_signal'] = [results[i]['recons_signal'] for i in range(N)]
-        self.estimates['spatialFilter'] = [results[i]['spatialFilter'] for i in range(N)]
-        self.estimates['templates'] = [results[i]['templates'] for i in range(N)]
-        self.estimates['cellN'] = [results[i]['cellN'] for i in range(N)]
-        self.estimates['templates'] = [results[i]['templates'] for i in range(N)]
-        self.estimates['snr'] = [results[i]['snr'] for i in range(N)]
-        self.estimates['num_spikes'] = [results[i]['num_spikes'] for i in range(N)]
-        self.estimates['passedLocalityTest'] = [results[i]['passedLocalityTest'] for i in range(N)]
-        self.estimates['low_spk'] = [results[i]['low_spk'] for i in range(N)]
-        self.estimates['weights'] = [results[i]['weights'] for i in range(N)]
-        self.estimates['bwexp'] = [results[i]['bwexp'] for i in range(N)]
-        
+        for key, name in [('spikeTimes', 'spikeTimes'), ('trace', 'yFilt'), ('recons_signal', 'recons_signal'),
+                          ('spatialFilter', 'spatialFilter'), ('templates', 'templates'), ('cellN', 'cellN'),
+                          ('snr', 'snr'), ('num_spikes', 'num_spikes'),
+                          ('passedLocalityTest', 'passedLocalityTest'), ('low_spk', 'low_spk'),
+                          ('weights', 'weights'), ('bwexp', 'bwexp')]:
+            self.estimates[key] = [None if results[i] is None else results[i][name] for i in range(N)]
+        self.estimates['failed'] = report.failed_indices
 
         return self
 
@@ -78,8 +78,8 @@ def local_correlations_fft(Y,
     """Computes the correlation image for the input dataset Y using a faster FFT based method
 
     Args:
-        Y:  np.ndarray (3D or 4D)
-            Input movie data in 3D or 4D format
+        Y:  np.ndarray (3D or 4D), or lazy movie (MovieReader, MovieChain)
+            Input movie data in 3D or 4D format. Lazy movies are read in chunks of frames
     
         eight_neighbours: Boolean
             Use 8 neighbors if true, and 4 if false for 3D data (default = True)
@@ -87,7 +87,7 @@ def local_correlations_fft(Y,
     
         swap_dim: Boolean
             True indicates that time is listed in the last axis of Y (matlab format)
-            and moves it in the front
+            and moves it in the front. Ignored for lazy movies, whose time axis is the first one
     
         opencv: Boolean
             If True process using open cv method
@@ -193,8 +193,8 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
     """Computes the correlation image for the input dataset Y
 
     Args:
-        Y:  np.ndarray (3D or 4D)
-            Input movie data in 3D or 4D format
+        Y:  np.ndarray (3D or 4D), or lazy movie (MovieReader, MovieChain)
+            Input movie data in 3D or 4D format. Lazy movies are read in chunks of frames
     
         eight_neighbours: Boolean
             Use 8 neighbors if true, and 4 if false for 3D data (default = True)
@@ -202,7 +202,7 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
     
         swap_dim: Boolean
             True indicates that time is listed in the last axis of Y (matlab format)
-            and moves it in the front
+            and moves it in the front. Ignored for lazy movies, whose time axis is the first one
 
         order_mean: (undocumented)
 
@@ -210,14 +210,26 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
         rho: d1 x d2 [x d3] matrix, cross-correlation with adjacent pixels
     """
 
-    if swap_dim:
-        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+    # pairs of neighbouring pixels: horizontal, vertical, depth (4D), and the two diagonals
+    pairs = [((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+             ((slice(None), slice(None, -1)), (slice(None), slice(1, None)))]
+    if Y.ndim == 4:
+        pairs.append(((slice(None), slice(None), slice(None, -1)), (slice(None), slice(None), slice(1, None))))
+    elif eight_neighbours:
+        pairs += [((slice(1, None), slice(None, -1)), (slice(None, -1), slice(1, None))),
+                  ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None)))]
+
+    if not isinstance(Y, (cm.base.movies.MovieReader, cm.base.movies.MovieChain)):
+        if swap_dim:
+            Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+        w_mov = (Y - np.mean(Y, axis=0)) / np.std(Y, axis=0)
+        rho_pairs = [np.mean(np.multiply(w_mov[(slice(None),) + sl1], w_mov[(slice(None),) + sl2]), axis=0)
+                     for sl1, sl2 in pairs]
+    else:
+        rho_pairs = _local_correlations_chunked(Y, pairs)
 
     rho = np.zeros(np.shape(Y)[1:])
-    w_mov = (Y - np.mean(Y, axis=0)) / np.std(Y, axis=0)
-
-    rho_h = np.mean(np.multiply(w_mov[:, :-1, :], w_mov[:, 1:, :]), axis=0)
-    rho_w = np.mean(np.multiply(w_mov[:, :, :-1], w_mov[:, :, 1:]), axis=0)
+    rho_h, rho_w = rho_pairs[:2]
 
     # yapf: disable
     if order_mean == 0:
@@ -235,7 +247,7 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
         rho[:,  1:] = rho[:,  1:] + rho_w**(order_mean)
 
     if Y.ndim == 4:
-        rho_d = np.mean(np.multiply(w_mov[:, :, :, :-1], w_mov[:, :, :, 1:]), axis=0)
+        rho_d = rho_pairs[2]
         rho[:, :, :-1] = rho[:, :, :-1] + rho_d
         rho[:, :, 1:] = rho[:, :, 1:] + rho_d
 
@@ -249,8 +261,7 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
 
     else:
         if eight_neighbours:
-            rho_d1 = np.mean(np.multiply(w_mov[:, 1:, :-1], w_mov[:, :-1, 1:,]), axis=0)
-            rho_d2 = np.mean(np.multiply(w_mov[:, :-1, :-1], w_mov[:, 1:, 1:,]), axis=0)
+            rho_d1, rho_d2 = rho_pairs[2:]
 
             if order_mean == 0:
                 rho_d1 = rho_d1
@@ -290,6 +301,24 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
     return rho
 
 
+def _local_correlations_chunked(Y, pairs: List, chunk_size: int = 1000) -> List[np.ndarray]:
+    """ correlations of the pairs of neighbouring pixels of a lazy movie (time first), accumulating
+    in double precision the moments of chunks of frames, so that the movie is read once """
+    T = len(Y)
+    s1 = np.zeros(Y.shape[1:])
+    s2 = np.zeros(Y.shape[1:])
+    s12 = [np.zeros(s1[sl1].shape) for sl1, _ in pairs]
+    for start in range(0, T, chunk_size):
+        frames = np.asarray(Y[start:start + chunk_size], dtype=np.float64)
+        s1 += frames.sum(0)
+        s2 += (frames**2).sum(0)
+        for prod, (sl1, sl2) in zip(s12, pairs):
+            prod += np.einsum('t...,t...->...', frames[(slice(None),) + sl1], frames[(slice(None),) + sl2])
+    mean = s1 / T
+    std = np.sqrt(np.maximum(s2 / T - mean**2, 0))
+    return [(prod / T - mean[sl1] * mean[sl2]) / (std[sl1] * std[sl2]) for prod, (sl1, sl2) in zip(s12, pairs)]
+
+
 def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True,
                     background_filter: str = 'disk') -> Tuple[np.ndarray, np.ndarray]:
     """
@@ -663,14 +692,19 @@ def local_correlations_movie(file_name,
             local correlation movie
 
     """
-    Y = cm.load(file_name) if type(file_name) is str else file_name
-    Y = Y[..., :tot_frames] if swap_dim else Y[:tot_frames]
+    if type(file_name) is str and not swap_dim:
+        # frames are read from the file as they are needed
+        Y = cm.base.movies.MovieReader(file_name, chunk_size=max(window, stride))
+        T = len(Y) if tot_frames is None else min(len(Y), tot_frames)
+    else:
+        Y = cm.load(file_name) if type(file_name) is str else file_name
+        Y = Y[..., :tot_frames] if swap_dim else Y[:tot_frames]
+        T = Y.shape[-1] if swap_dim else len(Y)
     first_moment, second_moment, crosscorr, col_ind, row_ind, num_neigbors, M, cn = \
         prepare_local_correlations(Y[..., :window] if swap_dim else Y[:window],
                                    swap_dim=swap_dim, eight_neighbours=eight_neighbours)
     if swap_dim:
         Y = np.transpose(Y, (Y.ndim - 1,) + tuple(range(Y.ndim - 1)))
-    T = len(Y)
     dims = Y.shape[1:]
     corr_movie = np.zeros(((T - window) // stride + 1,) + dims, dtype=Y.dtype)
     corr_movie[0] = cn
@@ -680,11 +714,13 @@ def local_correlations_movie(file_name,
                                                            first_moment, second_moment, crosscorr, col_ind, row_ind,
                                                            num_neigbors, M, cn, Y[tt * stride:(tt + 1) * stride]) # FIXME all params after M are invalid
     elif mode == 'exponential':
-        for tt, frames in enumerate(Y[window:window + (T - window) // stride * stride].reshape((-1, stride) + dims)):
+        for tt in range((T - window) // stride):
+            frames = Y[tt * stride + window:(tt + 1) * stride + window]
             corr_movie[tt + 1] = update_local_correlations(window, frames, first_moment, second_moment, crosscorr,
                                                            col_ind, row_ind, num_neigbors, M)
     elif mode == 'cumulative':
-        for tt, frames in enumerate(Y[window:window + (T - window) // stride * stride].reshape((-1, stride) + dims)):
+        for tt in range((T - window) // stride):
+            frames = Y[tt * stride + window:(tt + 1) * stride + window]
             corr_movie[tt + 1] = update_local_correlations(tt + window + 1, frames, first_moment, second_moment,
                                                            crosscorr, col_ind, row_ind, num_neigbors, M)
     else:
@@ -777,7 +813,12 @@ def local_correlations_movie_offline(file_name,
 
 def local_correlations_movie_parallel(params: Tuple) -> np.ndarray:
     mv_name, idx, eight_neighbours, swap_dim, order_mean, ismulticolor, remove_baseline, winSize_baseline, quantil_min_baseline  = params
-    mv = cm.load(mv_name, subindices=idx, in_memory=True)
+    if isinstance(mv_name, str):
+        # only the frames of the window are read
+        with cm.base.movies.MovieReader(mv_name, cache_size=0) as reader:
+            mv = cm.movie(np.array(reader[idx]))
+    else:
+        mv = cm.load(mv_name, subindices=idx, in_memory=True)
     if remove_baseline:
         mv.removeBL(quantilMin=quantil_min_baseline, windowSize=winSize_baseline, in_place=True)
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import numpy.testing as npt
+import scipy.sparse
+
+from caiman.base.movies import movie
+from caiman.cluster import (CachedTask, ClusterExecutor, MapReport, MemoryBudget, ResultCache, broadcast, fetch,
+                            file_fingerprint, hash_content, release, thread_limits, worker_threads)
+from caiman.mmapping import load_memmap, parallel_dot_product, save_memmap
+
+
+def test_broadcast():
+    Y = np.random.rand(300, 20, 25).astype(np.float32)
+    b = np.random.rand(300, 7)
+    b_sparse = scipy.sparse.random(500, 7, density=0.1, format='csr')
+    with tempfile.TemporaryDirectory() as tmpdir, multiprocessing.Pool(2) as pool:
+        Yr, _, _ = load_memmap(movie(Y).save(os.path.join(tmpdir, 'Yr.mmap'), order='C'))
+        npt.assert_array_equal(parallel_dot_product(Yr, b, block_size=60, dview=pool),
+                               parallel_dot_product(Yr, b, block_size=60))
+        npt.assert_allclose(parallel_dot_product(Yr, b_sparse, block_size=60, dview=pool, transpose=True),
+                            parallel_dot_product(Yr, b_sparse, block_size=60, transpose=True), rtol=1e-5)
+        with broadcast(b, pool) as handle:
+            npt.assert_array_equal(pool.map(fetch, [handle] * 3)[-1], b)
+        with broadcast(b_sparse, pool) as handle:
+            npt.assert_array_equal(pool.map(fetch, [handle] * 3)[-1].toarray(), b_sparse.toarray())
+        with broadcast({'nb': 2}, pool) as handle:
+            assert pool.map(fetch, [handle] * 3)[-1] == {'nb': 2}
+    # without a cluster the object itself is used
+    assert fetch(broadcast(b)) is b
+    release(b)
+
+
+def _square(x):
+    time.sleep(0.01 * (x % 3))
+    return x * x
+
+
+def test_cluster_executor():
+    for dview in [None, 'threads', 'processes']:
+        with ClusterExecutor(dview, n_processes=2) as executor:
+            npt.assert_array_equal(executor.map(_square, range(10)), np.arange(10)**2)
+            progress = []
+            res = dict(executor.imap_unordered(_square, range(10), with_index=True, max_pending=3,
+                                               progress=lambda n_done, n_total: progress.append(n_done)))
+            assert res == {i: i * i for i in range(10)}
+            assert progress[-1] == 10
+            if dview is not None:
+                results = executor.imap_unordered(time.sleep, [0.1] * 20)
+                next(results)
+                executor.cancel()
+                try:
+                    list(results)
+                    assert False, 'cancelled map did not raise'
+                except concurrent.futures.CancelledError:
+                    pass
+
+
+def _allocate(n_bytes):
+    return np.ones(n_bytes, dtype=np.uint8).sum()
+
+
+def test_memory_budget():
+    budget = MemoryBudget('100MB')
+    assert budget.bytes == 100 * 2**20
+    # blocks shrink so that all the workers fit
+    plan = budget.plan('blocks', 2**20, 1000, 4, max_size=500)
+    assert plan.block_size == 25 and plan.n_concurrent == 4
+    # tasks too large for the workers run fewer at a time
+    plan = budget.plan('patches', 40 * 2**20, 1, 4)
+    assert plan.block_size == 1 and plan.n_concurrent == 2
+    with ClusterExecutor('processes', n_processes=2) as executor:
+        res = list(executor.imap_unordered(_allocate, [2**25] * 4, plan=plan))
+    assert res == [2**25] * 4
+    stats = budget.report()['patches']
+    assert stats['n_tasks'] == 4 and stats['estimated_bytes'] == 40 * 2**20
+    assert stats['max_peak_bytes'] >= 2**25
+
+
+def test_thread_limits():
+    omp_threads = os.environ.get('OMP_NUM_THREADS')
+    with thread_limits(3):
+        assert os.environ['OMP_NUM_THREADS'] == '3'
+    assert os.environ.get('OMP_NUM_THREADS') == omp_threads
+    with ClusterExecutor('processes', n_processes=2, threads_per_process=1) as executor:
+        assert executor.map(_worker_omp_threads, range(2)) == [(1, '1')] * 2
+
+
+def _worker_omp_threads(_):
+    return worker_threads(), os.environ.get('OMP_NUM_THREADS')
+
+
+def _fails_once(x, _attempts={}):
+    _attempts[x] = _attempts.get(x, 0) + 1
+    if x == 3 and _attempts[x] == 1:
+        raise RuntimeError('transient')
+    if x == 5:
+        raise ValueError('degenerate')
+    return x
+
+
+def test_map_retries():
+    for dview in [None, 'threads']:
+        _fails_once.__defaults__[0].clear()
+        report = MapReport()
+        with ClusterExecutor(dview, n_processes=2) as executor:
+            res = list(executor.imap(_fails_once, range(8), retries=1, on_error='skip', report=report))
+        assert res == [0, 1, 2, 3, 4, None, 6, 7]
+        assert report.n_done == 8 and report.n_retries == 2
+        assert report.failed_indices == [5] and report.failures[0].attempts == 2
+        assert 'degenerate' in report.failures[0].traceback
+
+
+def test_result_cache():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fname = os.path.join(cache_dir, 'data.npy')
+        np.save(fname, np.arange(1000.))
+        key = hash_content(file_fingerprint(fname), {'K': 4, 'gSig': (3, 3)}, np.arange(5))
+        assert key == hash_content(file_fingerprint(fname), {'gSig': (3, 3), 'K': 4}, np.arange(5))
+        assert key != hash_content(file_fingerprint(fname), {'K': 5, 'gSig': (3, 3)}, np.arange(5))
+        # files are identified by their modification time (and the checksum of their header if any)
+        fname_mmap = save_memmap([np.ones((10, 4, 5), dtype=np.float32)], base_name=os.path.join(cache_dir, 'Yr'),
+                                 order='C', checksum=True)
+        for name in (fname, fname_mmap):
+            fingerprint = file_fingerprint(name)
+            os.utime(name, (0, 0))
+            assert file_fingerprint(name) != fingerprint
+        # frames modified in place leave the checksum of the header stale
+        fingerprint = file_fingerprint(fname_mmap)
+        Yr, _, _ = load_memmap(fname_mmap, mode='r+')
+        Yr[0] = 2
+        Yr.flush()
+        del Yr
+        os.utime(fname_mmap, (1, 1))
+        assert file_fingerprint(fname_mmap) != fingerprint
+
+        cache = ResultCache(os.path.join(cache_dir, 'cache'))
+        task = CachedTask(_square, cache)
+        assert task(('a', 3)) == 9 and 'a' in cache
+        npt.assert_raises(KeyError, cache.load, 'b')
+        task = CachedTask(None, cache)  # hits only, func is not called
+        assert task(('a', 3)) == 9
+
+        for i, key in enumerate('abcd'):
+            if key != 'a':
+                cache.store(key, np.zeros(1000))
+            os.utime(cache._path(key), (i, i))
+        cache.load('b')  # most recently used
+        cache.evict(2 * os.path.getsize(cache._path('b')))
+        assert 'b' in cache and 'd' in cache and 'a' not in cache and 'c' not in cache
+        cache.clear()
+        assert cache.size() == 0
+
+
+def _sleep(x):
+    time.sleep(1 if x >= 4 else 0.01)
+    return x
+
+
+def test_speculative_bounded():
+    # the two slow tasks are run again by the idle workers, within max_pending tasks at the same time
+    for max_pending, n_speculative in ((None, 2), (3, 1)):
+        report = MapReport()
+        with ClusterExecutor('threads', n_processes=4) as executor:
+            res = list(executor.imap(_sleep, range(6), max_pending=max_pending, speculative=0.5, report=report))
+        assert res == list(range(6)) and report.n_speculative == n_speculative
@@ -1,8 +1,12 @@
+import os
 import pathlib
+import tempfile
 
 import numpy as np
 import nose
+import tifffile
 
+import caiman as cm
 from caiman import mmapping
 from caiman.paths import caiman_datadir
 
@@ -73,3 +77,71 @@ def test_load_successful_3d():
     assert (d1, d2, d3) == (10, 11, 13)
     assert T == 12
     assert isinstance(Yr, np.memmap)
+
+
+def test_memmap_header():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = (100 * np.random.RandomState(0).rand(20, 10, 11)).astype(np.float32)
+        Yr_ref = np.reshape(mov.transpose(1, 2, 0), (110, 20), order='F') + np.float32(0.0001)
+        # uint16 files store the rounded data, without the offset of 0.0001
+        for dtype, atol in ((np.float32, 0), (np.float16, 0.1), (np.uint16, 0.501)):
+            fname = mmapping.save_memmap([mov], base_name=os.path.join(tmpdir, 'mov'), order='C', dtype=dtype, fr=10,
+                                         checksum=True)
+            header = mmapping.load_memmap_header(fname)
+            assert header['dims'] == [10, 11] and header['T'] == 20 and header['fr'] == 10
+            assert header['checksum'] is not None
+            Yr, dims, T = mmapping.load_memmap(fname, verify=True)
+            assert Yr.dtype == dtype and dims == (10, 11) and T == 20
+            np.testing.assert_allclose(Yr, Yr_ref, atol=atol)
+            # files without header are described by their name
+            os.remove(mmapping.memmap_header_filename(fname))
+            Yr, dims, T = mmapping.load_memmap(fname)
+            assert Yr.dtype == dtype and dims == (10, 11) and T == 20
+
+
+def test_save_memmap_join_tiles():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        movs = [(100 * np.random.rand(T, 10, 11)).astype(np.float32) for T in (30, 17)]
+        fnames = [cm.movie(mov).save(os.path.join(tmpdir, 'mov{}.mmap'.format(k)), order='F')
+                  for k, mov in enumerate(movs)]
+        Yr_ref = np.hstack([np.reshape(mov.transpose(1, 2, 0), (110, -1), order='F') for mov in movs])
+        for mem_budget in (2**30, 2**12):
+            fname = mmapping.save_memmap_join(fnames, base_name=os.path.join(tmpdir, 'join'), mem_budget=mem_budget)
+            Yr, dims, T = mmapping.load_memmap(fname)
+            assert not np.isfortran(Yr) and T == 47
+            np.testing.assert_array_equal(Yr, Yr_ref)
+
+
+def test_chunked_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = np.random.poisson(50, (300, 40, 50)).astype(np.float32)
+        fname_in = cm.movie(mov).save(os.path.join(tmpdir, 'mov.mmap'), order='C')
+        fname = mmapping.save_chunked(fname_in, os.path.join(tmpdir, 'mov_chunked.h5'), pixel_chunks=(16, 16, 64))
+        Yr_ref = np.reshape(mov.transpose(1, 2, 0), (-1, 300), order='F')
+        with mmapping.ChunkedStore(fname) as store:
+            assert store.shape == mov.shape
+            np.testing.assert_array_equal(store[10], mov[10])
+            np.testing.assert_array_equal(store[:, 5:30, 16:32], mov[:, 5:30, 16:32])
+            np.testing.assert_array_equal(store[20:200:7, [3, 1], 4], mov[20:200:7, [3, 1], 4])
+            idx = np.random.choice(2000, 300, replace=False)
+            np.testing.assert_array_equal(store.pixels(idx, slice(50, 80)), Yr_ref[idx, 50:80])
+        Yr, dims, T = mmapping.load_memmap(fname)
+        assert dims == (40, 50) and T == 300
+        np.testing.assert_array_equal(Yr[100:400], Yr_ref[100:400])
+        Yr.store.close()
+
+
+def test_save_memmap_uint16():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = np.random.randint(0, 4000, (60, 10, 11)).astype(np.uint16)
+        fname_in = os.path.join(tmpdir, 'mov.tif')
+        tifffile.imsave(fname_in, mov)
+        fname = mmapping.save_memmap([fname_in], base_name=os.path.join(tmpdir, 'Yr'), order='C',
+                                     dtype=np.uint16, add_to_movie=10)
+        Yr, dims, T = mmapping.load_memmap(fname)
+        assert Yr.dtype == np.uint16
+        # the data are stored as they are, the offset is added when converting them
+        np.testing.assert_array_equal(np.reshape(Yr.T, (T,) + dims, order='F'), mov)
+        np.testing.assert_allclose(mmapping.memmap_offset(fname), 10.0001, rtol=1e-6)
+        with cm.base.movies.MovieReader(fname) as reader:
+            np.testing.assert_allclose(reader[5:9], mov[5:9] + 10.0001, rtol=1e-6)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import glob
+import os
+import pickle
+import scipy.io
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+from scipy.ndimage import gaussian_filter, shift
+import tifffile
+
+from caiman import mmapping
+from caiman import motion_correction as mc
+from caiman.base.movies import SbxMovie
+
+
+def gen_shifted_frames(T=20, dims=(64, 72), max_shift=4, seed=0):
+    np.random.seed(seed)
+    pad = 2 * max_shift
+    base = gaussian_filter(np.random.rand(dims[0] + 2 * pad, dims[1] + 2 * pad), 2)
+    template = base[pad:-pad, pad:-pad]
+    shifts = np.random.uniform(-max_shift, max_shift, (T, 2))
+    frames = np.stack([shift(base, sh)[pad:-pad, pad:-pad] for sh in shifts])
+    return frames, template
+
+
+def test_register_translation_batch():
+    frames, template = gen_shifted_frames()
+    for kwargs in ({'upsample_factor': 10, 'max_shifts': (6, 6)},
+                   {'upsample_factor': 1, 'max_shifts': (6, 6)},
+                   {'upsample_factor': 10, 'shifts_lb': np.array([-2, -3]), 'shifts_ub': np.array([3, 1])}):
+        shifts, src_freq, phasediff = mc.register_translation_batch(frames, template, **kwargs)
+        for fr, sh, sf in zip(frames, shifts, src_freq):
+            sh_ref, sf_ref, _ = mc.register_translation(fr, template, **kwargs)
+            npt.assert_allclose(sh, sh_ref)
+            npt.assert_allclose(sf, sf_ref, atol=1e-10)
+
+
+def test_rigid_correct_batch():
+    frames, template = gen_shifted_frames()
+    for shifts_opencv in (True, False):
+        mov, shifts = mc.rigid_correct_batch(frames, template, (6, 6), add_to_movie=1.,
+                                             shifts_opencv=shifts_opencv, batch_size=7)
+        for fr, m, sh in zip(frames, mov, shifts):
+            m_ref, sh_ref, _, _ = mc.tile_and_correct(fr, template, None, None, (6, 6), add_to_movie=1.,
+                                                      max_deviation_rigid=0, shifts_opencv=shifts_opencv)
+            npt.assert_allclose(sh, sh_ref)
+            npt.assert_allclose(m, m_ref, rtol=1e-5, atol=1e-5)
+
+
+def test_template_registrar():
+    frames, template = gen_shifted_frames(T=5, dims=(96, 100))
+    registrar = mc.TemplateRegistrar(template + 1., upsample_factor=10, max_shifts=(6, 6))
+    for max_deviation_rigid in (0, 2):
+        for fr in frames:
+            kwargs = dict(strides=(48, 48), overlaps=(16, 16), max_shifts=(6, 6), add_to_movie=1.,
+                          max_deviation_rigid=max_deviation_rigid, shifts_opencv=True)
+            m_ref, sh_ref, _, _ = mc.tile_and_correct(fr, template, **kwargs)
+            m, sh, _, _ = mc.tile_and_correct(fr, template, registrar=registrar, **kwargs)
+            npt.assert_allclose(sh, sh_ref)
+            npt.assert_allclose(m, m_ref)
+
+
+def test_tile_and_correct_batch():
+    frames, template = gen_shifted_frames(T=6, dims=(96, 100))
+    for max_deviation_rigid in (2, None):
+        for gSig_filt in (None, (3, 3)):
+            kwargs = dict(strides=(48, 48), overlaps=(16, 16), max_shifts=(6, 6), add_to_movie=1.,
+                          max_deviation_rigid=max_deviation_rigid, gSig_filt=gSig_filt)
+            mov, shifts, start_step, xy_grid = mc.tile_and_correct_batch(frames.astype(np.float32), template,
+                                                                         batch_size=4, **kwargs)
+            assert mov.dtype == np.float32
+            for fr, m, sh in zip(frames, mov, shifts):
+                m_ref, sh_ref, start_step_ref, xy_grid_ref = mc.tile_and_correct(fr, template, shifts_opencv=True,
+                                                                                 **kwargs)
+                npt.assert_allclose(sh, sh_ref)
+                npt.assert_allclose(m, m_ref, atol=1e-4)
+                npt.assert_array_equal(start_step, start_step_ref)
+                npt.assert_array_equal(xy_grid, xy_grid_ref)
+
+
+def test_motion_correct_memmap_C():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fnames = []
+        for seed in range(2):
+            frames, _ = gen_shifted_frames(T=30, dims=(96, 100), seed=seed)
+            fnames.append(os.path.join(tmpdir, 'mov{}.tif'.format(seed)))
+            tifffile.imsave(fnames[-1], (100 * frames).astype(np.float32))
+        for pw_rigid in (False, True):
+            mcorr = mc.MotionCorrect(fnames, max_shifts=(6, 6), strides=(48, 48), overlaps=(16, 16),
+                                     splits_rig=3, splits_els=3, pw_rigid=pw_rigid, min_mov=0)
+            template = mcorr.motion_correct().total_template_rig
+            mcorr.motion_correct(template=template, save_movie=True)
+            Yr_ref = np.hstack([mmapping.load_memmap(mmapping.save_memmap(
+                [fname], base_name=os.path.join(tmpdir, 'ref'), order='C'))[0] for fname in mcorr.mmap_file])
+            mcorr.motion_correct(template=template, save_movie=True, order='C',
+                                 base_name=os.path.join(tmpdir, 'fused'))
+            Yr, dims, T = mmapping.load_memmap(mcorr.mmap_file[0])
+            assert not np.isfortran(Yr)
+            assert dims == (96, 100) and T == 60
+            npt.assert_allclose(Yr, Yr_ref, rtol=1e-5)
+            if pw_rigid:
+                # patch grid of each frame: 2 x 2 patches of 48 + 16 pixels
+                assert len(mcorr.coord_shifts_els) == 60
+                npt.assert_array_equal(mcorr.coord_shifts_els[-1], [(0, 0), (0, 1), (1, 0), (1, 1)])
+
+
+def test_motion_correct_resume():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        frames, _ = gen_shifted_frames(T=40, dims=(96, 100))
+        fname = os.path.join(tmpdir, 'mov.tif')
+        tifffile.imsave(fname, (100 * frames).astype(np.float32))
+        for pw_rigid in (False, True):
+            kwargs = dict(max_shifts=(6, 6), strides=(48, 48), overlaps=(16, 16), splits_rig=4, splits_els=4,
+                          pw_rigid=pw_rigid, min_mov=0)
+            mcorr = mc.MotionCorrect(fname, **kwargs)
+            mcorr.motion_correct(save_movie=True)
+            Yr_ref = np.array(mmapping.load_memmap(mcorr.mmap_file[0])[0])
+            shifts_ref = mcorr.x_shifts_els if pw_rigid else mcorr.shifts_rig
+            # simulate a run interrupted after two chunks
+            journal = sorted(glob.glob(os.path.join(mc._journal_dir(mcorr.mmap_file[0]), '*.pickle')))
+            assert len(journal) == 4
+            for entry in journal[2:]:
+                os.remove(entry)
+            Yr = mmapping.load_memmap(mcorr.mmap_file[0], mode='r+')[0]
+            Yr[:, 20:] = 0
+            del Yr
+            mtimes = [os.path.getmtime(entry) for entry in journal[:2]]
+            mcorr = mc.MotionCorrect(fname, resume=True, **kwargs)
+            mcorr.motion_correct(save_movie=True)
+            assert [os.path.getmtime(entry) for entry in journal[:2]] == mtimes
+            npt.assert_array_equal(mmapping.load_memmap(mcorr.mmap_file[0])[0], Yr_ref)
+            npt.assert_array_equal(mcorr.x_shifts_els if pw_rigid else mcorr.shifts_rig, shifts_ref)
+
+
+def test_template_registrar_pyramid():
+    frames, template = gen_shifted_frames(T=10, dims=(128, 120), max_shift=20)
+    shifts_ref = mc.TemplateRegistrar(template, upsample_factor=10, max_shifts=(24, 24)).register_batch(frames)[0]
+    for pyramid_levels in (1, 2, 3):
+        registrar = mc.TemplateRegistrar(template, upsample_factor=10, max_shifts=(24, 24),
+                                         pyramid_levels=pyramid_levels)
+        npt.assert_allclose(registrar.register_batch(frames)[0], shifts_ref)
+    registrar = mc.TemplateRegistrar(template, upsample_factor=1, max_shifts=(24, 24), pyramid_levels=2)
+    npt.assert_allclose(registrar.register_batch(frames)[0],
+                        mc.TemplateRegistrar(template, upsample_factor=1, max_shifts=(24, 24)).register_batch(frames)[0])
+
+
+def test_motion_correct_sbx_plane():
+    planes = [(1000 * gen_shifted_frames(T=30, dims=(96, 100), seed=seed)[0] + 100).astype(np.uint16)
+              for seed in range(2)]
+    mov = np.stack(planes, axis=1).reshape((60, 96, 100))  # interleaved planes
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'rec')
+        (2**16 - 1 - mov).transpose(2, 1, 0).ravel(order='F').tofile(fname + '.sbx')
+        scipy.io.savemat(fname + '.mat', {'info': {'channels': 2, 'sz': np.array([96, 100]), 'recordsPerBuffer': 96,
+                                                   'otparam': np.array([0, 0, 2])}})
+        tifffile.imsave(os.path.join(tmpdir, 'plane1.tif'), planes[1])
+        sbx = SbxMovie(fname + '.sbx', plane=1)
+        assert os.fspath(sbx).endswith('rec_plane1.sbx')
+        npt.assert_array_equal(np.asarray(pickle.loads(pickle.dumps(sbx))[:]), planes[1])
+        kwargs = dict(max_shifts=(6, 6), splits_rig=3, min_mov=0)
+        mcorr = mc.MotionCorrect(sbx, **kwargs).motion_correct(save_movie=True,
+                                                                                          order='C')
+        mcorr_ref = mc.MotionCorrect(os.path.join(tmpdir, 'plane1.tif'), **kwargs).motion_correct(
+            save_movie=True, order='C')
+        assert os.path.basename(mcorr.mmap_file[0]).startswith('rec_plane1_rig_')
+        npt.assert_allclose(mcorr.shifts_rig, mcorr_ref.shifts_rig)
+        npt.assert_allclose(mmapping.load_memmap(mcorr.mmap_file[0])[0],
+                            mmapping.load_memmap(mcorr_ref.mmap_file[0])[0])
@@ -1,9 +1,18 @@
 #!/usr/bin/env python
+import h5py
 import numpy as np
 import numpy.testing as npt
 import os
-from caiman.base.movies import load, load_iter
+import pickle
+import scipy.io
+import tempfile
+import tifffile
+from caiman.base.movies import load, load_iter, MovieReader, PrefetchIterator, tiff_index, tiff_index_filename, \
+    SbxMovie, movie, resize_file, removeBL_file, computeDFF_file, bin_median_file, load_movie_chain, MovieChain
+from caiman.base.timeseries import save_movie_file
+from caiman.mmapping import load_memmap
 from caiman.paths import caiman_datadir
+from caiman.summary_images import local_correlations
 
 
 def test_load_iter():
@@ -17,3 +26,123 @@ def test_load_iter():
             except StopIteration:
                 break
         npt.assert_allclose(S, load(fname, subindices=subindices).sum(), rtol=1e-6)
+
+
+def test_movie_reader():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = (100 * np.random.rand(60, 12, 14)).astype(np.uint16)
+        fnames = [os.path.join(tmpdir, name) for name in ('mov.tif', 'mov_zip.tif', 'mov.h5', 'mov.npy')]
+        tifffile.imsave(fnames[0], mov)
+        tifffile.imsave(fnames[1], mov, compress=6)
+        with h5py.File(fnames[2], 'w') as f:
+            f['mov'] = mov
+        np.save(fnames[3], mov)
+        for fname in fnames:
+            for cache_size in (0, 2):
+                with MovieReader(fname, chunk_size=16, cache_size=cache_size) as reader:
+                    assert reader.shape == mov.shape
+                    for key in (slice(10, 50), (slice(3, None, 7), slice(2, 9)), [5, 1, 40], 7,
+                                (Ellipsis, slice(4, 6)), range(30, 35)):
+                        npt.assert_array_equal(reader[key], mov[key].astype(np.float32))
+                    npt.assert_array_equal(np.array(list(reader)), mov)
+
+
+def test_tiff_index():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = (100 * np.random.rand(40, 12, 14)).astype(np.uint16)
+        fname = os.path.join(tmpdir, 'mov.tif')
+        with tifffile.TiffWriter(fname) as tif:
+            # pages with descriptions of different length, as in ScanImage files
+            for t, frame in enumerate(mov):
+                tif.save(frame, description='frameNumbers = {}\n'.format(10**t), contiguous=False)
+        index = tiff_index(fname)
+        assert os.path.exists(tiff_index_filename(fname))
+        assert index.shape == mov.shape and index.contiguous and index.memmap() is None
+        npt.assert_array_equal(index.read([3, 1, 30]), mov[[3, 1, 30]])
+        npt.assert_array_equal(load(fname, subindices=slice(5, 25)), mov[5:25])
+        npt.assert_array_equal(np.array(list(load_iter(fname, subindices=slice(2, None, 3)))), mov[2::3])
+        with MovieReader(fname, outtype=None) as reader:
+            npt.assert_array_equal(reader[10:20, 3:7], mov[10:20, 3:7])
+
+
+def test_sbx_movie():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'rec')
+        raw = np.random.randint(0, 2**16, (2, 12, 10, 24)).astype(np.uint16)  # channel, column, row, frame
+        raw.ravel(order='F').tofile(fname + '.sbx')
+        scipy.io.savemat(fname + '.mat', {'info': {'channels': 1, 'sz': np.array([10, 12]), 'recordsPerBuffer': 10,
+                                                   'otparam': np.array([0, 0, 3])}})
+        mov = (2**16 - 1 - raw).transpose(0, 3, 2, 1)
+        npt.assert_array_equal(SbxMovie(fname + '.sbx')[:], mov[0])
+        npt.assert_array_equal(SbxMovie(fname, channel=1, plane=2)[1:5, 3:7], mov[1, 2::3][1:5, 3:7])
+        npt.assert_array_equal(load(fname + '.sbx', subindices=slice(3, 9)), mov[0, 3:9])
+        npt.assert_array_equal(np.array(list(load_iter(fname + '.sbx', subindices=slice(1, None, 5)))), mov[0, 1::5])
+
+
+def test_prefetch_iterator():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mov = (100 * np.random.rand(90, 12, 14)).astype(np.uint16)
+        fnames = [os.path.join(tmpdir, 'mov.tif'), os.path.join(tmpdir, 'mov.h5')]
+        tifffile.imsave(fnames[0], mov[:40], compress=6)
+        with h5py.File(fnames[1], 'w') as f:
+            f['mov'] = mov[40:]
+        for queue_size, num_threads in ((1, 1), (4, 3)):
+            with PrefetchIterator(fnames, subindices=[slice(10, None), None], queue_size=queue_size,
+                                  num_threads=num_threads, chunk_size=7) as frames:
+                npt.assert_array_equal(np.array(list(frames.iter_file(0))), mov[10:40])
+                npt.assert_array_equal(np.array(list(frames.iter_file(1))), mov[40:])
+            npt.assert_array_equal(np.array(list(load_iter(fnames[0], subindices=slice(5, None, 2), queue_size=queue_size,
+                                                           num_threads=num_threads))), mov[5:40:2])
+
+
+def test_streaming_resize_removeBL():
+    mov = (100 * np.random.rand(403, 12, 14) + 10).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = movie(mov).save(os.path.join(tmpdir, 'mov.mmap'), order='C')
+
+        def load_frames(fname_out):
+            Yr, dims, T = load_memmap(fname_out)
+            return np.reshape(Yr.T, (T,) + dims, order='F')
+
+        # chunks not aligned with the output frames
+        npt.assert_allclose(load_frames(resize_file(fname, fx=0.5, fy=0.5, fz=0.3, chunk_size=17)),
+                            movie(mov).resize(fx=0.5, fy=0.5, fz=0.3), rtol=1e-5, atol=1e-4)
+        fname_out, _ = removeBL_file(fname, windowSize=40, chunk_size=90)
+        npt.assert_allclose(load_frames(fname_out), movie(mov).removeBL(windowSize=40), rtol=1e-5, atol=1e-4)
+        for method in ('only_baseline', 'delta_f_over_f'):
+            fname_out, _ = computeDFF_file(fname, fr=10, secsWindow=3, method=method, chunk_size=70)
+            dff, _ = movie(mov, fr=10).computeDFF(secsWindow=3, method=method)
+            npt.assert_allclose(load_frames(fname_out), dff, rtol=1e-5, atol=1e-4)
+        npt.assert_allclose(bin_median_file(fname, window=7, mem_budget=2**12), movie(mov).bin_median(window=7),
+                            rtol=1e-5, atol=1e-4)
+
+
+def test_save_movie_file():
+    with tempfile.TemporaryDirectory() as folder:
+        mov = movie((100 * np.random.rand(205, 12, 14)).astype(np.float32), fr=10)
+        for fname, kwargs in (('mov.tif', {}), ('mov_zip.tif', {'compress': 6}),
+                              ('mov.h5', {'chunks': (16, 12, 14), 'compression': 'gzip'})):
+            mov.save(os.path.join(folder, fname), batch_size=30, **kwargs)
+            npt.assert_array_equal(load(os.path.join(folder, fname)), mov)
+        # streaming source with batches of various lengths
+        fname = save_movie_file(iter(np.array_split(mov, 9)), os.path.join(folder, 'stream.tif'), compress=1)
+        npt.assert_array_equal(load(fname), mov)
+
+
+def test_movie_chain():
+    with tempfile.TemporaryDirectory() as folder:
+        file_list = []
+        for i, T in enumerate((40, 55, 23)):
+            file_list.append(os.path.join(folder, 'trial_{}.tif'.format(i)))
+            movie((100 * np.random.rand(T, 20, 18)).astype(np.float32)).save(file_list[-1], compress=3 * (i == 1))
+        mov = load_movie_chain(file_list, top=2, bottom=3, left=1)
+        chain = MovieChain(file_list, top=2, bottom=3, left=1)
+        assert chain.shape == mov.shape
+        npt.assert_array_equal(chain[:], mov)
+        # frames across files, in any order
+        npt.assert_array_equal(chain[30:110:3, 2:10], mov[30:110:3, 2:10])
+        npt.assert_array_equal(pickle.loads(pickle.dumps(chain))[[100, 3, 41, 40]], mov[[100, 3, 41, 40]])
+        npt.assert_array_equal(load(chain, subindices=slice(35, 60)), mov[35:60])
+        npt.assert_allclose(local_correlations(chain), local_correlations(np.asarray(mov), swap_dim=False), atol=1e-6)
+        chain = MovieChain(file_list, subindices=slice(5, 20, 2))
+        npt.assert_array_equal(chain[:], load_movie_chain(file_list, subindices=slice(5, 20, 2)))
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import numpy as np
 import numpy.testing as npt
 import os
 from caiman.source_extraction import cnmf
@@ -53,3 +54,35 @@ def demo():
 def test_onacid():
     demo()
     pass
+
+
+def test_motion_template_cache():
+    C = np.random.RandomState(0).rand(3, 100)
+    activities = []
+
+    def build_template(activity):
+        activities.append(activity)
+        return np.random.RandomState(len(activities)).rand(32, 32)
+
+    # the template is rebuilt every refresh frames
+    cache = cnmf.online_cnmf.MotionTemplateCache(refresh=5, window=10, upsample_factor=10, max_shifts=(4, 4))
+    registrars = [cache.get(C, t, build_template) for t in range(20, 40)]
+    assert len(activities) == 4
+    assert [len(set(map(id, registrars[i:i + 5]))) for i in range(0, 20, 5)] == [1] * 4
+    assert len(set(map(id, registrars))) == 4
+    npt.assert_allclose(activities[-1], np.median(C[:, 24:34], 1))
+    assert len(cache.t_template) == 20
+
+    # the exponential moving average is updated at every frame
+    activities.clear()
+    cache = cnmf.online_cnmf.MotionTemplateCache(refresh=3, window=10, mode='ema', upsample_factor=10,
+                                                 max_shifts=(4, 4))
+    for t in range(20, 27):
+        cache.get(C, t, build_template)
+    ema = np.median(C[:, 9:19], 1)
+    for t in range(21, 27):
+        ema += (C[:, t - 1] - ema) / 10
+    assert len(activities) == 3
+    npt.assert_allclose(activities[-1], ema)
+    npt.assert_allclose(cache.activity, ema)
+    assert len(cache.t_template) == 7